@@ -1,23 +1,35 @@
 # -*- coding: utf-8 -*-
 from django.contrib import admin
 
-from addons.models import AddonMySQL, Addon, AddonPostgresql, AddonMongodb, AddonRabbitmq, AddonInfluxdb, AddonSnapshot
+from addons.models import AddonMySQL, Addon, AddonPostgresql, AddonMongodb, AddonRabbitmq, AddonInfluxdb, \
+    AddonSnapshot, select_real_addons
 from addons.tasks import create_volume_and_release
-from hubot.utils.mesos import suspend_marathon_app
+from hubot.utils.deploy_batch import bulk_deploy, bulk_suspend
+
+
+def volumes_ready(addon):
+    return not addon.get_plugin_volumes() or bool(addon.volume_ids and addon.check_volume_status())
 
 
 def addon_release(modeladmin, request, queryset):
-    for query in queryset:
+    addons = []
+    for query in select_real_addons(queryset):
         addon = query.real_addon
-        if query.depend:
-            create_volume_and_release.apply_async(args=[addon.depend, True])
-        create_volume_and_release.apply_async(args=[addon, True])
+        depends = [addon.depend.real_addon] if addon.depend else []
+        if all(volumes_ready(obj) for obj in depends + [addon]):
+            addons.extend(depends + [addon])
+            continue
+        # the volumes are created first, one addon at a time
+        for obj in depends + [addon]:
+            create_volume_and_release.apply_async(args=[obj, True])
+    result = bulk_deploy(addons)
+    modeladmin.message_user(request, result.describe("deployed"))
 addon_release.short_description = "Releases all selected addons"
 
 
 def addon_suspend(modeladmin, request, queryset):
-    for query in queryset:
-        suspend_marathon_app(query)
+    result = bulk_suspend([query.real_addon for query in select_real_addons(queryset)])
+    modeladmin.message_user(request, result.describe("suspended"))
 addon_suspend.short_description = "Suspend all selected addons"
 
 
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('addons', '0015_auto_20160603_1123'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='addon',
+            name='spec_hash',
+            field=models.CharField(max_length=40, verbose_name='Marathon Spec Hash', blank=True),
+        ),
+    ]
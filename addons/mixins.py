@@ -5,6 +5,7 @@
 """
 from __future__ import absolute_import, print_function
 from hubot.utils.mesos import clean_container_path
+from hubot.utils.transactions import on_commit
 
 
 class AddonsMixin(object):
@@ -78,7 +79,8 @@ class AddonsMixin(object):
         from addons.models import AddonSnapshot
 
         snapshot = AddonSnapshot.objects.create(addon=self, description=description or '')
-        snapshot.create(description=description)
+        # the cinder snapshots are taken once the row is committed, a rolled back batch takes none
+        on_commit(snapshot.create, description=description)
         return snapshot
 
     def destroy_snapshot(self, snapshot_short_id):
@@ -89,4 +91,4 @@ class AddonsMixin(object):
         except AddonSnapshot.DoesNotExist:
             pass
         else:
-            snapshot.destroy()
+            on_commit(snapshot.destroy)
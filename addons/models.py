@@ -4,25 +4,26 @@ import random
 import string
 import uuid
 
-import time
-
 from django.conf import settings
 from django.db import models
 from django.utils.crypto import get_random_string
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
-from marathon import MarathonHttpError
+from marathon import MarathonError
 from model_utils.models import TimeStampedModel, StatusModel
 from safedelete.shortcuts import SoftDeleteMixin
 from model_utils import Choices
 
 from api.utils import get_random_hour, get_random_minute
 from hubot.fields import RandomCharField
+from hubot.utils.identity import current_identity_map
 from addons.mixins import AddonsMixin
-from addons.utils import addons_registry, get_cinder
+from addons.utils import addons_registry, get_cinder, ADDONS_REGISTRY
 from hubot.utils.mesos import MarathonAppMixin, destroy_marathon_app, create_or_update_marathon_app, \
     suspend_marathon_app
+from hubot.utils.retry import CircuitOpenError, cinder_policy, marathon_policy
+from hubot.utils.transactions import on_commit
 from hubot.models import MesosResourceModel, NamespaceModel, validate_size, validate_minute, validate_hour, \
     validate_backup_keep
 
@@ -58,6 +59,9 @@ class Addon(AddonsMixin, MarathonAppMixin, NamespaceModel, StatusModel, MesosRes
     args = models.CharField(max_length=500, blank=True)
     m_version = models.CharField(max_length=128, blank=True, verbose_name=_('Marathon Version'))
     deployment_id = models.CharField(max_length=128, blank=True, verbose_name=_('Marathon Deployment Id'))
+    spec_hash = models.CharField(max_length=40, blank=True, verbose_name=_('Marathon Spec Hash'))
+    # when the deployment followed by `hubot.tasks.reconcile_deployments` was put, None once it's settled
+    deployed_at = models.DateTimeField(null=True, blank=True, verbose_name=_('Marathon Deployed At'))
     volume_ids = models.TextField(blank=True, verbose_name=_('OpenStack Volume Ids'))
     volume_size = models.IntegerField(validators=[validate_size], verbose_name=_('OpenStack Volume Size'))
 
@@ -83,13 +87,9 @@ class Addon(AddonsMixin, MarathonAppMixin, NamespaceModel, StatusModel, MesosRes
     def get_default_args(cls):
         return getattr(cls, "addon_default_args", "")
 
-    def check_status_after(self, seconds):
-        from hubot.tasks import check_addon_status
-        check_addon_status.apply_async(args=[self.deployment_id], countdown=seconds)
-
     def check_suspend(self):
         from hubot.tasks import check_addon_suspend
-        check_addon_suspend.apply_async(args=[self.name])
+        on_commit(check_addon_suspend.apply_async, args=[self.name])
 
     def delete_deploy(self):
         from hubot.utils.mesos import marathon
@@ -98,12 +98,12 @@ class Addon(AddonsMixin, MarathonAppMixin, NamespaceModel, StatusModel, MesosRes
         except Exception as e:
             LOG.error(str(e))
         else:
+            self.status = Addon.STATUS.Staging
             self.m_version = app['version']
             self.deployment_id = app['deploymentId']
+            self.deployed_at = now()
+            self.spec_hash = ""
             self.save()
-            from hubot.tasks import check_addon_status
-            check_addon_status.apply_async(args=[self.deployment_id],
-                                           countdown=settings.TIMEOUT_FOR_STATUS_FINISHED)
 
     def storage_volume_ids(self, volume_ids):
         if isinstance(volume_ids, list):
@@ -211,16 +211,14 @@ class Addon(AddonsMixin, MarathonAppMixin, NamespaceModel, StatusModel, MesosRes
             return True
         return False
 
-    def prepare_restore(self, snapshot):
+    def prepare_restore(self, snapshot, timeout=None):
         if self.status != Addon.STATUS.Restoring:
             self.status = Addon.STATUS.Restoring
             self.save()
         destroy_marathon_app(self, run_async=False)
-        while True:
-            attach = self.check_volume_attach()
-            if attach:
-                continue
-            break
+        timeout = settings.TIMEOUT_FOR_STATUS_FINISHED if timeout is None else timeout
+        if not cinder_policy.poll(lambda: not self.check_volume_attach(), timeout):
+            return False
         return self.rename_volume(str(snapshot.short_id))
 
     def check_volume_ids(self, coverage=False):
@@ -238,18 +236,18 @@ class Addon(AddonsMixin, MarathonAppMixin, NamespaceModel, StatusModel, MesosRes
             self.save()
         return False
 
-    def reset(self):
+    def reset(self, timeout=None):
         addon = self.real_addon
         if addon.status != Addon.STATUS.Resetting:
             addon.status = Addon.STATUS.Resetting
             addon.save()
         addon.check_volume_ids(coverage=True)
         suspend_marathon_app(addon, run_async=False)
-        while True:
-            if not addon.check_volume_status():
-                time.sleep(1)
-                continue
-            break
+        timeout = settings.TIMEOUT_FOR_STATUS_FINISHED if timeout is None else timeout
+        if not cinder_policy.poll(addon.check_volume_status, timeout):
+            addon.status = Addon.STATUS.Failed
+            addon.save()
+            return
         delete_volume = addon.delete_volume()
         if not delete_volume:
             addon.rename_volume()
@@ -257,7 +255,7 @@ class Addon(AddonsMixin, MarathonAppMixin, NamespaceModel, StatusModel, MesosRes
             addon.volume_ids = ""
             addon.save()
         from addons.tasks import create_volume_and_release
-        create_volume_and_release.apply_async(args=[addon, True])
+        on_commit(create_volume_and_release.apply_async, args=[addon, True])
 
     def save(self, *args, **kwargs):
         if not self.color:
@@ -315,7 +313,21 @@ class Addon(AddonsMixin, MarathonAppMixin, NamespaceModel, StatusModel, MesosRes
 
     @property
     def real_addon(self):
-        return getattr(self, "addon" + self.slug)
+        if type(self) is not Addon and self.slug == self.addon_name:
+            return self
+
+        identity = current_identity_map()
+        real = identity.get(Addon, self.pk) if identity is not None else None
+        if real is None:
+            # no query when the subclass came with ``select_real_addons``
+            real = getattr(self, "addon" + self.slug)
+            depend_cache = Addon._meta.get_field("depend").get_cache_name()
+            if hasattr(self, depend_cache) and not hasattr(real, depend_cache):
+                depend = getattr(self, depend_cache)
+                setattr(real, depend_cache, depend.real_addon if depend is not None else None)
+            if identity is not None:
+                identity.add(real)
+        return real
 
     def get_random_name(self):
         return "{0}-{1}".format(get_random_string(4, allowed_chars=string.lowercase), random.choice(CHINESE_ZODIAC))
@@ -334,6 +346,18 @@ class Addon(AddonsMixin, MarathonAppMixin, NamespaceModel, StatusModel, MesosRes
             ProjectAddon.objects.filter(addon=self).delete()
 
 
+def select_real_addons(queryset, prefix="", depend=True):
+    """
+    Joins every addon subclass (and the ones of ``depend``) so ``real_addon`` resolves without another query.
+
+    :param str prefix: path to the addon in a queryset of another model, eg. ``"addon__"``
+    """
+    related = ["addon" + name for name in ADDONS_REGISTRY]
+    if depend:
+        related += ["depend"] + ["depend__" + name for name in related]
+    return queryset.select_related(*[prefix + name for name in related])
+
+
 @python_2_unicode_compatible
 class AddonSnapshot(TimeStampedModel, models.Model):
 
@@ -351,7 +375,7 @@ class AddonSnapshot(TimeStampedModel, models.Model):
     def __str__(self):
         return "{0}-snapshot-s{1}".format(self.addon, self.created)
 
-    def restore(self, snapshot_ids=None, run_async=True):
+    def restore(self, snapshot_ids=None, run_async=True, timeout=None):
         cinder = get_cinder()
         addon = self.addon.real_addon
         snapshot_ids = snapshot_ids if snapshot_ids else self.snapshot_ids
@@ -360,20 +384,21 @@ class AddonSnapshot(TimeStampedModel, models.Model):
         success_ids = []
         for snapshot_id in snapshot_ids:
             try:
-                snapshot = cinder.volume_snapshots.get(snapshot_id)
+                snapshot = cinder_policy.call(cinder.volume_snapshots.get, snapshot_id)
                 name = snapshot.name.split("-snapshot-s")[0]
-                volume = cinder.volumes.create(addon.volume_size, name=name, snapshot_id=snapshot_id)
+                volume = cinder_policy.call(cinder.volumes.create, addon.volume_size, name=name,
+                                            snapshot_id=snapshot_id)
                 volume_ids.append(volume.id)
                 success_ids.append(snapshot_id)
             except Exception as e:
                 LOG.error(str(e))
 
         if not run_async:
-            while True:
-                if not addon.check_volume_status(volume_ids=",".join(volume_ids)):
-                    time.sleep(1)
-                    continue
-                break
+            timeout = settings.TIMEOUT_FOR_STATUS_FINISHED if timeout is None else timeout
+            if not cinder_policy.poll(lambda: addon.check_volume_status(volume_ids=",".join(volume_ids)), timeout):
+                addon.status = Addon.STATUS.Failed
+                addon.save()
+                return False
         if len(snapshot_ids) == len(volume_ids):
             if self.volume_ids:
                 self.volume_ids = str(self.volume_ids) + "," + str(addon.volume_ids)
@@ -383,20 +408,14 @@ class AddonSnapshot(TimeStampedModel, models.Model):
             addon.volume_ids = ",".join(volume_ids)
             addon.save()
 
-            retries = 5
-            while retries:
-                try:
-                    create_or_update_marathon_app(addon)
-                except MarathonHttpError as e:
-                    retries -= 1
-                    LOG.error(str(e))
-                    time.sleep(1)
-                    continue
-                else:
-                    return True
-            addon.status = Addon.STATUS.Failed
-            addon.save()
-            return False
+            try:
+                marathon_policy.run(create_or_update_marathon_app, addon)
+            except (MarathonError, CircuitOpenError) as e:
+                LOG.error(str(e))
+                addon.status = Addon.STATUS.Failed
+                addon.save()
+                return False
+            return True
         lost_ids = list(set(snapshot_ids) - set(success_ids))
         return ",".join(lost_ids)
 
@@ -7,11 +7,13 @@ import pytz
 from celery import shared_task
 from hubot.celery import app
 from django.conf import settings
-from marathon import MarathonHttpError
-from addons.models import Addon
+from marathon import MarathonError
+from addons.models import Addon, select_real_addons
 from addons.utils import get_cinder
 from celery_once import QueueOnce
+from hubot.utils.identity import identity_scoped, current_identity_map
 from hubot.utils.mesos import create_or_update_marathon_app
+from hubot.utils.retry import CircuitOpenError, cinder_policy, marathon_policy
 
 logger = logging.getLogger('hubot')
 
@@ -29,37 +31,34 @@ def recover_volumes(addon):
 
 
 @shared_task(ignore_result=True)
-def create_volume_and_release(real_addon, enqueue=False, retries=5, timeout=300):
-    start = time.time()
-
+@identity_scoped
+def create_volume_and_release(real_addon, enqueue=False, retries=5, timeout=300, delay=None):
     if real_addon.get_plugin_volumes():
 
-        while True:
-            now = time.time()
+        def volume_created():
             real_addon.create_volume()
-            if now - start >= timeout:
-                real_addon.status = Addon.STATUS.Failed
-                real_addon.save()
-                return
-            if not real_addon.check_volume_status():
-                time.sleep(10)
-                continue
-            break
+            return real_addon.check_volume_status()
+
+        if not cinder_policy.poll(volume_created, timeout):
+            real_addon.status = Addon.STATUS.Failed
+            real_addon.save()
+            return
 
     try:
-        create_or_update_marathon_app(real_addon)
-    except MarathonHttpError as e:
-        if enqueue and retries:
-            create_volume_and_release.apply_async(args=[real_addon, enqueue, retries - 1],
-                                                  countdown=settings.TIMEOUT_FOR_STATUS_FINISHED)
-        else:
-            if enqueue and retries == 0:
-                real_addon.status = Addon.STATUS.Failed
-                real_addon.save()
-            logger.error(str(e))
+        marathon_policy.call(create_or_update_marathon_app, real_addon)
+    except (MarathonError, CircuitOpenError) as e:
+        logger.error(str(e))
+        if enqueue and marathon_policy.should_retry(e, retries):
+            delay = marathon_policy.backoff(delay, e)
+            create_volume_and_release.apply_async(args=[real_addon, enqueue, retries - 1, timeout, delay],
+                                                  countdown=delay)
+        elif enqueue:
+            real_addon.status = Addon.STATUS.Failed
+            real_addon.save()
 
 
 @shared_task(ignore_result=True)
+@identity_scoped
 def do_reset(real_addon):
     try:
         real_addon.reset()
@@ -68,7 +67,9 @@ def do_reset(real_addon):
 
 
 @shared_task(ignore_result=True)
+@identity_scoped
 def restore_addon_snapshot(real_addon, snapshot, timeout=300):
+    current_identity_map().add(real_addon)
     start = time.time()
     while True:
         now = time.time()
@@ -76,24 +77,25 @@ def restore_addon_snapshot(real_addon, snapshot, timeout=300):
             real_addon.status = Addon.STATUS.Failed
             real_addon.save()
             return
-        if not real_addon.prepare_restore(snapshot):
+        if not real_addon.prepare_restore(snapshot, timeout=timeout - (now - start)):
             continue
 
-        output = snapshot.restore(run_async=False)
+        output = snapshot.restore(run_async=False, timeout=timeout - (time.time() - start))
         while isinstance(output, list):
             now = time.time()
             if now - start >= timeout:
                 real_addon.status = Addon.STATUS.Failed
                 real_addon.save()
                 return
-            output = snapshot.restore(output, run_async=False)
+            output = snapshot.restore(output, run_async=False, timeout=timeout - (now - start))
             continue
         return
 
 
 @app.task
+@identity_scoped
 def create_snapshot_task():
-    for addon in Addon.objects.filter(backup_enable=True):
+    for addon in select_real_addons(Addon.objects.filter(backup_enable=True)):
         addon = addon.real_addon
         if addon.has_snapshot_support():
             tzinfo = pytz.timezone(addon.user.tzinfo) if addon.user.tzinfo else pytz.timezone(settings.CELERY_TIMEZONE)
@@ -104,6 +106,7 @@ def create_snapshot_task():
 
 
 @shared_task(ignore_result=True, base=QueueOnce, once={'graceful': True, 'unlock_before_run': True})
+@identity_scoped
 def create_snapshot(real_addon):
     description = "auto backup"
     try:
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 from django.test import TestCase
-from addons.factories import AddonMySQLFactory, AddonRabbitmqFactory, AddonMemcachedFactory
+from addons.factories import AddonMySQLFactory, AddonRabbitmqFactory, AddonMemcachedFactory, AddonInfluxdbFactory, \
+    AddonStatsdFactory
+from addons.models import Addon, AddonInfluxdb, AddonStatsd, select_real_addons
+from hubot.utils.identity import identity_map
 
 
 class AddonMySQLTest(TestCase):
@@ -40,3 +43,30 @@ class SnapshotTest(TestCase):
 
         addon = AddonMemcachedFactory()
         self.assertFalse(addon.has_snapshot_support())
+
+
+class RealAddonTest(TestCase):
+
+    def test_real_addon_in_one_query(self):
+        influxdb = AddonInfluxdbFactory()
+        AddonStatsdFactory(name="statsd", depend=influxdb)
+
+        with self.assertNumQueries(1):
+            addon = select_real_addons(Addon.objects.all()).get(name="statsd").real_addon
+            self.assertIsInstance(addon, AddonStatsd)
+            self.assertIsInstance(addon.depend.real_addon, AddonInfluxdb)
+            self.assertEqual(addon.depend.real_addon.db_password, influxdb.db_password)
+        self.assertIs(addon.real_addon, addon)
+
+    def test_identity_map(self):
+        addon = AddonMySQLFactory()
+
+        with identity_map():
+            first = Addon.objects.get(id=addon.id).real_addon
+            first.cpus = 4
+            with self.assertNumQueries(1):
+                second = Addon.objects.get(id=addon.id).real_addon
+            self.assertIs(first, second)
+            self.assertEqual(second.cpus, 4)
+
+        self.assertIsNot(Addon.objects.get(id=addon.id).real_addon, first)
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from cinderclient import client
 from django.conf import settings
+from hubot.utils.metrics import timed
 
 
 class AddonNotFound(Exception):
@@ -52,4 +53,6 @@ def get_support_addons():
 def get_cinder():
     cinder = client.Client('2', settings.OS_USER_NAME, settings.OS_PASSWORD,
                            settings.OS_TENANT_NAME, settings.OS_AUTH_URL)
+    # the managers and the resources they return all send their requests through it
+    cinder.client.request = timed("cinder", cinder.client.request)
     return cinder
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+from django.contrib import admin
+
+from api.models import Job
+
+
+class JobAdmin(admin.ModelAdmin):
+    model = Job
+    list_filter = ('status', 'action')
+    list_display = ('id', 'user', 'action', 'target', 'status', 'created', 'modified')
+    search_fields = ('user__username', 'action', 'target', 'task_id')
+
+
+admin.site.register(Job, JobAdmin)
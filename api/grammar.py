@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Precompiled docopt grammars for the chat commands.
+
+``docopt()`` re-tokenizes the usage docstring and rebuilds the pattern tree on
+every call. The usage of a command class never changes, so the tree is built
+once when the class is defined and only the argv is parsed per request.
+"""
+from docopt import AnyOptions, Dict, DocoptExit, Option, TokenStream, extras, formal_usage, parse_argv, \
+    parse_defaults, parse_pattern, printable_usage
+
+
+GRAMMAR_REGISTRY = {
+
+}
+
+
+class Grammar(object):
+
+    def __init__(self, doc, options_first=False):
+        self.doc = doc
+        self.options_first = options_first
+        self.usage = printable_usage(doc)
+        self.options = parse_defaults(doc)
+        self.pattern = parse_pattern(formal_usage(self.usage), self.options)
+
+        pattern_options = set(self.pattern.flat(Option))
+        for ao in self.pattern.flat(AnyOptions):
+            ao.children = list(set(parse_defaults(doc)) - pattern_options)
+
+        self.pattern.fix()
+        self.leaves = self.pattern.flat()
+
+    @property
+    def names(self):
+        return [leaf.name for leaf in self.leaves]
+
+    def parse(self, argv, help=True, version=None):
+        """
+        Same contract as ``docopt(doc, argv, help, version, options_first)``.
+        """
+        DocoptExit.usage = self.usage
+        argv = parse_argv(TokenStream(argv, DocoptExit), list(self.options), self.options_first)
+        extras(help, version, argv, self.doc)
+
+        matched, left, collected = self.pattern.match(argv)
+        if matched and left == []:
+            # list defaults live on the shared pattern tree, never hand them out
+            return Dict((a.name, list(a.value) if isinstance(a.value, list) else a.value)
+                        for a in self.leaves + collected)
+        raise DocoptExit()
+
+
+def compile_grammar(cls):
+    grammar = Grammar(cls.__doc__, options_first=getattr(cls, 'options_first', False))
+    GRAMMAR_REGISTRY[cls] = grammar
+    return grammar
+
+
+def get_grammar(cls):
+    """
+    :rtype: `api.grammar.Grammar`
+    """
+    grammar = GRAMMAR_REGISTRY.get(cls)
+    if grammar is None:
+        grammar = compile_grammar(cls)
+    return grammar
+
+
+class GrammarMeta(type):
+    """
+    Compiles the usage docstring of every class that has one at import time.
+    """
+
+    def __init__(cls, name, bases, attrs):
+        super(GrammarMeta, cls).__init__(name, bases, attrs)
+        if attrs.get('__doc__'):
+            compile_grammar(cls)
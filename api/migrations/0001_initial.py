@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+from django.conf import settings
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, verbose_name='created', editable=False)),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, verbose_name='modified', editable=False)),
+                ('status', model_utils.fields.StatusField(default=b'Pending', max_length=100, verbose_name='status', no_check_for_status=True, choices=[(b'Pending', '\u6392\u961f\u4e2d'), (b'Running', '\u6267\u884c\u4e2d'), (b'Finished', '\u5df2\u5b8c\u6210'), (b'Failed', '\u6267\u884c\u5931\u8d25')])),
+                ('status_changed', model_utils.fields.MonitorField(default=django.utils.timezone.now, verbose_name='status changed', monitor='status')),
+                ('action', models.CharField(max_length=64, verbose_name='Action')),
+                ('target', models.CharField(max_length=128, verbose_name='Target')),
+                ('object_id', models.CharField(max_length=64)),
+                ('task_id', models.CharField(max_length=255, blank=True)),
+                ('message', models.TextField(blank=True)),
+                ('user', models.ForeignKey(related_name='jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ('-created',),
+                'verbose_name': 'Job',
+            },
+        ),
+    ]
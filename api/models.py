@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.db import models
+from django.utils.encoding import python_2_unicode_compatible
+from django.utils.translation import ugettext_lazy as _
+from model_utils import Choices
+from model_utils.models import TimeStampedModel, StatusModel
+
+
+@python_2_unicode_compatible
+class Job(StatusModel, TimeStampedModel, models.Model):
+    """
+    A slow chat command (one that waits on Marathon) queued to a celery worker.
+    """
+
+    STATUS = Choices(
+        ('Pending', _(u'排队中')),
+        ('Running', _(u'执行中')),
+        ('Finished', _(u'已完成')),
+        ('Failed', _(u'执行失败'))
+    )
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='jobs')
+    action = models.CharField(max_length=64, verbose_name=_(u"Action"))
+    target = models.CharField(max_length=128, verbose_name=_(u"Target"))
+    object_id = models.CharField(max_length=64)
+    task_id = models.CharField(max_length=255, blank=True)
+    message = models.TextField(blank=True)
+
+    class Meta:
+        verbose_name = _(u"Job")
+        ordering = ('-created',)
+
+    def __str__(self):
+        return u"#{0} {1} {2}".format(self.id, self.action, self.target)
+
+    def mark(self, status, message=u""):
+        self.status = status
+        self.message = message
+        self.save()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import logging
+from celery import shared_task
+from addons.models import Addon, select_real_addons
+from api.models import Job
+from hubot.utils.identity import identity_scoped
+from hubot.utils.mesos import create_or_update_marathon_app, destroy_marathon_app
+from hubot.utils.transactions import on_commit
+from projects.tasks import release_deploy
+
+
+logger = logging.getLogger('hubot')
+
+
+JOB_HANDLERS = {
+
+}
+
+
+def job_handler(action):
+    def decorator(func):
+        JOB_HANDLERS[action] = func
+        return func
+    return decorator
+
+
+@job_handler('addons.scale')
+def addon_scale(job):
+    addon = select_real_addons(Addon.objects.all()).get(id=job.object_id).real_addon
+    if addon.depend:
+        create_or_update_marathon_app(addon.depend.real_addon)
+    create_or_update_marathon_app(addon)
+    return u"Addon {0} scale to cpus {1} mem {2}".format(addon.name, addon.cpus, addon.mem)
+
+
+@job_handler('addons.destroy')
+def addon_destroy(job):
+    addon = Addon.objects.all_with_deleted().get(id=job.object_id)
+    destroy_marathon_app(addon)
+    return u"Addon {0} destroyed".format(addon.name)
+
+
+@job_handler('projects.scale')
+def project_scale(job):
+    if release_deploy(int(job.object_id), enqueue=True) is False:
+        return u"Project {0} is unchanged, nothing to redeploy".format(job.target)
+    return u"Project {0} scaled".format(job.target)
+
+
+def enqueue_job(user, action, obj, target):
+    """
+    :rtype: `api.models.Job`
+    """
+    job = Job.objects.create(user=user, action=action, target=target, object_id=str(obj.pk))
+
+    def enqueue():
+        result = run_job.apply_async(args=[job.id])
+        Job.objects.filter(id=job.id).update(task_id=result.id or "")
+
+    on_commit(enqueue)
+    return job
+
+
+@shared_task(ignore_result=True)
+@identity_scoped
+def run_job(job_id):
+    try:
+        job = Job.objects.get(id=job_id)
+    except Job.DoesNotExist:
+        logger.error("Job #{0} does not exist".format(job_id))
+        return
+
+    if job.status != Job.STATUS.Pending:
+        return
+
+    job.mark(Job.STATUS.Running)
+    try:
+        message = JOB_HANDLERS[job.action](job)
+    except Exception as e:
+        logger.error(str(e))
+        job.mark(Job.STATUS.Failed, unicode(e))
+    else:
+        job.mark(Job.STATUS.Finished, message or u"")
@@ -3,15 +3,19 @@
 :copyright: (c) 2015 by the xxxxx Team, see AUTHORS for more details.
 :license: BSD, see LICENSE for more details.
 """
+from django.db import DatabaseError
 from django.test import TestCase
+from rest_framework.test import APIClient
 import mock
 from accounts.factories import CustomUserFactory
 from addons.factories import AddonFactory, AddonMySQLFactory, AddonPostgresqlFactory, AddonMemcachedFactory, \
     AddonRedisFactory, AddonMongodbFactory, AddonRabbitmqFactory, AddonInfluxdbFactory, AddonStatsdFactory
 from addons.models import AddonMySQL, Addon, AddonSnapshot
-from api.views.execute import AddonsCmd, ProjectsCmd, ConfigCmd, ReleasesCmd, xxxxxCmd, SnapshotsCmd
+from api.models import Job
+from api.tasks import run_job
+from api.views.execute import AddonsCmd, ProjectsCmd, ConfigCmd, ReleasesCmd, xxxxxCmd, SnapshotsCmd, JobsCmd
 from projects.factories import ProjectFactory, ProjectConfigFactory, ProjectReleaseFactory
-from projects.models import Project, ProjectBuild
+from projects.models import Project, ProjectBuild, ProjectConfig, ProjectRelease
 
 
 @mock.patch("api.views.execute.create_volume_and_release", mock.MagicMock(return_value=None))
@@ -233,6 +237,99 @@ class AddonsCmdTest(TestCase):
         rc, out, err = cmd.run(u'scale addon -c 1o -m ')
         self.assertEqual(rc, cmd.ERROR)
 
+    def test_addons_list(self):
+        user = CustomUserFactory()
+        cmd = AddonsCmd(user)
+        demo = ProjectFactory(user=user, name="demo")
+        test = ProjectFactory(user=user, name="test")
+        ProjectFactory(user=user, name="test1")
+
+        AddonMySQLFactory(user=user, name="both").attach(demo)
+        Addon.objects.get(name="both").attach(test)
+        AddonRedisFactory(user=user, name="single").attach(test)
+        AddonRedisFactory(user=user, name="alone")
+
+        rc, out, err = cmd.run(u"list")
+        self.assertEqual(rc, cmd.OK)
+        lines = out.splitlines()[2:]
+        self.assertEqual([line.split() for line in lines], [
+            ["alone", "Staging", "redis"],
+            ["both", "Staging", "mysql", "demo,test"],
+            ["single", "Staging", "redis", "test"],
+        ])
+
+        rc, out, err = cmd.run(u"list -p test")
+        self.assertEqual(rc, cmd.OK)
+        self.assertEqual([line.split()[0] for line in out.splitlines()[2:]], ["both", "single"])
+
+        rc, out, err = cmd.run(u"list -p test1")
+        self.assertEqual(rc, cmd.OK)
+        self.assertEqual(out.splitlines()[2:], [])
+
+        rc, out, err = cmd.run(u"list -p notfound")
+        self.assertEqual(rc, cmd.ERROR)
+
+    def test_addons_list_query_count(self):
+        user = CustomUserFactory()
+        cmd = AddonsCmd(user)
+        project = ProjectFactory(user=user, name="demo")
+        AddonMySQLFactory(user=user).attach(project)
+
+        with self.assertNumQueries(1):
+            cmd.run(u"list")
+        with self.assertNumQueries(2):
+            cmd.run(u"list -p demo")
+
+        for addon in AddonRedisFactory.create_batch(10, user=user):
+            addon.attach(project)
+            addon.attach(ProjectFactory(user=user))
+
+        with self.assertNumQueries(1):
+            rc, out, err = cmd.run(u"list")
+        self.assertEqual(len(out.splitlines()), 2 + 11)
+        with self.assertNumQueries(2):
+            rc, out, err = cmd.run(u"list -p demo")
+        self.assertEqual(len(out.splitlines()), 2 + 11)
+
+    def test_addons_options_validation(self):
+        user = CustomUserFactory()
+        ProjectFactory(user=user, name="demo")
+        cmd = AddonsCmd(user)
+
+        rc, out, err = cmd.run(u"create mysql -p demo --state sideways")
+        self.assertEqual(rc, cmd.ERROR)
+        self.assertEqual(err, 'Option --state should be used "up" or "down".')
+
+        rc, out, err = cmd.run(u"info Addon")
+        self.assertEqual(rc, cmd.ERROR)
+        self.assertIn("Name only can be used", err)
+
+        rc, out, err = cmd.run(u"list --limit 1000")
+        self.assertEqual(rc, cmd.ERROR)
+
+        with mock.patch.object(AddonsCmd, "validate", side_effect=AddonsCmd.validate, autospec=True) as validate:
+            rc, out, err = cmd.run(u"create mysql -p demo -c 2 -m 1024 --backup-hour 3")
+        self.assertEqual(rc, cmd.OK)
+        self.assertEqual(validate.call_count, 1)
+
+    def test_addons_list_pages(self):
+        user = CustomUserFactory()
+        project = ProjectFactory(user=user, name="demo")
+        for name in ["a1", "a2", "a3"]:
+            addon = AddonRedisFactory(user=user, name=name)
+            addon.attach(project)
+            addon.attach(ProjectFactory(user=user))
+        cmd = AddonsCmd(user)
+
+        rc, out, err = cmd.run(u"list --limit 2")
+        self.assertEqual(rc, cmd.OK)
+        self.assertEqual([line.split()[0] for line in out.splitlines()[2:4]], ["a1", "a2"])
+        self.assertIn(u"--after=a2", out)
+
+        rc, out, err = cmd.run(u"list --limit 2 --after a2 -p demo")
+        self.assertEqual(rc, cmd.OK)
+        self.assertEqual([line.split()[0] for line in out.splitlines()[2:]], ["a3"])
+
     def test_addons_service(self):
         user = CustomUserFactory()
         cmd = AddonsCmd(user)
@@ -423,8 +520,10 @@ class ProjectCmdTest(TestCase):
         rc, out, err = cmd.run(u"create bar --cpus 2 --mem 2048 --instances 10")
         self.assertEqual(rc, cmd.ERROR)
 
+        # '--cpu' is an unambiguous prefix of '--cpus'
         rc, out, err = cmd.run(u"create new --cpu 2 --mem 2048 -i 10")
-        self.assertEqual(rc, cmd.ERROR)
+        self.assertEqual(rc, cmd.OK)
+        self.assertEqual(Project.objects.get(name="new").cpus, 2)
 
     def test_project_destroy(self):
         user = CustomUserFactory()
@@ -669,6 +768,52 @@ class ConfigCmdTest(TestCase):
         rc, out, err = cmd.run(u"unset -p {0} chinese".format(self.project.name))
         self.assertEqual(rc, cmd.ERROR)
 
+    def test_config_set_bulk(self):
+        cmd = ConfigCmd(self.user)
+        ProjectConfigFactory(project=self.project, key="KEEP", value="same")
+        ProjectConfigFactory(project=self.project, key="CHANGE", value="old")
+
+        def set_configs(count, change):
+            kvs = " ".join(u"key{0}=value{0}".format(i) for i in range(count))
+            with self.assertNumQueries(6):
+                rc, out, err = cmd.run(u"set -p {0} keep=same change={1} {2}".format(self.project.name, change, kvs))
+            self.assertEqual(rc, cmd.OK)
+
+        set_configs(5, "new")
+        set_configs(40, "newer")
+        configs = self.project.get_configs()
+        self.assertEqual(len(configs), 42)
+        self.assertEqual(configs["KEEP"], "same")
+        self.assertEqual(configs["CHANGE"], "newer")
+        self.assertEqual(configs["KEY39"], "value39")
+
+        rc, out, err = cmd.run(u"set -p {0} key={1}".format(self.project.name, "x" * 1001))
+        self.assertEqual(rc, cmd.ERROR)
+
+    @mock.patch("api.views.execute.release_deploy")
+    def test_config_apply(self, release_deploy):
+        cmd = ConfigCmd(self.user)
+
+        rc, out, err = cmd.run(u"set -p {0} a=1 b=2 --apply".format(self.project.name))
+        self.assertEqual(rc, cmd.OK)
+        self.assertIn("no running release", out)
+        self.assertFalse(release_deploy.called)
+
+        release = ProjectReleaseFactory(build__project=self.project, status=ProjectRelease.STATUS.Running)
+        rc, out, err = cmd.run(u"set -p {0} a=2 b=3 c=4 --apply".format(self.project.name))
+        self.assertEqual(rc, cmd.OK)
+        release_deploy.assert_called_once_with(release.id, enqueue=True)
+
+        release_deploy.reset_mock()
+        rc, out, err = cmd.run(u"unset -p {0} a b --apply".format(self.project.name))
+        self.assertEqual(rc, cmd.OK)
+        release_deploy.assert_called_once_with(release.id, enqueue=True)
+        self.assertEqual(self.project.get_configs().keys(), ["C"])
+
+        rc, out, err = cmd.run(u"unset -p {0} c notfound".format(self.project.name))
+        self.assertEqual(rc, cmd.ERROR)
+        self.assertEqual(self.project.get_configs().keys(), ["C"])
+
     def test_config_get(self):
         cmd = ConfigCmd(self.user)
 
@@ -742,6 +887,27 @@ class ReleasesCmdTest(TestCase):
         rc, out, err = cmd.run(u'list')
         self.assertEqual(rc, cmd.ERROR)
 
+    def test_releases_list_pages(self):
+        cmd = ReleasesCmd(self.user)
+        releases = ProjectReleaseFactory.create_batch(5, build__project=self.project)
+
+        with self.assertNumQueries(2):
+            rc, out, err = cmd.run(u'list -p {0} --limit 2'.format(self.project.name))
+        self.assertEqual(rc, cmd.OK)
+        self.assertEqual([int(line.split()[0]) for line in out.splitlines()[2:4]],
+                         [releases[4].id, releases[3].id])
+        self.assertIn(u"--after={0}".format(releases[3].id), out)
+
+        rc, out, err = cmd.run(u'list -p {0} --limit 2 --after {1}'.format(self.project.name, releases[1].id))
+        self.assertEqual(rc, cmd.OK)
+        self.assertEqual([int(line.split()[0]) for line in out.splitlines()[2:]], [releases[0].id])
+        self.assertNotIn(u"--after", out)
+
+        rc, out, err = cmd.run(u'list -p {0} --after notfound'.format(self.project.name))
+        self.assertEqual(rc, cmd.ERROR)
+        rc, out, err = cmd.run(u'list -p {0} --limit 0'.format(self.project.name))
+        self.assertEqual(rc, cmd.ERROR)
+
     def test_releases_create_build(self):
         user = CustomUserFactory()
         project = ProjectFactory(user=user)
@@ -842,6 +1008,22 @@ class SnapshotsCmdTest(TestCase):
         self.assertEqual(rc, cmd.OK)
 
 
+    def test_snapshots_list_pages(self):
+        user = CustomUserFactory()
+        addon = AddonMySQLFactory(user=user)
+        for short_id in range(1, 6):
+            AddonSnapshot.objects.create(addon=addon, short_id=short_id)
+        cmd = SnapshotsCmd(user)
+
+        rc, out, err = cmd.run(u"list -a {0} --limit 3".format(addon.name))
+        self.assertEqual(rc, cmd.OK)
+        self.assertEqual([line.split()[0] for line in out.splitlines()[2:5]], ["5", "4", "3"])
+        self.assertIn(u"--after=3", out)
+
+        rc, out, err = cmd.run(u"list -a {0} --limit 3 --after 3".format(addon.name))
+        self.assertEqual(rc, cmd.OK)
+        self.assertEqual([line.split()[0] for line in out.splitlines()[2:]], ["2", "1"])
+
 @mock.patch("addons.models.get_cinder", mock.MagicMock(return_value=None))
 @mock.patch("projects.tasks.check_build_status", mock.MagicMock(return_value=None))
 @mock.patch("projects.models.build_code_to_docker", mock.MagicMock(return_value=(True, "Task_id")))
@@ -1304,3 +1486,181 @@ class xxxxxCmdTest(TestCase):
         self.assertEqual(rc, cmd.OK)
         project = Project.objects.get(name="test")
         self.assertEqual(project.instances, 46)
+
+
+@mock.patch("api.tasks.run_job.apply_async", mock.MagicMock(return_value=mock.MagicMock(id="task-id")))
+@mock.patch("api.views.execute.create_volume_and_release", mock.MagicMock(return_value=None))
+@mock.patch("api.views.execute.create_or_update_marathon_app")
+@mock.patch("api.views.execute.destroy_marathon_app")
+@mock.patch("api.views.execute.release_deploy")
+class JobsCmdTest(TestCase):
+
+    def setUp(self):
+        self.user = CustomUserFactory()
+        self.project = ProjectFactory(user=self.user, name="demo")
+
+    def test_addons_scale_async(self, release_deploy, destroy_marathon_app, create_or_update_marathon_app):
+        cmd = xxxxxCmd(self.user)
+        cmd.run(u"addons create mysql -n addon -p demo")
+
+        rc, out, err = cmd.run(u"addons scale addon -c 2 --async")
+        self.assertEqual(rc, cmd.OK)
+        self.assertFalse(create_or_update_marathon_app.called)
+        job = Job.objects.get(user=self.user)
+        self.assertIn(str(job.id), out)
+        self.assertEqual(job.action, "addons.scale")
+        self.assertEqual(job.target, "addon")
+        self.assertEqual(job.status, Job.STATUS.Pending)
+        self.assertEqual(job.task_id, "task-id")
+        self.assertEqual(Addon.objects.get(name="addon").cpus, 2)
+
+        with mock.patch("api.tasks.create_or_update_marathon_app") as deploy:
+            run_job(job.id)
+            self.assertEqual(deploy.call_count, 1)
+        job = Job.objects.get(id=job.id)
+        self.assertEqual(job.status, Job.STATUS.Finished)
+
+    def test_addons_destroy_async(self, release_deploy, destroy_marathon_app, create_or_update_marathon_app):
+        cmd = xxxxxCmd(self.user)
+        cmd.run(u"addons create mysql -n addon -p demo")
+
+        rc, out, err = cmd.run(u"addons destroy addon --async")
+        self.assertEqual(rc, cmd.OK)
+        self.assertFalse(destroy_marathon_app.called)
+        self.assertFalse(Addon.objects.filter(name="addon").exists())
+
+        job = Job.objects.get(user=self.user)
+        with mock.patch("api.tasks.destroy_marathon_app", side_effect=Exception("Marathon is down")):
+            run_job(job.id)
+        job = Job.objects.get(id=job.id)
+        self.assertEqual(job.status, Job.STATUS.Failed)
+        self.assertEqual(job.message, "Marathon is down")
+
+    def test_projects_scale_async(self, release_deploy, destroy_marathon_app, create_or_update_marathon_app):
+        cmd = xxxxxCmd(self.user)
+        release = ProjectReleaseFactory(build__project=self.project, status="Running")
+
+        rc, out, err = cmd.run(u"projects scale demo -i 2 --async")
+        self.assertEqual(rc, cmd.OK)
+        self.assertFalse(release_deploy.called)
+        job = Job.objects.get(user=self.user)
+        self.assertEqual(job.object_id, str(release.id))
+
+        with mock.patch("api.tasks.release_deploy") as deploy:
+            run_job(job.id)
+            deploy.assert_called_once_with(release.id, enqueue=True)
+
+        rc, out, err = cmd.run(u"projects create --async")
+        self.assertEqual(rc, cmd.ERROR)
+
+    def test_jobs(self, release_deploy, destroy_marathon_app, create_or_update_marathon_app):
+        cmd = JobsCmd(self.user)
+        job = Job.objects.create(user=self.user, action="addons.scale", target="addon", object_id="1")
+        other = Job.objects.create(user=CustomUserFactory(), action="addons.scale", target="other", object_id="2")
+
+        rc, out, err = cmd.run(u"status {0}".format(job.id))
+        self.assertEqual(rc, cmd.OK)
+        self.assertIn(u"Pending", out)
+        self.assertIn(u"addons.scale", out)
+
+        rc, out, err = cmd.run(u"status {0}".format(other.id))
+        self.assertEqual(rc, cmd.ERROR)
+
+        rc, out, err = cmd.run(u"status foo")
+        self.assertEqual(rc, cmd.ERROR)
+
+        rc, out, err = cmd.run(u"list")
+        self.assertEqual(rc, cmd.OK)
+        self.assertIn(u"addon", out)
+        self.assertNotIn(u"other", out)
+
+
+@mock.patch("api.views.execute.release_deploy", mock.MagicMock(return_value=None))
+class RunViewTest(TestCase):
+
+    def setUp(self):
+        self.user = CustomUserFactory()
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_run_single(self):
+        response = self.client.post("/api/execute", {"cmd": u"projects create foo"}, format="json")
+        self.assertEqual(response.data["rc"], xxxxxCmd.OK)
+        self.assertEqual(response.data["cmd"], u"projects create foo")
+        self.assertTrue(Project.objects.filter(name="foo").exists())
+
+    def test_run_batch(self):
+        cmds = [u"projects create foo", u"config set -p foo a=1", u"config set -p foo b=2", u"config get -p foo b"]
+        response = self.client.post("/api/execute", {"cmds": cmds}, format="json")
+        self.assertEqual(response.data["rc"], xxxxxCmd.OK)
+        results = response.data["results"]
+        self.assertEqual([r["cmd"] for r in results], cmds)
+        self.assertEqual([r["rc"] for r in results], [xxxxxCmd.OK] * 4)
+        self.assertEqual(results[3]["stdout"], u"2")
+        self.assertEqual(ProjectConfig.objects.filter(project__name="foo").count(), 2)
+
+    def test_run_batch_stop_at_first_error(self):
+        cmds = [u"projects create foo", u"config set -p bar a=1", u"config set -p foo b=2"]
+        response = self.client.post("/api/execute", {"cmds": cmds}, format="json")
+        self.assertEqual(response.data["rc"], xxxxxCmd.ERROR)
+        results = response.data["results"]
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[1]["stderr"], u"Project 'bar' not found")
+        # the batch stopped, so it's rolled back as a whole
+        self.assertFalse(Project.objects.filter(name="foo").exists())
+        self.assertFalse(ProjectConfig.objects.exists())
+
+    @mock.patch("api.views.execute.get_spec_hash", mock.Mock(return_value="new"))
+    @mock.patch.object(ProjectRelease, "get_marathon_app", mock.Mock())
+    def test_run_batch_deploys_after_commit(self):
+        from api.views import execute
+        execute.release_deploy.reset_mock()
+        project = ProjectFactory(user=self.user, name="foo")
+        release = ProjectReleaseFactory(project=project, build__project=project, status=ProjectRelease.STATUS.Running)
+        cmds = [u"projects scale foo -c 2", u"config set -p bar a=1"]
+        response = self.client.post("/api/execute", {"cmds": cmds}, format="json")
+        self.assertEqual([r["rc"] for r in response.data["results"]], [xxxxxCmd.OK, xxxxxCmd.ERROR])
+        self.assertFalse(execute.release_deploy.called)
+        self.assertNotEqual(Project.objects.get(id=release.project_id).cpus, 2)
+
+        response = self.client.post("/api/execute", {"cmds": cmds[:1]}, format="json")
+        self.assertEqual(response.data["rc"], xxxxxCmd.OK)
+        execute.release_deploy.assert_called_once_with(release.id, enqueue=True)
+        self.assertEqual(Project.objects.get(id=release.project_id).cpus, 2)
+
+    def test_run_batch_continue_on_error(self):
+        cmds = [u"projects create foo", u"projects create foo", u"config set -p foo b=2"]
+        response = self.client.post("/api/execute", {"cmds": cmds, "continue": True}, format="json")
+        self.assertEqual(response.data["rc"], xxxxxCmd.ERROR)
+        results = response.data["results"]
+        self.assertEqual([r["rc"] for r in results], [xxxxxCmd.OK, xxxxxCmd.ERROR, xxxxxCmd.OK])
+        self.assertEqual(ProjectConfig.objects.filter(project__name="foo").count(), 1)
+
+    def test_run_batch_database_error(self):
+        cmds = [u"projects create foo", u"config set -p foo a=1", u"config set -p foo b=2"]
+        with mock.patch.object(ConfigCmd, "apply", side_effect=[DatabaseError("boom"), (ConfigCmd.OK, u"", u"")]):
+            response = self.client.post("/api/execute", {"cmds": cmds, "continue": True}, format="json")
+        results = response.data["results"]
+        self.assertEqual([r["rc"] for r in results], [xxxxxCmd.OK, xxxxxCmd.ERROR, xxxxxCmd.OK])
+        # the failing command is rolled back alone
+        self.assertEqual(list(ProjectConfig.objects.values_list("key", flat=True)), [u"B"])
+
+    @mock.patch("projects.models.build_code_to_docker", return_value=(True, "task"))
+    def test_run_batch_builds_after_commit(self, build):
+        ProjectFactory(user=self.user, name="foo")
+        cmds = [u"releases create -p foo v1", u"config set -p bar a=1"]
+        response = self.client.post("/api/execute", {"cmds": cmds}, format="json")
+        self.assertEqual([r["rc"] for r in response.data["results"]], [xxxxxCmd.OK, xxxxxCmd.ERROR])
+        self.assertFalse(build.called)
+        self.assertFalse(ProjectRelease.objects.exists())
+
+        response = self.client.post("/api/execute", {"cmds": cmds[:1]}, format="json")
+        self.assertEqual(response.data["rc"], xxxxxCmd.OK)
+        self.assertEqual(build.call_count, 1)
+        self.assertEqual(ProjectBuild.objects.get().status, ProjectBuild.STATUS.Staging)
+
+    def test_run_batch_forgets_destroyed(self):
+        cmds = [u"projects create foo", u"projects info foo", u"projects destroy foo", u"projects info foo"]
+        response = self.client.post("/api/execute", {"cmds": cmds, "continue": True}, format="json")
+        results = response.data["results"]
+        self.assertEqual([r["rc"] for r in results], [xxxxxCmd.OK, xxxxxCmd.OK, xxxxxCmd.OK, xxxxxCmd.ERROR])
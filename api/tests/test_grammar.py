@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import sys
+import time
+from django.test import SimpleTestCase
+from docopt import docopt, DocoptExit
+from api.grammar import GRAMMAR_REGISTRY
+from api.views.execute import AddonsCmd, ProjectsCmd, ConfigCmd, ReleasesCmd, xxxxxCmd, SnapshotsCmd
+
+
+# command strings taken from api/tests/test_execute.py
+COMMANDS = [
+    (AddonsCmd, "create mysql -n addon -p demo"),
+    (AddonsCmd, "create mysql -p demo --name=demo --cpus=2 --mem=1024"),
+    (AddonsCmd, "create mysql"),
+    (AddonsCmd, "attach addon -p test"),
+    (AddonsCmd, "detach addon -p test"),
+    (AddonsCmd, "destroy demo"),
+    (AddonsCmd, "info add-mysql"),
+    (AddonsCmd, "scale addon -c 8 -m 9216"),
+    (AddonsCmd, "scale addon -c 1o -m "),
+    (AddonsCmd, "services"),
+    (AddonsCmd, "list"),
+    (ProjectsCmd, "create foo -c 2 -m 2048 -i 10"),
+    (ProjectsCmd, "create bar --cpus 8 --mem 4096 --instances 2"),
+    (ProjectsCmd, "create new --cpu 2 --mem 2048 -i 10"),
+    (ProjectsCmd, "destroy demo"),
+    (ProjectsCmd, "info info"),
+    (ProjectsCmd, "scale demo -c 4 -m 1024 --instances 4"),
+    (ProjectsCmd, "scale -p demo -c 4 -m 1024 --instances 4"),
+    (ProjectsCmd, "list"),
+    (ConfigCmd, "set -p demo key=value name=test test=test chinese=chinese"),
+    (ConfigCmd, "set key=value name=test -p demo test=test chinese=chinese"),
+    (ConfigCmd, "set key value"),
+    (ConfigCmd, "unset -p demo key name"),
+    (ConfigCmd, "get -p demo key"),
+    (ConfigCmd, "list -p demo"),
+    (ReleasesCmd, "create -p demo tag"),
+    (ReleasesCmd, "create -p demo tag --force"),
+    (ReleasesCmd, "create --project demo mc9@#U@JHC@ --no-build"),
+    (ReleasesCmd, "list -p demo"),
+    (SnapshotsCmd, "create -a addon just a test for snapshot"),
+    (SnapshotsCmd, "destroy -a addon 1"),
+    (SnapshotsCmd, "list -a addon"),
+    (xxxxxCmd, "projects create foo"),
+    (xxxxxCmd, "config set -p foo key=value"),
+    (xxxxxCmd, "addons create -p foo mysql --as bar1 --name foo"),
+    (xxxxxCmd, "snapshots create -a addon test"),
+    (xxxxxCmd, "releases create -p foo tag"),
+]
+
+
+def legacy_parse(cls, argv):
+    try:
+        return docopt(cls.__doc__, argv, options_first=cls.options_first)
+    except DocoptExit:
+        return None
+
+
+def compiled_parse(cls, argv):
+    try:
+        return GRAMMAR_REGISTRY[cls].parse(argv)
+    except DocoptExit:
+        return None
+
+
+class GrammarTest(SimpleTestCase):
+
+    def test_registry(self):
+        for cls in [AddonsCmd, ProjectsCmd, ConfigCmd, ReleasesCmd, xxxxxCmd, SnapshotsCmd]:
+            self.assertIn(cls, GRAMMAR_REGISTRY)
+            self.assertIs(cls(None).grammar, GRAMMAR_REGISTRY[cls])
+
+    def test_same_result_as_docopt(self):
+        for cls, argv in COMMANDS:
+            self.assertEqual(compiled_parse(cls, argv), legacy_parse(cls, argv), argv)
+
+    def test_parse_is_repeatable(self):
+        cls, argv = ConfigCmd, "set -p demo a=1 b=2"
+        first = compiled_parse(cls, argv)
+        first["<key=value>"].append("c=3")
+        self.assertEqual(compiled_parse(cls, argv)["<key=value>"], ["a=1", "b=2"])
+        self.assertEqual(compiled_parse(cls, "set -p demo d=4")["<key=value>"], ["d=4"])
+
+    def test_benchmark(self):
+        rounds = 20
+
+        def rate(parse):
+            start = time.time()
+            for _ in range(rounds):
+                for cls, argv in COMMANDS:
+                    parse(cls, argv)
+            return rounds * len(COMMANDS) / (time.time() - start)
+
+        before = rate(legacy_parse)
+        after = rate(compiled_parse)
+        sys.stderr.write("\ndocopt: {0:.0f} commands/s, precompiled grammar: {1:.0f} commands/s ... ".format(
+                         before, after))
+        self.assertGreater(after, before)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from django.test import TestCase
+from django.test.utils import override_settings
+from redis.exceptions import ConnectionError
+import mock
+from accounts.factories import CustomUserFactory
+from api.throttling import get_rate, throttle, Throttled
+from api.views.execute import ProjectsCmd, xxxxxCmd
+from projects.factories import ProjectFactory
+
+
+RATES = {
+    'default': '30/m',
+    'ProjectsCmd': '10/m',
+    'vip': '100/m',
+    'vip:ProjectsCmd': '50/m',
+}
+
+
+@override_settings(COMMAND_THROTTLE_RATES=RATES)
+class ThrottlingTest(TestCase):
+
+    def test_get_rate(self):
+        user = CustomUserFactory()
+        vip = CustomUserFactory(username="vip")
+
+        self.assertEqual(get_rate(user, "ProjectsCmd"), "10/m")
+        self.assertEqual(get_rate(user, "AddonsCmd"), "30/m")
+        self.assertEqual(get_rate(vip, "ProjectsCmd"), "50/m")
+        self.assertEqual(get_rate(vip, "AddonsCmd"), "100/m")
+        with self.settings(COMMAND_THROTTLE_RATES={}):
+            self.assertIsNone(get_rate(user, "AddonsCmd"))
+
+    @mock.patch("api.throttling.take_token_script")
+    def test_throttle(self, script):
+        user = CustomUserFactory()
+
+        script.return_value = "0"
+        throttle(user, "ProjectsCmd")
+        script.assert_called_once_with(keys=[u"throttle:ProjectsCmd:{0}".format(user.id)],
+                                       args=[10, 10.0 / 60, mock.ANY])
+
+        script.return_value = "2.5"
+        with self.assertRaises(Throttled) as cm:
+            throttle(user, "ProjectsCmd")
+        self.assertIn("retry after 3 seconds", unicode(cm.exception))
+
+        script.side_effect = ConnectionError()
+        throttle(user, "ProjectsCmd")
+
+    @mock.patch("api.throttling.take_token_script", return_value="0")
+    def test_user_rate_shared_by_commands(self, script):
+        vip = CustomUserFactory(username="vip")
+
+        throttle(vip, "AddonsCmd")
+        throttle(vip, "ConfigCmd")
+        throttle(vip, "ProjectsCmd")
+        keys = [call[1]["keys"][0] for call in script.call_args_list]
+        self.assertEqual(keys, [u"throttle:{0}".format(vip.id)] * 2 + [u"throttle:ProjectsCmd:{0}".format(vip.id)])
+
+    @mock.patch("api.throttling.take_token_script", mock.MagicMock(return_value="6"))
+    @mock.patch("api.views.execute.release_deploy")
+    def test_throttled_command(self, release_deploy):
+        user = CustomUserFactory()
+        ProjectFactory(user=user, name="demo")
+        cmd = xxxxxCmd(user)
+
+        rc, out, err = cmd.run(u"projects scale demo -c 2")
+        self.assertEqual(rc, cmd.ERROR)
+        self.assertIn("retry after 7 seconds", err)
+        self.assertFalse(release_deploy.called)
+
+        rc, out, err = ProjectsCmd(user).run(u"info demo")
+        self.assertEqual(rc, cmd.OK)
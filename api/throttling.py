@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Token buckets in front of the commands that change marathon apps.
+
+Every (user, command class) pair owns a bucket of ``<tokens>/<period>`` from
+``settings.COMMAND_THROTTLE_RATES``, refilled continuously, except for a rate
+given to ``<username>`` alone: all the commands of the user share its bucket. The bucket lives in
+redis so all the web workers share it, and is updated by one lua script so two
+requests can't take the same token.
+"""
+import time
+import logging
+
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from api.utils import client
+
+
+logger = logging.getLogger('hubot')
+
+
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+local tokens = tonumber(bucket[1]) or capacity
+local timestamp = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - timestamp) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'timestamp', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+take_token_script = client.register_script(TOKEN_BUCKET_SCRIPT)
+
+
+class Throttled(Exception):
+
+    def __init__(self, wait):
+        self.wait = wait
+        super(Throttled, self).__init__(
+            u"Too many commands, please retry after {0} seconds".format(int(wait) + 1))
+
+
+def parse_rate(rate):
+    """
+    '10/m' -> (10, 60), same format as the rest framework throttle rates.
+    """
+    num, period = rate.split('/')
+    return int(num), {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[period[0]]
+
+
+def get_bucket(user, name):
+    """
+    ``(bucket key, rate)`` of the most specific of '<username>:<command>', '<username>', '<command>' and 'default',
+    ``(None, None)`` to not throttle.
+    """
+    rates = settings.COMMAND_THROTTLE_RATES
+    command_bucket = u"throttle:{0}:{1}".format(name, user.id)
+    for key, bucket in [(u"{0}:{1}".format(user.username, name), command_bucket),
+                        (user.username, u"throttle:{0}".format(user.id)),
+                        (name, command_bucket),
+                        ('default', command_bucket)]:
+        if key in rates:
+            return bucket, rates[key]
+    return None, None
+
+
+def get_rate(user, name):
+    return get_bucket(user, name)[1]
+
+
+def take_token(key, tokens, duration):
+    """
+    Returns the seconds to wait before a token is available, 0 when one was taken.
+    """
+    try:
+        return float(take_token_script(keys=[key], args=[tokens, float(tokens) / duration, time.time()]))
+    except RedisError as e:
+        # never lock users out because redis is away
+        logger.error(str(e))
+        return 0
+
+
+def throttle(user, name):
+    """
+    Takes a token of the bucket of ``user`` for the command ``name``, raises `Throttled` when it's empty.
+    """
+    bucket, rate = get_bucket(user, name)
+    if not rate:
+        return
+
+    tokens, duration = parse_rate(rate)
+    wait = take_token(bucket, tokens, duration)
+    if wait > 0:
+        raise Throttled(wait)
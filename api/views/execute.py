@@ -1,20 +1,31 @@
 # -*- coding: utf-8 -*-
-import re
 import logging
+from collections import OrderedDict
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Q, Value, When
+from django.utils.timezone import now
 from django.db.utils import IntegrityError
-from docopt import docopt, DocoptExit
+from docopt import DocoptExit
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from tabulate import tabulate
-from schema import Schema, And, Or, Use, SchemaError
-from addons.models import Addon, AddonSnapshot
+from schema import Schema, And, Optional, Or, Use, SchemaError
+from addons.models import Addon, AddonSnapshot, select_real_addons
 from addons.tasks import create_volume_and_release, restore_addon_snapshot, do_reset
 from addons.utils import addons_create, AddonNotFound, get_support_addons
+from api.grammar import GrammarMeta, get_grammar
+from api.models import Job
+from api.tasks import enqueue_job
+from api.throttling import throttle, Throttled
 from api.utils import string_to_bool
-from hubot.utils.mesos import destroy_marathon_app, create_or_update_marathon_app, get_image_fullname
+from hubot.models import NAME_RE, NUMBER_RE
+from hubot.utils.identity import identity_map, current_identity_map
+from hubot.utils.metrics import command_timing, current_timing
+from hubot.utils.mesos import destroy_marathon_app, create_or_update_marathon_app, get_image_fullname, \
+    get_spec_hash
+from hubot.utils.transactions import atomic, on_commit
 from projects.models import ProjectConfig, Project, ProjectRelease, ProjectAddon, ProjectBuild
-from projects.serializers import ProjectConfigSerializer
 from projects.tasks import release_deploy
 
 
@@ -30,27 +41,78 @@ MIN_SIZE = settings.MIN_SIZE
 MAX_SIZE = settings.MAX_SIZE
 MIN_BACKUP_KEEP = settings.MIN_BACKUP_KEEP
 MAX_BACKUP_KEEP = settings.MAX_BACKUP_KEEP
+MAX_PAGE_SIZE = settings.REST_FRAMEWORK['MAX_PAGE_SIZE']
+
+
+NAME_ERROR = 'only can be used with lowercase letters, numbers, hyphens and initial with letter'
+
+# options of every command, validated in one pass by `Cmd.run`
+OPTIONS_SCHEMA = Schema({
+    Optional('--instances'): Or(None, And(Use(int), lambda n: MIN_INSTANCES < n),
+                                error='--instances=<instances> should be int {0} < instances'.format(MIN_INSTANCES)),
+    Optional('--mem'): Or(None, And(Use(float), lambda n: MIN_MEM < n <= MAX_MEM),
+                          error='--mem=<mem> should be float {0} < mem <= {1}'.format(MIN_MEM, MAX_MEM)),
+    Optional('--cpus'): Or(None, And(Use(float), lambda n: MIN_CPUS < n <= MAX_CPUS),
+                           error='--cpus=<cpus> should be float {0} < cpus <= {1}'.format(MIN_CPUS, MAX_CPUS)),
+    Optional('--size'): Or(None, And(Use(int), lambda n: MIN_SIZE < n <= MAX_SIZE),
+                           error='--size=<size> should be integer {0} < size <= {1}'.format(MIN_SIZE, MAX_SIZE)),
+    Optional('--backup-hour'): Or(None, And(Use(int), lambda n: 0 <= n <= 23),
+                                  error='--backup-hour=<backup-hour> should be integer 0 <= backup-hour <= 23'),
+    Optional('--backup-minute'): Or(None, And(Use(int), lambda n: 0 <= n <= 59),
+                                    error='--backup-minute=<backup-minute> should be integer 0 <= backup-minute <= 59'),
+    Optional('--backup-keep'): Or(None, And(Use(int), lambda n: MIN_BACKUP_KEEP < n <= MAX_BACKUP_KEEP),
+                                  error='Option --backup-keep should be integer {0} < backup-keep <= {1}'.format(
+                                      MIN_BACKUP_KEEP, MAX_BACKUP_KEEP)),
+    Optional('--state'): Or(None, 'up', 'down', error='Option --state should be used "up" or "down".'),
+    Optional('--limit'): Or(None, And(Use(int), lambda n: 0 < n <= MAX_PAGE_SIZE),
+                            error='--limit=<limit> should be integer 0 < limit <= {0}'.format(MAX_PAGE_SIZE)),
+    Optional('--name'): Or(None, NAME_RE.match, error='Name ' + NAME_ERROR),
+    Optional('<name>'): Or(None, NAME_RE.match, error='Name ' + NAME_ERROR),
+    Optional('--addon'): Or(None, NAME_RE.match, error='"--addon" ' + NAME_ERROR),
+    Optional('<snapshot>'): Or(None, NUMBER_RE.match, error='"<snapshot>" must be used with numbers, eg: 1, 2, 3...'),
+    object: object,
+})
 
 
 class Cmd(object):
 
+    __metaclass__ = GrammarMeta
+
     OK = 0
     ERROR = 1
 
     actions = []
+    # actions that change marathon apps, they take a token of `api.throttling`
+    throttled_actions = []
+    options_first = False
 
     def __init__(self, user):
         self.user = user
         self.args = None
 
+    @property
+    def name(self):
+        return type(self).__name__[:-len("Cmd")].lower()
+
     def usage(self):
         return self.__doc__
 
     def get_actions(self):
         return self.actions
 
+    @property
+    def grammar(self):
+        return get_grammar(type(self))
+
     def parse_arguments(self, argv):
-        return docopt(self.usage(), argv)
+        return self.grammar.parse(argv)
+
+    def is_throttled(self, action):
+        return action in self.throttled_actions
+
+    def validate(self, schema, data):
+        with current_timing().phase("validate"):
+            return schema.validate(data)
 
     def error(self, msg=None):
         return self.ERROR, self.usage(), msg or u""
@@ -58,41 +120,62 @@ class Cmd(object):
     def success(self, msg=None):
         return self.OK, msg or u"Success", u""
 
+    def queued(self, action, obj, target):
+        job = enqueue_job(self.user, action, obj, target)
+        return self.success(u"Job {0} queued, use 'xxxxx jobs status {0}' to follow it".format(job.id))
+
     def run(self, argv):
-        # hack for bug fix
-        if isinstance(argv, unicode):
-            argv = argv.encode("utf-8")
-        elif isinstance(argv, list):
-            argv = list(v.encode("utf-8") for v in argv)
+        with command_timing(self.name) as timing:
+            # hack for bug fix
+            if isinstance(argv, unicode):
+                argv = argv.encode("utf-8")
+            elif isinstance(argv, list):
+                argv = list(v.encode("utf-8") for v in argv)
 
-        try:
-            args = self.parse_arguments(argv)
-        except DocoptExit:
-            return self.error()
+            try:
+                with timing.phase("parse"):
+                    args = self.parse_arguments(argv)
+            except DocoptExit:
+                return self.error()
 
-        # hack for bug fix
-        for key, value in args.items():
-            if isinstance(value, str):
-                args[key] = value.decode("utf-8")
-            elif isinstance(value, list):
-                args[key] = list(v.decode("utf-8") for v in value)
+            # hack for bug fix
+            for key, value in args.items():
+                if isinstance(value, str):
+                    args[key] = value.decode("utf-8")
+                elif isinstance(value, list):
+                    args[key] = list(v.decode("utf-8") for v in value)
 
-        self.args = args
+            self.args = args
 
-        try:
-            return self._run(args)
-        except Exception as e:
-            return self.error(str(e))
+            try:
+                self.validate(OPTIONS_SCHEMA, args)
+            except SchemaError as e:
+                return self.error(str(e))
+
+            with identity_map():
+                try:
+                    return self._run(args)
+                except Exception as e:
+                    return self.error(str(e))
 
     def _run(self, args):
         action = None
         for key in self.get_actions():
             if args.get(key, False):
                 action = getattr(self, key, None)
+                name = key
 
         if not action:
             return self.error()
 
+        current_timing().command = u"{0} {1}".format(self.name, name)
+
+        if self.is_throttled(name):
+            try:
+                throttle(self.user, type(self).__name__)
+            except Throttled as e:
+                return self.ERROR, u"", unicode(e)
+
         return action(args)
 
     def get_project(self):
@@ -100,20 +183,48 @@ class Cmd(object):
         :rtype: `projects.models.Project`
         """
         project_name = self.args.get('--project') or self.args.get('<project>')
+        identity = current_identity_map()
+        project = identity.lookup(Project, user_id=self.user.id, name=project_name)
+        if project is not None:
+            return project
         try:
             project = Project.objects.get(user=self.user, name=project_name)
         except Project.DoesNotExist:
             raise Exception(u"Project '{0}' not found".format(project_name))
 
-        return project
+        return identity.add(project, user_id=self.user.id, name=project_name)
 
     def get_addon(self):
+        """
+        :rtype: `addons.models.Addon` subclass, ``real_addon`` is the addon itself
+        """
         name = self.args.get('--addon') or self.args.get('<name>')
+        identity = current_identity_map()
+        addon = identity.lookup(Addon, user_id=self.user.id, name=name)
+        if addon is not None:
+            return addon
         try:
-            addon = Addon.objects.get(user=self.user, name=name)
+            addon = select_real_addons(Addon.objects.filter(user=self.user)).get(name=name)
         except Addon.DoesNotExist:
             raise Exception(u"Addon '{0}' not found".format(name))
-        return addon
+
+        return identity.add(addon.real_addon, user_id=self.user.id, name=name)
+
+    def forget(self, obj):
+        current_identity_map().forget(obj)
+
+    def get_limit(self):
+        return int(self.args['--limit'])
+
+    def page(self, table, headers, limit, cursor):
+        """
+        Renders the first ``limit`` rows of ``table``, which is fetched with one more row to tell
+        whether there is a next page. ``cursor`` maps a row to the value of its '--after'.
+        """
+        out = tabulate(table[:limit], headers=headers, tablefmt="simple")
+        if len(table) > limit:
+            out += u"\n\nMore rows, use '--after={0}' to see the next page".format(cursor(table[limit - 1]))
+        return self.success(out)
 
 
 class SnapshotsCmd(Cmd):
@@ -124,30 +235,19 @@ class SnapshotsCmd(Cmd):
       snapshots create -a <addon> [<description>...]
       snapshots destroy <snapshot> -a <addon>
       snapshots restore <snapshot> -a <addon>
-      snapshots list -a <addon>
+      snapshots list -a <addon> [--limit=<limit>] [--after=<snapshot>]
 
     Options:
       -h, --help                          Show this screen.
       -a <addon>, --addon=<addon>         Addon's name
+      --limit=<limit>                     Rows per page [default: 20]
+      --after=<snapshot>                  Start the page after this snapshot
     """
 
     actions = ['create', 'destroy', 'restore', 'list']
-
-    def get_schema(self):
-        schema = Schema({
-            '--addon': Or(None, lambda n: re.search(r"[a-zA-Z][a-zA-Z0-9\-]*", n).group() == n,
-                          error='"--addon" only can be used with numbers, letters, hyphens and initial with letter'),
-            '<snapshot>': Or(None, lambda n: re.search(r"^[1-9][0-9]*$", n),
-                             error='"<snapshot>" must be used with numbers, eg: 1, 2, 3...'),
-        })
-        return schema
+    throttled_actions = ['restore']
 
     def get_real_addon(self, args):
-        schema = self.get_schema()
-        try:
-            schema.validate({"--addon": args["--addon"], "<snapshot>": args["<snapshot>"]})
-        except SchemaError as e:
-            return self.error(str(e))
         addon = self.get_addon().real_addon
         if not addon.has_snapshot_support():
             return self.error("Addon type of '{0}' don't have operate for snapshots".format(addon.addon_name))
@@ -190,23 +290,27 @@ class SnapshotsCmd(Cmd):
         except AddonSnapshot.DoesNotExist as e:
             return self.error(str(e))
         try:
-            restore_addon_snapshot.apply_async(args=[addon, snapshot])
+            on_commit(restore_addon_snapshot.apply_async, args=[addon, snapshot])
         except Exception as e:
             return self.error(str(e))
         return self.success()
 
     def list(self, args):
+        limit = self.get_limit()
         addon = self.get_addon()
-        snapshots = addon.snapshots.all()
+        snapshots = AddonSnapshot.objects.filter(addon=addon).order_by("-short_id")
+        if args["--after"]:
+            try:
+                snapshots = snapshots.filter(short_id__lt=int(args["--after"]))
+            except ValueError:
+                return self.error('"--after" must be used with numbers, eg: 1, 2, 3...')
 
         headers = ["Snapshot", "Create", "Description"]
         table = []
-        for snapshot in snapshots:
+        for snapshot in snapshots[:limit + 1]:
             table.append([snapshot.short_id, self.user.get_time_display(snapshot.created), snapshot.description])
 
-        out = tabulate(table, headers=headers, tablefmt="simple")
-
-        return self.success(out)
+        return self.page(table, headers, limit, lambda row: row[0])
 
 
 class AddonsCmd(Cmd):
@@ -215,13 +319,13 @@ class AddonsCmd(Cmd):
 
     Usage:
       addons create <service> --project=<project> [options]
-      addons scale <name> [options]
-      addons destroy <name>
+      addons scale <name> [options] [--async]
+      addons destroy <name> [--async]
       addons info <name>
       addons reset <name>
       addons attach <name> --project=<project> [options]
       addons detach <name> --project=<project>
-      addons list [--project=<project>]
+      addons list [--project=<project>] [--limit=<limit>] [--after=<name>]
       addons services
 
     Options:
@@ -237,43 +341,15 @@ class AddonsCmd(Cmd):
       --backup-minute=<backup-minute>                   Minute in the day to auto create snapshot task, default=0
       --backup-keep=<backup-keep>                       Addon's Snapshots number to keep, default=7
       --backup-enable                                   Execute task to enable create snapshot everyday
+      --async                                           Return a job id at once and apply the change in background
+      --limit=<limit>                                   Rows per page [default: 20]
+      --after=<name>                                    Start the page after this addon
     """
 
     actions = ['attach', 'create', 'detach', 'destroy', 'info', 'list', 'services', 'scale', 'reset']
-
-    def get_schema(self):
-        schema = Schema({
-            '--mem': Or(None, And(Use(float), lambda n: MIN_MEM < n <= MAX_MEM),
-                        error='--mem=<mem> should be float {0} < mem <= {1}'.format(MIN_MEM, MAX_MEM)),
-            '--cpus': Or(None, And(Use(float), lambda n: MIN_CPUS < n <= MAX_CPUS),
-                         error='--cpus=<cpus> should be float {0} < cpus <= {1}'.format(MIN_CPUS, MAX_CPUS)),
-            '--name': Or(None, lambda n: re.search(r"[a-zA-Z][a-zA-Z0-9\-]*", n).group() == n,
-                         error='Name only can be used with numbers, letters, hyphens and initial with letter'),
-            '--size': Or(None, And(Use(int), lambda n: MIN_SIZE < n <= MAX_SIZE),
-                         error='--size=<size> should be integer {0} < size <= {1}'.format(MIN_SIZE, MAX_SIZE)),
-            '--backup-hour': Or(None, And(Use(int), lambda n: 0 <= n <= 23),
-                                error='--backup-hour=<backup-hour> should be integer 0 <= backup-hour <= 23'),
-            '--backup-minute': Or(None, And(Use(int), lambda n: 0 <= n <= 59),
-                                  error='--backup-minute=<backup-minute> should be integer 0 <= backup-minute <= 59'),
-            '--state': Or(None, And(Use(lambda n: n in ["up", "down"])),
-                          error='Option --state should be used "up" or "down".'),
-            '--backup-keep': Or(None, And(Use(int), lambda n: MIN_BACKUP_KEEP < n <= MAX_BACKUP_KEEP),
-                                error='Option --backup-keep should be integer {0} < backup-keep <= {1}'.format(
-                                    MIN_BACKUP_KEEP, MAX_BACKUP_KEEP)),
-
-        })
-        return schema
+    throttled_actions = ['create', 'destroy', 'scale', 'reset']
 
     def scale(self, args):
-        schema = self.get_schema()
-        try:
-            schema.validate({"--cpus": args["--cpus"], "--mem": args["--mem"], "--name": args["--name"],
-                             "--size": args['--size'], "--backup-hour": args["--backup-hour"],
-                             "--backup-minute": args["--backup-minute"], "--backup-keep": args["--backup-keep"],
-                             "--state": args["--state"]})
-        except SchemaError as e:
-            return self.error(str(e))
-
         addon = self.get_addon()
 
         changed = False
@@ -284,16 +360,20 @@ class AddonsCmd(Cmd):
         if changed:
             addon.save()
 
+        if args['--async']:
+            return self.queued('addons.scale', addon, addon.name)
+
         if addon.depend:
-            create_or_update_marathon_app(addon.depend.real_addon)
-        create_or_update_marathon_app(addon.real_addon)
+            on_commit(create_or_update_marathon_app, addon.depend.real_addon)
+        on_commit(create_or_update_marathon_app, addon.real_addon)
         return self.success(u"Addon {0} scale to cpus {1} mem {2}".format(addon.name, addon.cpus, addon.mem))
 
     def attach(self, args):
         addon = self.get_addon()
         project = self.get_project()
         try:
-            addon.attach(project, alias=args['--as'] if args['--as'] else '')
+            with transaction.atomic():
+                addon.attach(project, alias=args['--as'] if args['--as'] else '')
         except IntegrityError:
             return self.error(u"Addon '{0}' is already attach to Project '{1}'".format(addon.name, project.name))
         except Exception as e:
@@ -307,15 +387,6 @@ class AddonsCmd(Cmd):
         return self.success()
 
     def create(self, args):
-        schema = self.get_schema()
-        try:
-            schema.validate({"--cpus": args["--cpus"], "--mem": args["--mem"], "--name": args["--name"],
-                             "--size": args["--size"], "--backup-hour": args["--backup-hour"],
-                             "--backup-minute": args["--backup-minute"], "--backup-keep": args["--backup-keep"],
-                             "--state": args["--state"]})
-        except SchemaError as e:
-            return self.error(str(e))
-
         project = self.get_project()
 
         service = args['<service>']
@@ -331,10 +402,11 @@ class AddonsCmd(Cmd):
 
         if args['--state'] == 'up':
             if addon.depend:
-                create_volume_and_release.apply_async(args=[addon.depend.real_addon, True])
-            create_volume_and_release.apply_async(args=[addon, True])
+                on_commit(create_volume_and_release.apply_async, args=[addon.depend.real_addon, True])
+            on_commit(create_volume_and_release.apply_async, args=[addon, True])
         try:
-            addon.attach(project, alias=args['--as'] if args['--as'] else '')
+            with transaction.atomic():
+                addon.attach(project, alias=args['--as'] if args['--as'] else '')
         except IntegrityError:
             return self.error(u"Addon '{0}' is already attach to Project '{1}'".format(addon.name, project.name))
         except Exception as e:
@@ -345,7 +417,7 @@ class AddonsCmd(Cmd):
     def reset(self, args):
         addon = self.get_addon().real_addon
         try:
-            do_reset.apply_async(args=[addon])
+            on_commit(do_reset.apply_async, args=[addon])
         except Exception as e:
             return self.error(str(e))
         return self.success(u"Addon {0} reset success".format(addon.name))
@@ -355,7 +427,10 @@ class AddonsCmd(Cmd):
 
         addon.detach()
         addon.delete()
-        destroy_marathon_app(addon)
+        self.forget(addon)
+        if args['--async']:
+            return self.queued('addons.destroy', addon, addon.name)
+        on_commit(destroy_marathon_app, addon)
 
         return self.success(u"Addon {0} destroyed".format(addon.name))
 
@@ -376,24 +451,30 @@ class AddonsCmd(Cmd):
         return self.success(out)
 
     def list(self, args):
+        limit = self.get_limit()
         addons = Addon.objects.filter(user=self.user)
+        if args["--project"]:
+            project = self.get_project()
+            addons = addons.filter(id__in=ProjectAddon.objects.filter(project=project).values("addon_id"))
+        if args["--after"]:
+            addons = addons.filter(name__gt=args["--after"])
 
-        headers = ["Name", "Status", "Service", "Project"]
+        # one row per attached project, in attach order
+        rows = addons.values_list("id", "name", "status", "slug", "projectaddon__project__name").order_by(
+            "name", "id", "projectaddon__modified", "projectaddon__created")
 
-        project = self.get_project() if args["--project"] else None
-        table = []
-        for addon in addons:
-            pa = ProjectAddon.objects.filter(addon=addon)
-            name = ",".join(pa.values_list("project__name",
-                                           flat=True)) if pa.count() > 1 else pa[0].project.name if pa else ""
-            if project and name.find(project.name) < 0:
-                continue
-            table.append([addon.name, addon.status, addon.slug, name])
+        headers = ["Name", "Status", "Service", "Project"]
 
-        table.sort()
-        out = tabulate(table, headers=headers, tablefmt="simple")
+        table = OrderedDict()
+        for addon_id, name, status, slug, project_name in rows.iterator():
+            if addon_id not in table and len(table) > limit:
+                break
+            row = table.setdefault(addon_id, [name, status, slug, []])
+            if project_name:
+                row[3].append(project_name)
 
-        return self.success(out)
+        table = [[name, status, slug, ",".join(projects)] for name, status, slug, projects in table.values()]
+        return self.page(table, headers, limit, lambda row: row[0])
 
     def services(self, args):
         table = [["Slug", "Default Version"]]
@@ -413,7 +494,7 @@ class ProjectsCmd(Cmd):
       projects create [<name>] [options]
       projects destroy <project>
       projects info <project>
-      projects scale <project> [options]
+      projects scale <project> [options] [--async]
       projects list
 
     Options:
@@ -429,6 +510,7 @@ class ProjectsCmd(Cmd):
       --redirect-https=<redirect-https>                 Redirect HTTP traffic to HTTPS, write 'true' to enable
       --use-hsts=<use-hsts>                             HSTS response header for HTTP clients, write 'true' to enable
       --use-lb=<use-lb>                                 Project's marathon-lb, write 'false' to disable
+      --async                                           Return a job id at once and redeploy in background
 
     Overview of health_check:
       a request for the '/'(slash) URI is made to each server in the upstream group every 5 seconds (the default).
@@ -437,19 +519,7 @@ class ProjectsCmd(Cmd):
     """
 
     actions = ['create', 'destroy', 'info', 'scale', 'list']
-
-    def get_schema(self):
-        schema = Schema({
-            '--instances': Or(None, And(Use(int), lambda n: MIN_INSTANCES < n),
-                        error='--instances=<instances> should be int {0} < instances'.format(MIN_INSTANCES)),
-            '--mem': Or(None, And(Use(float), lambda n: MIN_MEM < n <= MAX_MEM),
-                        error='--mem=<mem> should be float {0} < mem <= {1}'.format(MIN_MEM, MAX_MEM)),
-            '--cpus': Or(None, And(Use(float), lambda n: MIN_CPUS < n <= MAX_CPUS),
-                         error='--cpus=<cpus> should be float {0} < cpus <= {1}'.format(MIN_CPUS, MAX_CPUS)),
-            '<name>': Or(None, lambda n: re.search(r"[a-zA-Z][a-zA-Z0-9\-]*", n).group() == n,
-                         error='Name only can be used with numbers, letters, hyphens and initial with letter'),
-        })
-        return schema
+    throttled_actions = ['destroy', 'scale']
 
     def get_health_check(self):
         health_check = "/"
@@ -460,21 +530,15 @@ class ProjectsCmd(Cmd):
         return health_check
 
     def create(self, args):
-        schema = self.get_schema()
-        try:
-            schema.validate({"--cpus": args["--cpus"], "--mem": args["--mem"], "<name>": args["<name>"],
-                             "--instances": args["--instances"]})
-        except SchemaError as e:
-            return self.error(str(e))
-
         health_check = self.get_health_check()
         use_lb = string_to_bool(args["--use-lb"]) if args["--use-lb"] else True
         try:
-            project = Project.objects.create(user=self.user, name=args['<name>'], health_check=health_check,
-                                             cpus=args['--cpus'] or 1, mem=args['--mem'] or 512,
-                                             instances=args['--instances'] or 1, domain=args['--domain'] or '',
-                                             git_id_rsa=args['--git-id-rsa'] or '', git_repo=args['--git-repo'] or '',
-                                             use_lb=use_lb)
+            with transaction.atomic():
+                project = Project.objects.create(user=self.user, name=args['<name>'], health_check=health_check,
+                                                 cpus=args['--cpus'] or 1, mem=args['--mem'] or 512,
+                                                 instances=args['--instances'] or 1, domain=args['--domain'] or '',
+                                                 git_id_rsa=args['--git-id-rsa'] or '',
+                                                 git_repo=args['--git-repo'] or '', use_lb=use_lb)
         except IntegrityError:
             return self.error(u"Project name '{0}' already exists".format(args['<name>']))
         except Exception as e:
@@ -488,9 +552,10 @@ class ProjectsCmd(Cmd):
 
         releases = ProjectRelease.objects.filter(project=project).order_by("-modified")
         if releases.exists():
-            destroy_marathon_app(releases[0])
+            on_commit(destroy_marathon_app, releases[0])
 
         project.delete()
+        self.forget(project)
         return self.success(u"Project '{0}' destroyed".format(project.name))
 
     def info(self, args):
@@ -512,13 +577,6 @@ class ProjectsCmd(Cmd):
         return self.success(out)
 
     def scale(self, args):
-        schema = self.get_schema()
-        try:
-            schema.validate({"--cpus": args["--cpus"], "--mem": args["--mem"], "<name>": args["<name>"],
-                             "--instances": args["--instances"]})
-        except SchemaError as e:
-            return self.error(str(e))
-
         project = self.get_project()
 
         if args["--cpus"]:
@@ -553,7 +611,13 @@ class ProjectsCmd(Cmd):
         except Exception as e:
             logger.error(str(e))
         else:
-            release_deploy(release.id, enqueue=True)
+            if args['--async']:
+                return self.queued('projects.scale', release, project.name)
+            # in a batch the deploy waits for the commit, the spec hash tells beforehand if it changes the app
+            unchanged = release.spec_hash == get_spec_hash(release.marathon_app_id, release.get_marathon_app())
+            on_commit(release_deploy, release.id, enqueue=True)
+            if unchanged:
+                return self.success("Project {0} is unchanged, nothing to redeploy".format(project.name))
 
         return self.success()
 
@@ -576,38 +640,58 @@ class ConfigCmd(Cmd):
     """xxxxx config
 
     Usage:
-      config set --project=<project> <key=value>...
+      config set --project=<project> <key=value>... [--apply]
       config get --project=<project> <key>
-      config unset --project=<project> <key>...
+      config unset --project=<project> <key>... [--apply]
       config list --project=<project>
 
     Options:
       -h, --help                          Show this screen.
       -p <project>, --project=<project>   Project name
+      --apply                             Redeploy the running release once with the new configs
     """
 
     actions = ['set', 'get', 'unset', 'list']
 
+    def is_throttled(self, action):
+        # only a redeploy reaches marathon
+        return bool(self.args.get("--apply"))
+
+    def apply(self, project):
+        if not self.args["--apply"]:
+            return self.success()
+
+        release = project.get_running_release()
+        if release is None:
+            return self.success(u"Project {0} has no running release to apply the configs".format(project.name))
+        on_commit(release_deploy, release.id, enqueue=True)
+        return self.success(u"Release {0} of project {1} redeployed".format(release.build.tag, project.name))
+
     def set(self, args):
         project = self.get_project()
 
-        kvs = args["<key=value>"]
-        for kv in kvs:
+        configs = OrderedDict()
+        for kv in args["<key=value>"]:
             try:
                 key, value = kv.split("=", 1)
-            except:
+            except ValueError:
                 return self.error(u"Key '{0}' must be format 'key=value'".format(kv))
+            configs[key.upper()] = ProjectConfig(project=project, key=key.upper(), value=value)
+            configs[key.upper()].clean_fields(exclude=["project"])
 
-            try:
-                config = ProjectConfig.objects.get(key=key.upper(), project_id=project.id)
-            except ProjectConfig.DoesNotExist:
-                config = None
-
-            data = dict(project=project.id, key=key, value=value)
-            serializer = ProjectConfigSerializer(config, data=data, partial=True if config else False)
-            serializer.is_valid(raise_exception=True)
-            serializer.save()
-        return self.success()
+        with transaction.atomic():
+            existing = dict(ProjectConfig.objects.select_for_update().filter(
+                project=project, key__in=configs.keys()).values_list("key", "value"))
+
+            ProjectConfig.objects.bulk_create([configs[k] for k in configs if k not in existing])
+
+            changed = [k for k in configs if k in existing and existing[k] != configs[k].value]
+            if changed:
+                value = Case(*[When(key=k, then=Value(configs[k].value)) for k in changed],
+                             output_field=ProjectConfig._meta.get_field("value"))
+                ProjectConfig.objects.filter(project=project, key__in=changed).update(value=value, modified=now())
+
+        return self.apply(project)
 
     def get(self, args):
         project = self.get_project()
@@ -620,16 +704,16 @@ class ConfigCmd(Cmd):
     def unset(self, args):
         project = self.get_project()
 
-        keys = args["<key>"]
-        for key in keys:
-            key = key.upper()
-            try:
-                config = ProjectConfig.objects.get(project_id=project.id, key=key)
-            except ProjectConfig.DoesNotExist:
-                return self.error(u"Config key '{0}' not found".format(key))
+        keys = [key.upper() for key in args["<key>"]]
+        with transaction.atomic():
+            configs = ProjectConfig.objects.select_for_update().filter(project=project, key__in=keys)
+            found = set(configs.values_list("key", flat=True))
+            for key in keys:
+                if key not in found:
+                    return self.error(u"Config key '{0}' not found".format(key))
+            configs.delete()
 
-            config.delete()
-        return self.success()
+        return self.apply(project)
 
     def list(self, args):
         project = self.get_project()
@@ -653,23 +737,26 @@ class ReleasesCmd(Cmd):
 
     Usage:
       releases create <tag> --project=<project> [options]
-      releases list --project=<project>
+      releases list --project=<project> [--limit=<limit>] [--after=<release>]
 
     Options:
       -h, --help                          Show this screen.
       -p <project>, --project=<project>   Project name
       -f, --force                         Force releases
       --no-build                          Don't build code
+      --limit=<limit>                     Rows per page [default: 20]
+      --after=<release>                   Start the page after this release
     """
 
     actions = ['create', 'list']
+    throttled_actions = ['create']
 
     def create(self, args):
         project = self.get_project()
         release = project.create_release(args["<tag>"])
 
         if release.build.status == ProjectBuild.STATUS.Finished or args['--no-build']:
-            release_deploy(release.id, force=args["--force"], enqueue=True)
+            on_commit(release_deploy, release.id, force=args["--force"], enqueue=True)
             return self.success("Release {0} of project {1} created".format(release.build.tag, project.name))
 
         if not project.git_repo or not (project.git_id_rsa or self.user.git_id_rsa):
@@ -677,19 +764,73 @@ class ReleasesCmd(Cmd):
                               args['--project']))
 
         image_name = get_image_fullname(release.get_container_image())
-        release.build.do_build(image_name)
+        # in a batch the build starts once the release is committed
+        on_commit(release.build.do_build, image_name)
         return self.success("Release {0} of project {1} created, please waiting for build".format(
                             release.build.tag, project.name))
 
     def list(self, args):
+        limit = self.get_limit()
         project = self.get_project()
-        releases = ProjectRelease.objects.filter(project=project).order_by("-created")[:50]
+        releases = ProjectRelease.objects.filter(project=project).select_related("build").order_by("-created", "-id")
+        if args["--after"]:
+            try:
+                after = ProjectRelease.objects.get(project=project, id=int(args["--after"]))
+            except (ValueError, ProjectRelease.DoesNotExist):
+                return self.error(u"Release '{0}' not found".format(args["--after"]))
+            releases = releases.filter(Q(created__lt=after.created) | Q(created=after.created, id__lt=after.id))
 
-        headers = ["Tag", "Create", "Status"]
+        headers = ["Release", "Tag", "Create", "Status"]
         table = []
 
-        for release in releases:
-            table.append([release.build.tag, self.user.get_time_display(release.created), release.status])
+        for release in releases[:limit + 1]:
+            table.append([release.id, release.build.tag, self.user.get_time_display(release.created), release.status])
+
+        return self.page(table, headers, limit, lambda row: row[0])
+
+
+class JobsCmd(Cmd):
+
+    """xxxxx jobs
+
+    Usage:
+      jobs status <job>
+      jobs list
+
+    Options:
+      -h, --help                          Show this screen.
+    """
+
+    actions = ['status', 'list']
+
+    def status(self, args):
+        try:
+            job = Job.objects.get(user=self.user, id=int(args["<job>"]))
+        except (ValueError, Job.DoesNotExist):
+            return self.error(u"Job '{0}' not found".format(args["<job>"]))
+
+        table = [["Job info"]]
+
+        table.append(["Job", job.id])
+        table.append(["Action", job.action])
+        table.append(["Target", job.target])
+        table.append(["Status", job.status])
+        table.append(["Create", self.user.get_time_display(job.created)])
+        table.append(["Update", self.user.get_time_display(job.modified)])
+        if job.message:
+            table.append(["Message", job.message])
+
+        out = tabulate(table, headers="firstrow", tablefmt="simple")
+
+        return self.success(out)
+
+    def list(self, args):
+        jobs = Job.objects.filter(user=self.user)[:20]
+
+        headers = ["Job", "Action", "Target", "Status", "Create"]
+        table = []
+        for job in jobs:
+            table.append([job.id, job.action, job.target, job.status, self.user.get_time_display(job.created)])
 
         out = tabulate(table, headers=headers, tablefmt="simple")
 
@@ -710,15 +851,17 @@ class xxxxxCmd(Cmd):
       snapshots    List, create or destroy snapshots
       config       List, set or unset project config
       releases     List, release project releases
+      jobs         List jobs or show the status of a job
     """
 
     program = "xxxxx"
+    options_first = True
 
     def parse_arguments(self, argv):
         if argv.startswith(self.program):
             argv = argv.replace(self.program, "", 1).strip()
 
-        return docopt(self.usage(), argv, options_first=True)
+        return self.grammar.parse(argv)
 
     def _run(self, args):
         argv = args['<args>']
@@ -739,6 +882,8 @@ class xxxxxCmd(Cmd):
             return ReleasesCmd(self.user).run(argv)
         elif command == 'snapshots':
             return SnapshotsCmd(self.user).run(argv)
+        elif command == 'jobs':
+            return JobsCmd(self.user).run(argv)
         elif command in ['help', '-h']:
             return self.success(self.usage())
         else:
@@ -752,8 +897,44 @@ class xxxxxCmd(Cmd):
         return ProjectsCmd(self.user)
 
 
+def run_batch(user, cmds, continue_on_error=False):
+    """
+    Run ``cmds`` in order, sharing the loaded projects and addons between them.
+    Stops at the first command that fails unless ``continue_on_error`` is set.
+
+    The batch runs in one transaction. A failing command is rolled back to its savepoint, so a database
+    error doesn't spoil the next commands, and the whole batch is rolled back when it stops there. The
+    marathon calls and tasks of the commands are sent once the batch is committed.
+    """
+    rc = Cmd.OK
+    results = []
+    with identity_map(), atomic():
+        for cmd in cmds:
+            cmd = cmd.strip()
+            logger.info(u"run batched cmd: {0}".format(cmd))
+            with atomic():
+                code, out, err = xxxxxCmd(user).run(cmd)
+                if code != Cmd.OK:
+                    transaction.set_rollback(True)
+                    # the objects it loaded or changed may not be in the database anymore
+                    current_identity_map().clear()
+            results.append(dict(rc=code, cmd=cmd, stdout=out, stderr=err))
+            if code != Cmd.OK:
+                rc = code
+                if not continue_on_error:
+                    transaction.set_rollback(True)
+                    break
+    return rc, results
+
+
 @api_view(['POST', 'OPTIONS'])
 def run(request):
+    cmds = request.data.get("cmds")
+    if isinstance(cmds, list):
+        continue_on_error = string_to_bool(request.data.get("continue", False))
+        rc, results = run_batch(request.user, cmds, continue_on_error=continue_on_error)
+        return Response(data=dict(rc=rc, results=results))
+
     cmd = request.data.get("cmd", "").strip()
     print 'run cmd:', cmd.encode("utf-8")
     rc, out, err = xxxxxCmd(request.user).run(cmd)
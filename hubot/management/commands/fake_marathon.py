@@ -0,0 +1,28 @@
+# -*- coding:utf-8 -*-
+from django.core.management import BaseCommand
+
+from hubot.utils.fake_marathon import FakeMarathonServer
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs an in-memory stand-in of marathon, set MARATHON_SERVERS to its url "
+        "to run the hubot, the monitor or a benchmark without a cluster."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8080)
+        parser.add_argument("--latency", type=float, default=0, help="seconds added to every request")
+        parser.add_argument("--conflict-rate", type=float, default=0, help="share of the changes refused with a 409")
+        parser.add_argument("--deployment-duration", type=float, default=1, help="seconds a deployment lasts")
+
+    def handle(self, **options):
+        server = FakeMarathonServer(options["host"], options["port"], latency=options["latency"],
+                                    conflict_rate=options["conflict_rate"],
+                                    deployment_duration=options["deployment_duration"])
+        print "Fake marathon at {0}, use MARATHON_SERVERS={0}".format(server.url)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.stop()
@@ -2,19 +2,40 @@
 import json
 import random
 import re
-import math
 import time
 import sys
+import threading
 from datetime import datetime
 from django.conf import settings
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
 from django.dispatch import receiver
+from django.utils import timezone
 import requests
 from addons.models import Addon
 from projects.models import Project, ProjectRelease
 from api.utils import client
 from hubot.signals import status_update_event, deployment_success
-from hubot.utils.mesos import marathon
+from hubot.tasks import reconcile_deployments
+from hubot.utils.event_journal import EventJournal
+from hubot.utils.event_pipeline import EventPipeline, serve_metrics
+from hubot.utils.app_state import AppMetadata
+from hubot.utils.mesos import app_states, marathon
+from hubot.utils.monitor_cluster import LeaderLease, MonitorCluster, member_identity
+from hubot.utils.status_window import StatusWindow
+from hubot.utils.waiter import publish_event
+
+
+app_metadata = AppMetadata()
+
+
+def handle_event(data):
+    app_metadata.apply_event(data)
+    app_states.apply_event(data)
+    publish_event(data)
+    if data['eventType'] == 'status_update_event':
+        status_update_event.send(sender=Command, data=data)
+    elif data['eventType'] == 'deployment_success':
+        deployment_success.send(sender=Command, data=data)
 
 
 class Command(BaseCommand):
@@ -23,41 +44,182 @@ class Command(BaseCommand):
         "(only with the database backend at the moment)."
     )
 
+    lease = None
+    response = None
+    streaming = False
+    metadata_seeded = 0
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=settings.MONITOR_WORKERS,
+                            help="threads handling the events, the events of an app go to the same thread")
+        parser.add_argument("--queue-size", type=int, default=settings.MONITOR_QUEUE_SIZE,
+                            help="events read ahead of the workers before the stream is paused")
+        parser.add_argument("--metrics-port", type=int, default=settings.MONITOR_METRICS_PORT,
+                            help="port serving the metrics of the monitor, 0 to not serve them")
+        parser.add_argument("--journal-dir", default=settings.MONITOR_JOURNAL_DIR,
+                            help="directory the events are journaled to, empty to not journal them")
+        parser.add_argument("--replay", type=int, metavar="OFFSET",
+                            help="handles the journaled events from OFFSET again, then exits")
+        parser.add_argument("--cluster", action="store_true", default=settings.MONITOR_CLUSTER,
+                            help="shares the events with the other monitors, one of them reading the stream")
+
+    def seed(self):
+        listed = marathon.list_apps(embed_tasks=True)
+        app_metadata.bootstrap(listed)
+        apps, deployments = app_states.seed(listed)
+        print "cached {0} apps and {1} deployments".format(apps, deployments)
+
+    def replay(self, journal, start, pipeline):
+        try:
+            self.seed()
+        except Exception as e:
+            print "replaying without the apps of marathon: {0}".format(e)
+        count = 0
+        started = time.time()
+        for offset, raw in journal.read(start):
+            pipeline.put(json.loads(raw))
+            count += 1
+        pipeline.stop()
+        status_window.flush()
+        elapsed = time.time() - started
+        print "replayed {0} events from offset {1} in {2:.2f}s, {3:.0f} events/s".format(
+            count, start, elapsed, count / elapsed if elapsed else 0)
+
     def handle(self, **options):
+        if options["metrics_port"]:
+            serve_metrics(options["metrics_port"])
+        pipeline = EventPipeline(handle_event, workers=options["workers"], queue_size=options["queue_size"]).start()
+        journal = None
+        if options["journal_dir"]:
+            journal = EventJournal(options["journal_dir"], segment_size=settings.MONITOR_JOURNAL_SEGMENT_SIZE,
+                                   max_segments=settings.MONITOR_JOURNAL_SEGMENTS)
+        if options["replay"] is not None:
+            if journal is None:
+                raise CommandError("--replay needs a journal directory")
+            if not journal.is_boundary(options["replay"]):
+                raise CommandError("No journaled event starts at offset {0}".format(options["replay"]))
+            return self.replay(journal, options["replay"], pipeline)
+        status_window.start()
+        thread = threading.Thread(target=self.keep_alive, name="monitor-stream")
+        thread.daemon = True
+        thread.start()
+
+        if not options["cluster"]:
+            while True:
+                self.read_stream(journal, lambda raw, data: pipeline.put(data))
+
+        identity = member_identity()
+        cluster = MonitorCluster(client, identity, partitions=settings.MONITOR_PARTITIONS,
+                                 ttl=settings.MONITOR_LEASE_TTL)
+        self.lease = LeaderLease(client, identity, ttl=settings.MONITOR_LEASE_TTL)
+        for target, args, name in [(self.coordinate, [cluster], "monitor-lease"),
+                                   (self.consume, [cluster, pipeline], "monitor-partitions")]:
+            thread = threading.Thread(target=target, args=args, name=name)
+            thread.daemon = True
+            thread.start()
+        try:
+            while True:
+                if self.lease.held():
+                    self.read_stream(journal, lambda raw, data: cluster.push(raw))
+                else:
+                    time.sleep(settings.MONITOR_LEASE_TTL / 3.0)
+        finally:
+            self.lease.release()
+            cluster.leave()
+
+    def coordinate(self, cluster):
+        """
+        Keeps the process on the ring and renews the lease, the stream is closed as soon as the lease is lost.
+        """
+        while True:
+            cluster.heartbeat()
+            if not self.lease.refresh() and self.response is not None:
+                print "lost the lease, closing the event stream"
+                self.response.close()
+            time.sleep(settings.MONITOR_LEASE_TTL / 3.0)
+
+    def keep_alive(self):
+        """
+        Tells the other processes that the state cache is kept current, as long as the stream is connected.
+        """
+        while True:
+            if self.streaming:
+                app_states.mark_alive()
+            time.sleep(max(app_states.max_age / 4.0, 1))
+
+    def load_metadata(self):
+        """
+        Takes the apps from the state cache each time the leader seeded it, without asking marathon.
+        """
+        seeded, alive = app_states.stream_state()
+        if seeded and seeded != self.metadata_seeded:
+            apps = app_states.cached_apps()
+            if apps is not None:
+                app_metadata.bootstrap(apps)
+                self.metadata_seeded = seeded
 
+    def consume(self, cluster, pipeline):
+        """
+        Handles the events of the partitions of the process.
+        """
         while True:
-            for server in settings.MARATHON_SERVERS:
-                try:
-                    url = server + "/v2/events"
-
-                    if settings.MARATHON_USERNAME and settings.MARATHON_PASSWORD:
-                        auth = (settings.MARATHON_USERNAME, settings.MARATHON_PASSWORD)
-                    else:
-                        auth = None
-                    response = requests.get(url, stream=True, auth=auth, headers={
-                                            'Cache-Control': 'no-cache', 'Accept': 'text/event-stream'})
-
-                    for line in response.iter_lines():
-                        try:
-                            if line.strip() != '':
-                                # marathon sometimes sends more than one json per event
-                                # e.g. {}\r\n{}\r\n\r\n
-                                for real_event_data in re.split(r'\r\n', line):
-                                    if real_event_data[:6] == "data: ":
-                                        data = json.loads(real_event_data[6:])
-                                        print "received event of type {0}".format(data['eventType'])
-                                        if data['eventType'] == 'status_update_event':
-                                            status_update_event.send(sender=self.__class__, data=data)
-                                        elif data['eventType'] == 'deployment_success':
-                                            deployment_success.send(sender=self.__class__, data=data)
-                            else:
-                                print "skipping empty message"
-                        except:
-                            print line
-                            print "Unexpected error:", sys.exc_info()[0]
-                except:
-                    print "Caught exception! Reconnecting..."
-                    time.sleep(random.random() * 3)
+            try:
+                self.load_metadata()
+                data = cluster.pop()
+                if data is not None:
+                    pipeline.put(data)
+            except Exception:
+                print "Unexpected error:", sys.exc_info()[0]
+                time.sleep(random.random() * 3)
+
+    def read_stream(self, journal, sink):
+        """
+        Reads the event stream of the first marathon server answering, ``sink(raw, data)`` being called per event.
+        """
+        for server in settings.MARATHON_SERVERS:
+            if self.lease is not None and not self.lease.held():
+                return
+            try:
+                url = server + "/v2/events"
+
+                if settings.MARATHON_USERNAME and settings.MARATHON_PASSWORD:
+                    auth = (settings.MARATHON_USERNAME, settings.MARATHON_PASSWORD)
+                else:
+                    auth = None
+                self.response = response = requests.get(url, stream=True, auth=auth, headers={
+                                                        'Cache-Control': 'no-cache', 'Accept': 'text/event-stream'})
+                # the events missed while disconnected are caught up by listing everything again,
+                # and the releases whose deployment ended meanwhile are moved on by the reconciler
+                self.seed()
+                reconcile_deployments.delay()
+                self.streaming = True
+
+                for line in response.iter_lines():
+                    if self.lease is not None and not self.lease.held():
+                        response.close()
+                        return
+                    try:
+                        if line.strip() != '':
+                            # marathon sometimes sends more than one json per event
+                            # e.g. {}\r\n{}\r\n\r\n
+                            for real_event_data in re.split(r'\r\n', line):
+                                if real_event_data[:6] == "data: ":
+                                    if journal is not None:
+                                        journal.append(real_event_data[6:])
+                                    data = json.loads(real_event_data[6:])
+                                    print "received event of type {0}".format(data['eventType'])
+                                    sink(real_event_data[6:], data)
+                        else:
+                            print "skipping empty message"
+                    except:
+                        print line
+                        print "Unexpected error:", sys.exc_info()[0]
+            except:
+                print "Caught exception! Reconnecting..."
+                time.sleep(random.random() * 3)
+            finally:
+                self.response = None
+                self.streaming = False
 
 
 def addon_status_update(name=None, namespace=None,
@@ -99,52 +261,52 @@ def decide_intervel_time_to_rollback(timestamp, version):
     return False
 
 
-@receiver(status_update_event, sender=Command, dispatch_uid="status_update_event")
-def status_update(sender, data, **kwargs):
-    task_status = data['taskStatus'][5:].capitalize()  # TASK_RUNNING
-    if task_status in ['Starting', 'Lost', 'Killed']:
-        return
-
-    app_id = data['appId']
+def emit_status(app_id, version, status, timestamp, labels):
     try:
         name, namespace = app_id[1:].rsplit("-", 1)  # /meimor-m-meiye
-    except:
+    except ValueError:
         return
-    timestamp = data['timestamp']
-    version = data['version']
     kw = {
         'name': name,
         'namespace': namespace,
         'version': version,
         'timestamp': timestamp,
-        'status': task_status
+        'status': status
     }
-    app = marathon.get_app(app_id)
-
-    key = app_id + ":" + version
-    client.sadd(key, timestamp)
-    count_now = client.scard(key)
-    count_calculate = int(math.ceil(settings.MINIMUM_HEALTH_CAPACITY * app.instances))
-    if app.instances > 1 and count_now < count_calculate:
-        return
-    client.expire(key, settings.TIMEOUT_FOR_STATUS_FINISHED)
-    if 'addon' in app.labels:
+    if 'addon' in labels:
         addon_status_update(**kw)
-    elif 'HAPROXY_GROUP' in app.labels and task_status == ProjectRelease.STATUS.Finished:
+    elif 'HAPROXY_GROUP' in labels and status == ProjectRelease.STATUS.Finished:
         app_status_update(**kw)
 
 
+status_window = StatusWindow(emit_status, client, settings.MINIMUM_HEALTH_CAPACITY,
+                             window=settings.MONITOR_STATUS_WINDOW, ttl=settings.TIMEOUT_FOR_STATUS_FINISHED)
+
+
+@receiver(status_update_event, sender=Command, dispatch_uid="status_update_event")
+def status_update(sender, data, **kwargs):
+    task_status = data['taskStatus'][5:].capitalize()  # TASK_RUNNING
+    if task_status in ['Starting', 'Lost', 'Killed']:
+        return
+
+    app_id = data['appId']
+    app = app_metadata.get(app_id)
+    if "-" not in app_id or app is None:
+        return
+    status_window.add(app_id, data['version'], data['taskId'], task_status, data['timestamp'], app["instances"],
+                      app["labels"])
+
+
 @receiver(deployment_success, sender=Command, dispatch_uid="deployment_success")
 def deployment_success_status_update(sender, data, **kwargs):
-    try:
-        obj = ProjectRelease.objects.get(deployment_id=data['id'])
-    except ProjectRelease.DoesNotExist:
-        try:
-            obj = Addon.objects.get(deployment_id=data['id'])
-        except Addon.DoesNotExist:
-            return
-    obj.status = ProjectRelease.STATUS.Running
-    obj.save()
-    if isinstance(obj, ProjectRelease):
-        ProjectRelease.objects.filter(project=obj.project, status=ProjectRelease.STATUS.Running).exclude(
-            id=obj.id).update(status=ProjectRelease.STATUS.Finished)
+    # a bulk deploy puts many releases and addons in one deployment
+    releases = ProjectRelease.objects.filter(deployment_id=data['id'])
+    release_ids = list(releases.values_list("id", flat=True))
+    if release_ids:
+        ProjectRelease.objects.filter(project__in=releases.values_list("project_id", flat=True),
+                                      status=ProjectRelease.STATUS.Running).exclude(id__in=release_ids).update(
+            status=ProjectRelease.STATUS.Finished, modified=timezone.now())
+        ProjectRelease.objects.filter(id__in=release_ids).update(
+            status=ProjectRelease.STATUS.Running, deployed_at=None, modified=timezone.now())
+    Addon.objects.filter(deployment_id=data['id']).update(status=Addon.STATUS.Running, deployed_at=None,
+                                                          modified=timezone.now())
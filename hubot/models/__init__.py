@@ -17,6 +17,11 @@ MAX_SIZE = settings.MAX_SIZE
 MIN_BACKUP_KEEP = settings.MIN_BACKUP_KEEP
 MAX_BACKUP_KEEP = settings.MAX_BACKUP_KEEP
 
+# shared with the validation of the chat command options
+LETTER_RE = re.compile(r"[a-z]")
+NAME_RE = re.compile(r"[a-z][a-z0-9\-]*\Z")
+NUMBER_RE = re.compile(r"[1-9][0-9]*\Z")
+
 
 def validate_size(value):
     try:
@@ -51,12 +56,9 @@ def validate_mem(value):
 def validate_name(value):
     if not value:
         raise ValidationError("Name can not be none")
-    if not re.match(r"[a-z]", value):
+    if not LETTER_RE.match(value):
         raise ValidationError("The first one of the name must be a letter, '%s' found" % value)
-    regex = re.search(r'^(?:[a-z0-9\-]*)', value)
-    if not regex:
-        raise ValidationError("Please enter a valid 'name' consisting of letters, numbers, and hyphens.")
-    if not regex.group() is value:
+    if not NAME_RE.match(value):
         raise ValidationError("Name only can be used with numbers, letters and hyphens, '%s' found" % value)
 
 
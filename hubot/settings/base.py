@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from datetime import timedelta
 from hubot.settings import root, env
 from celery.schedules import crontab
 
@@ -194,6 +195,15 @@ REST_FRAMEWORK = {
     'DATETIME_FORMAT': '%Y-%m-%d %H:%M:%S',
 }
 
+# Token buckets of the chat commands that change marathon apps, "<tokens>/<period>" like the rest framework
+# throttle rates. The most specific of "<username>:<Command>", "<username>", "<Command>" and "default" is used,
+# a "<username>" rate is shared by all the commands of the user.
+COMMAND_THROTTLE_RATES = {
+    'default': '30/m',
+    'ProjectsCmd': '10/m',
+    'AddonsCmd': '10/m',
+}
+
 CELERYBEAT_SCHEDULE = {
     # Executes addons.tasks.create_snapshot_task everyday at 0:00 A.M
     'create_snapshots-everyday-midnight': {
@@ -201,5 +211,12 @@ CELERYBEAT_SCHEDULE = {
         'schedule': crontab(hour=0, minute=0),
         'args': []
     },
+    # Moves the releases and addons being deployed to Running or Failed
+    'reconcile-deployments-every-30-seconds': {
+        'task': 'hubot.tasks.reconcile_deployments',
+        'schedule': timedelta(seconds=30),
+        'args': [],
+        'options': {'expires': 30},
+    },
 }
 CELERY_TIMEZONE = 'Asia/Shanghai'
@@ -79,6 +79,11 @@ LOGGING = {
             'handlers': ['console'],
             'propagate': False,
         },
+        'hubot.marathon.slow': {
+            'level': 'WARNING',
+            'handlers': ['console'],
+            'propagate': False,
+        },
     },
 }
 
@@ -88,6 +93,20 @@ setup_logging(handler)
 MARATHON_SERVERS = env.list('MARATHON_SERVERS')
 MARATHON_USERNAME = env('MARATHON_USERNAME')
 MARATHON_PASSWORD = env('MARATHON_PASSWORD')
+MARATHON_TIMEOUT = env.int('MARATHON_TIMEOUT', default=10)  # seconds
+MARATHON_VERIFY = env.bool('MARATHON_VERIFY', default=False)
+MARATHON_POOL_MAXSIZE = env.int('MARATHON_POOL_MAXSIZE', default=10)
+MARATHON_RETRY_AFTER = env.int('MARATHON_RETRY_AFTER', default=30)  # seconds
+MARATHON_STATE_MAX_AGE = env.int('MARATHON_STATE_MAX_AGE', default=60)  # seconds
+MARATHON_STATE_LOCAL_TTL = env.int('MARATHON_STATE_LOCAL_TTL', default=2)  # seconds
+MARATHON_WAIT_TIMEOUT = env.int('MARATHON_WAIT_TIMEOUT', default=500)  # seconds
+MARATHON_BULK_SIZE = env.int('MARATHON_BULK_SIZE', default=50)  # apps per deployment of the admin actions
+MARATHON_SLOW_CALL = env.float('MARATHON_SLOW_CALL', default=1.0)  # seconds, calls slower than this are logged
+MARATHON_SLOW_CALL_SAMPLE = env.float('MARATHON_SLOW_CALL_SAMPLE', default=0.2)  # share of the slow calls logged
+RETRY_BASE = env.int('RETRY_BASE', default=5)  # seconds, shortest pause between two attempts of a task
+RETRY_BUDGET_RATIO = env.float('RETRY_BUDGET_RATIO', default=0.2)  # retries allowed per call made to an endpoint
+CIRCUIT_BREAKER_THRESHOLD = env.int('CIRCUIT_BREAKER_THRESHOLD', default=5)  # failures in a row opening the circuit
+CIRCUIT_BREAKER_RESET_AFTER = env.int('CIRCUIT_BREAKER_RESET_AFTER', default=30)  # seconds
 
 OS_USER_NAME = env('OS_USERNAME')
 OS_PASSWORD = env('OS_PASSWORD')
@@ -108,6 +127,17 @@ MAX_BACKUP_KEEP = env.int('MAX_BACKUP_KEEP')
 
 TIMEOUT_FOR_STATUS_FINISHED = env.int('TIMEOUT_FOR_STATUS_FINISHED')  # seconds
 MINIMUM_HEALTH_CAPACITY = env.float('MINIMUM_HEALTH_CAPACITY')
+MONITOR_WORKERS = env.int('MONITOR_WORKERS', default=4)  # threads of marathon_monitor handling the events
+MONITOR_QUEUE_SIZE = env.int('MONITOR_QUEUE_SIZE', default=1000)  # events read ahead of the workers
+MONITOR_METRICS_PORT = env.int('MONITOR_METRICS_PORT', default=0)  # 0 doesn't serve the metrics of the monitor
+METRICS_ALLOWED_IPS = env.list('METRICS_ALLOWED_IPS', default=['127.0.0.1'])  # addresses /metrics is served to
+MONITOR_STATUS_WINDOW = env.int('MONITOR_STATUS_WINDOW', default=2)  # seconds the task statuses are gathered
+MONITOR_JOURNAL_DIR = env('MONITOR_JOURNAL_DIR', default='')  # empty doesn't journal the events
+MONITOR_JOURNAL_SEGMENT_SIZE = env.int('MONITOR_JOURNAL_SEGMENT_SIZE', default=64 * 1024 * 1024)  # bytes
+MONITOR_JOURNAL_SEGMENTS = env.int('MONITOR_JOURNAL_SEGMENTS', default=16)  # segments kept, the oldest are deleted
+MONITOR_CLUSTER = env.bool('MONITOR_CLUSTER', default=False)  # several monitors, one reading the stream
+MONITOR_PARTITIONS = env.int('MONITOR_PARTITIONS', default=64)  # redis lists the events are shared on
+MONITOR_LEASE_TTL = env.int('MONITOR_LEASE_TTL', default=5)  # seconds before a monitor gone away is replaced
 
 
 BUILD_CALLBACK_URI = env('BUILD_CALLBACK_URI')
@@ -28,3 +28,7 @@ PASSWORD_HASHERS = (
 # INSTALLED_APPS += ('discover_runner', )
 # TEST_RUNNER = 'discover_runner.DiscoverRunner'
 # TEST_DISCOVER_TOP_LEVEL = root('../')
+
+
+# commands are not throttled in the tests, see api.tests.test_throttling
+COMMAND_THROTTLE_RATES = {}
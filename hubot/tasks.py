@@ -1,17 +1,22 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 import logging
+from datetime import timedelta
 
-import time
 from celery import shared_task
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
 from addons.models import Addon
-from hubot.utils.mesos import marathon
+from hubot.utils.mesos import app_states, marathon, wait_app_suspended
 from projects.models import ProjectRelease
 
 
 logger = logging.getLogger("hubot")
 
 
+# check_release_status and check_addon_status are superseded by reconcile_deployments, they are kept for the tasks
+# queued before it
 @shared_task(ignore_result=True)
 def check_release_status(deployment_id):
     try:
@@ -20,7 +25,7 @@ def check_release_status(deployment_id):
         logger.error(str(e))
 
     else:
-        deployment_ids = [deployment.id for deployment in marathon.list_deployments()]
+        deployment_ids = app_states.list_deployment_ids()
         if deployment_id in deployment_ids:
             release.status = ProjectRelease.STATUS.Failed
             release.save()
@@ -40,7 +45,7 @@ def check_addon_status(deployment_id):
         logger.error(str(e))
 
     else:
-        deployment_ids = [deployment.id for deployment in marathon.list_deployments()]
+        deployment_ids = app_states.list_deployment_ids()
         if deployment_id in deployment_ids:
             addon.status = ProjectRelease.STATUS.Failed
             addon.save()
@@ -53,19 +58,12 @@ def check_addon_status(deployment_id):
 def check_release_suspend(tag, timeout=500):
     try:
         release = ProjectRelease.objects.get(build__tag=tag)
-    except Addon.DoesNotExist as e:
+    except ProjectRelease.DoesNotExist as e:
         logger.error(str(e))
     else:
-        start = time.time()
-        app = marathon.get_app(release.marathon_app_id)
-        while app.instances != 0:
-            now = time.time()
-            if now - start >= timeout:
-                release.do_rollback()
-                return
-            time.sleep(1)
-            app = marathon.get_app(release.marathon_app_id)
-            continue
+        if not wait_app_suspended(release.marathon_app_id, timeout=timeout):
+            release.do_rollback()
+            return
         release.status = ProjectRelease.STATUS.Suspend
         release.save()
 
@@ -77,15 +75,172 @@ def check_addon_suspend(name, timeout=500):
     except Addon.DoesNotExist as e:
         logger.error(str(e))
     else:
-        start = time.time()
-        app = marathon.get_app(addon.marathon_app_id)
-        while app.instances != 0:
-            now = time.time()
-            if now - start >= timeout:
-                addon.delete_deploy()
-                return
-            time.sleep(1)
-            app = marathon.get_app(addon.marathon_app_id)
-            continue
+        if not wait_app_suspended(addon.marathon_app_id, timeout=timeout):
+            addon.delete_deploy()
+            return
         addon.status = Addon.STATUS.Suspend
         addon.save()
+
+
+def app_converged(app, action):
+    """
+    True when the marathon app runs its instances on its current version only.
+    """
+    if action == "suspend":
+        return not app.tasks
+    return len(app.tasks) == app.instances and all(task.version == app.version for task in app.tasks)
+
+
+@shared_task(ignore_result=True)
+def check_deploy_batch(batch_id):
+    """
+    Moves the releases and addons of a bulk deploy to their final status.
+
+    A deployment still running is stopped without rollback, only its apps that didn't converge fail and the
+    releases among them are rolled back, on a deploy, by putting the running release of their project again.
+    """
+    from hubot.utils.deploy_batch import get_batch
+    from projects.tasks import release_deploy
+    batch = get_batch(batch_id)
+    if batch is None:
+        logger.error("Deploy batch {0} does not exist".format(batch_id))
+        return
+
+    running = set(app_states.list_deployment_ids())
+    for deployment_id in batch["deployments"]:
+        releases = list(ProjectRelease.objects.filter(deployment_id=deployment_id).select_related("project"))
+        addons = list(Addon.objects.filter(deployment_id=deployment_id))
+        stuck = []
+        if deployment_id in running:
+            try:
+                marathon.delete_deployment(deployment_id, force=True)
+            except Exception as e:
+                logger.error(str(e))
+            for obj in releases + addons:
+                try:
+                    converged = app_converged(app_states.get_app(obj.marathon_app_id, bypass=True), batch["action"])
+                except Exception as e:
+                    logger.error(str(e))
+                    converged = False
+                if not converged:
+                    stuck.append(obj)
+            ProjectRelease.objects.filter(id__in=[obj.id for obj in stuck if isinstance(obj, ProjectRelease)]).update(
+                status=ProjectRelease.STATUS.Failed, spec_hash="", deployed_at=None)
+            Addon.objects.filter(id__in=[obj.id for obj in stuck if isinstance(obj, Addon)]).update(
+                status=Addon.STATUS.Failed, spec_hash="", deployed_at=None)
+
+        release_ids = [obj.id for obj in releases if obj not in stuck]
+        addon_ids = [obj.id for obj in addons if obj not in stuck]
+        if batch["action"] == "suspend":
+            ProjectRelease.objects.filter(id__in=release_ids).update(status=ProjectRelease.STATUS.Suspend)
+            Addon.objects.filter(id__in=addon_ids).update(status=Addon.STATUS.Suspend)
+        else:
+            ProjectRelease.objects.filter(project__in=[obj.project_id for obj in releases if obj not in stuck],
+                                          status=ProjectRelease.STATUS.Running).exclude(
+                id__in=release_ids).update(status=ProjectRelease.STATUS.Finished)
+            ProjectRelease.objects.filter(id__in=release_ids).update(status=ProjectRelease.STATUS.Running,
+                                                                     deployed_at=None)
+            Addon.objects.filter(id__in=addon_ids).update(status=Addon.STATUS.Running, deployed_at=None)
+
+        for release in stuck:
+            if batch["action"] == "suspend" or not isinstance(release, ProjectRelease):
+                continue
+            previous = ProjectRelease.objects.filter(project_id=release.project_id,
+                                                     status=ProjectRelease.STATUS.Running).order_by("-modified").first()
+            if previous is not None:
+                release_deploy.delay(previous.id, force=True)
+
+
+def diff_deployments(objs, running, apps, expired):
+    """
+    Splits the releases or addons being deployed into the finished, the timed out and the lost ones.
+
+    :param set running: ids of the running deployments
+    :param dict apps: instances of the marathon apps, by app id
+    :param expired: time before which a deployment still running is timed out
+    """
+    finished, timed_out, lost = [], [], []
+    for obj in objs:
+        if obj.deployment_id in running:
+            if obj.deployed_at <= expired:
+                timed_out.append(obj)
+        elif "/" + obj.marathon_app_id.strip("/") in apps:
+            finished.append(obj)
+        else:
+            lost.append(obj)
+    return finished, timed_out, lost
+
+
+def diff_restores(addons, running, apps, expired):
+    """
+    Splits the addons in Restoring or Resetting into the restored and the stuck ones.
+
+    An addon is restored once the deployment put since it entered that status is over and its app runs again. It's
+    stuck when that deployment, or the status itself when nothing was put yet, is older than ``expired``.
+    """
+    restored, stuck = [], []
+    for addon in addons:
+        redeployed = addon.deployed_at is not None and addon.deployed_at > addon.status_changed
+        if redeployed and addon.deployment_id not in running and apps.get("/" + addon.marathon_app_id.strip("/")):
+            restored.append(addon)
+        elif (addon.deployed_at if redeployed else addon.status_changed) <= expired:
+            stuck.append(addon)
+    return restored, stuck
+
+
+@shared_task(ignore_result=True)
+def reconcile_deployments():
+    """
+    Moves the releases and addons being deployed to Running or Failed, from one listing of the deployments and apps.
+
+    The deployments followed are the ones with a ``deployed_at``: the releases and addons in Staging, and the running
+    releases a rollback was put to. A deployment still running after ``TIMEOUT_FOR_STATUS_FINISHED`` seconds fails,
+    and the release is rolled back unless it's a rollback already. The addons in Restoring or Resetting are diffed
+    with `diff_restores`.
+    """
+    # what changed during the listings is left to the next run
+    started = timezone.now()
+    try:
+        running = set(deployment.id for deployment in marathon.list_deployments())
+        apps = dict((app.id, app.instances or 0) for app in marathon.list_apps())
+    except Exception as e:
+        logger.error(str(e))
+        return
+    expired = started - timedelta(seconds=settings.TIMEOUT_FOR_STATUS_FINISHED)
+
+    releases = list(ProjectRelease.objects.filter(
+        status__in=[ProjectRelease.STATUS.Staging, ProjectRelease.STATUS.Running], deployed_at__lt=started).exclude(
+        deployment_id="").select_related("project"))
+    rollbacks = set(release.id for release in releases if release.status == ProjectRelease.STATUS.Running)
+    finished, timed_out, lost = diff_deployments(releases, running, apps, expired)
+    deployed = [release for release in finished if release.id not in rollbacks]
+    if deployed:
+        ProjectRelease.objects.filter(project__in=[release.project_id for release in deployed],
+                                      status=ProjectRelease.STATUS.Running).exclude(
+            id__in=[release.id for release in finished]).update(
+            status=ProjectRelease.STATUS.Finished, modified=timezone.now())
+    if finished:
+        ProjectRelease.objects.filter(id__in=[release.id for release in finished]).update(
+            status=ProjectRelease.STATUS.Running, deployed_at=None, modified=timezone.now())
+    if timed_out or lost:
+        ProjectRelease.objects.filter(id__in=[release.id for release in timed_out + lost]).update(
+            status=ProjectRelease.STATUS.Failed, spec_hash="", deployed_at=None, modified=timezone.now())
+    for release in timed_out:
+        # the update above cleared the spec hash already
+        release.spec_hash = ""
+        if release.id not in rollbacks:
+            release.do_rollback()
+
+    addons = list(Addon.objects.filter(
+        Q(status=Addon.STATUS.Staging, deployed_at__lt=started) & ~Q(deployment_id="") |
+        Q(status__in=[Addon.STATUS.Restoring, Addon.STATUS.Resetting], status_changed__lt=started)))
+    finished, timed_out, lost = diff_deployments(
+        [addon for addon in addons if addon.status == Addon.STATUS.Staging], running, apps, expired)
+    restored, stuck = diff_restores(
+        [addon for addon in addons if addon.status != Addon.STATUS.Staging], running, apps, expired)
+    if finished or restored:
+        Addon.objects.filter(id__in=[addon.id for addon in finished + restored]).update(
+            status=Addon.STATUS.Running, deployed_at=None, modified=timezone.now())
+    if timed_out or lost or stuck:
+        Addon.objects.filter(id__in=[addon.id for addon in timed_out + lost + stuck]).update(
+            status=Addon.STATUS.Failed, spec_hash="", deployed_at=None, modified=timezone.now())
@@ -1,9 +1,48 @@
 # -*- coding: utf-8 -*-
+import itertools
+import json
 import os
-from django.test import TestCase
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from datetime import timedelta
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+import mock
+import requests
+from marathon import MarathonApp, MarathonClient, MarathonTask
+from marathon.exceptions import MarathonError, MarathonHttpError, NotFoundError
+from marathon.models.deployment import MarathonDeployment
+from redis.exceptions import ConnectionError
 from accounts.factories import CustomUserFactory
+from addons.factories import AddonRedisFactory
+from addons.models import Addon
+from api.views.execute import xxxxxCmd
+from hubot.utils.app_state import AppMetadata, AppStateCache
+from hubot.utils.marathon_client import PooledMarathonClient
+from hubot.tasks import check_deploy_batch, reconcile_deployments
+from hubot.utils.deploy_batch import bulk_deploy
+from hubot.utils.event_journal import EventJournal
+from hubot.utils.event_pipeline import EventPipeline
+from hubot.utils.fake_marathon import FakeMarathonServer
+from hubot.utils.retry import CircuitOpenError, RetryPolicy, is_marathon_failure, is_marathon_retryable
+from hubot.utils.mesos import create_or_update_marathon_app, destroy_marathon_app, get_marathon_client
+from hubot.utils.monitor_cluster import RELEASE_SCRIPT, HashRing, LeaderLease, MonitorCluster
+from hubot.utils.waiter import publish_event, wait_for
+from hubot.utils.metrics import METRICS_REGISTRY, TimedProxy, command_phase_seconds, command_timing, \
+    marathon_request_seconds, monitor_blocked_seconds, monitor_queue_depth
+from hubot.utils.status_window import StatusWindow
+from hubot.utils.tracing import TracedMarathonClient, endpoint_template
+from hubot.utils.transactions import atomic, on_commit
 from projects.factories import ProjectFactory, ProjectVolumeFactory, ProjectReleaseFactory, ProjectBuildFactory
-from projects.models import ProjectVolume
+from projects.models import Project, ProjectRelease, ProjectVolume
 
 
 class MarathonAppMixinTest(TestCase):
@@ -37,3 +76,926 @@ class MarathonAppMixinTest(TestCase):
         self.assertIn(volume, release.container_paths)
         self.assertIn(volume.host_path, release.get_volumes()[0].host_path)
         self.assertEqual(ProjectVolume.MODE.RO, release.get_volumes()[0].mode)
+
+    @mock.patch("hubot.utils.mesos.app_states")
+    @mock.patch("hubot.utils.mesos.marathon")
+    def test_unchanged_app_is_skipped(self, marathon, app_states):
+        release = ProjectReleaseFactory(build__project=ProjectFactory(instances=1))
+        marathon.update_app.return_value = {"version": "v1", "deploymentId": "d1"}
+
+        self.assertTrue(create_or_update_marathon_app(release))
+        self.assertEqual(len(release.spec_hash), 40)
+        self.assertFalse(create_or_update_marathon_app(release))
+        self.assertEqual(marathon.update_app.call_count, 1)
+
+        self.assertTrue(create_or_update_marathon_app(release, force=True))
+        release.project.instances = 2
+        self.assertTrue(create_or_update_marathon_app(release))
+        self.assertEqual(marathon.update_app.call_count, 3)
+
+        # an app missing from marathon is created again whatever the hash
+        app_states.get_app.side_effect = NotFoundError(mock.MagicMock(status_code=404))
+        marathon.create_app.return_value = {"version": "v4", "deploymentId": "d4"}
+        self.assertTrue(create_or_update_marathon_app(release))
+        self.assertTrue(marathon.create_app.called)
+
+    @mock.patch("hubot.utils.mesos.app_states", mock.MagicMock())
+    @mock.patch("hubot.utils.mesos.marathon")
+    def test_release_put_again_after_another(self, marathon):
+        project = ProjectFactory(instances=1)
+        first = ProjectReleaseFactory(project=project, build__project=project, build__tag="a")
+        second = ProjectReleaseFactory(project=project, build__project=project, build__tag="b")
+        marathon.update_app.return_value = {"version": "v1", "deploymentId": "d1"}
+
+        # releases a, b then a again, marathon must run a at the end
+        self.assertTrue(create_or_update_marathon_app(first))
+        self.assertTrue(create_or_update_marathon_app(second))
+        first = ProjectRelease.objects.get(id=first.id)
+        self.assertEqual(first.spec_hash, "")
+        self.assertTrue(create_or_update_marathon_app(first))
+        self.assertEqual(marathon.update_app.call_count, 3)
+        self.assertEqual(ProjectRelease.objects.get(id=second.id).spec_hash, "")
+
+    @mock.patch("hubot.utils.mesos.app_states")
+    @mock.patch("hubot.utils.mesos.marathon")
+    def test_destroy_app_removed_meanwhile(self, marathon, app_states):
+        release = ProjectReleaseFactory()
+        marathon.delete_app.side_effect = NotFoundError(mock.MagicMock(status_code=404))
+
+        self.assertIsNone(destroy_marathon_app(release))
+        app_states.forget.assert_called_once_with(release.marathon_app_id)
+
+
+class MetricsTest(TestCase):
+
+    def setUp(self):
+        for metric in METRICS_REGISTRY.values():
+            metric.clear()
+
+    def test_command_phases(self):
+        client = TimedProxy(mock.Mock(get_app=lambda app_id: time.sleep(0.01)), "marathon")
+
+        with command_timing("test"):
+            client.get_app("/demo")
+            Project.objects.count()
+            # the queries are timed without the debug cursor logging them
+            self.assertFalse(connection.queries_logged)
+        client.get_app("/demo")
+
+        counts, total = command_phase_seconds.values[("test", "marathon")]
+        self.assertEqual(counts[-1], 1)
+        self.assertGreaterEqual(total, 0.01)
+        counts, total = command_phase_seconds.values[("test", "db")]
+        self.assertEqual(counts[-1], 1)
+        self.assertGreater(total, 0)
+
+    def test_metrics_view(self):
+        user = CustomUserFactory()
+        ProjectFactory(user=user, name="demo")
+        xxxxxCmd(user).run(u"projects info demo")
+        xxxxxCmd(user).run(u"projects info demo")
+
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('hubot_command_seconds_bucket{command="projects info",le="+Inf"} 2', response.content)
+        for phase in ["parse", "validate", "db", "marathon", "cinder"]:
+            self.assertIn('hubot_command_phase_seconds_count{{command="projects info",phase="{0}"}} 2'.format(phase),
+                          response.content)
+
+    def test_metrics_view_forbidden(self):
+        with self.settings(METRICS_ALLOWED_IPS=["10.0.0.1"]):
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+            self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="10.0.0.1").status_code, 200)
+
+            user = CustomUserFactory(is_staff=True)
+            self.client.login(username=user.username, password="111111")
+            self.assertEqual(self.client.get("/metrics").status_code, 200)
+
+
+class StubMarathonHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    # one write per response, or delayed acks slow down keep-alive connections
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        body = json.dumps({"app": {"id": "/" + self.path[len("/v2/apps"):].strip("/"), "instances": 1, "tasks": []}})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubMarathonServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    connections = 0
+
+
+class PooledMarathonClientTest(SimpleTestCase):
+
+    def setUp(self):
+        self.server = StubMarathonServer(("127.0.0.1", 0), StubMarathonHandler)
+        self.url = "http://127.0.0.1:{0}".format(self.server.server_address[1])
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_failover(self):
+        client = PooledMarathonClient(["http://127.0.0.1:1", self.url], retry_after=60)
+
+        self.assertEqual(client.get_app("/demo").id, "/demo")
+        self.assertEqual(client.get_servers(), [self.url, "http://127.0.0.1:1"])
+        self.assertEqual(client.get_servers(), [self.url, "http://127.0.0.1:1"])
+
+        client.mark_up("http://127.0.0.1:1")
+        self.assertEqual(set(client.get_servers()[0] for _ in range(2)), {"http://127.0.0.1:1", self.url})
+
+    def test_benchmark(self):
+        calls = 200
+
+        def rate(client):
+            start = time.time()
+            for _ in range(calls):
+                client.get_app("/demo")
+            return calls / (time.time() - start)
+
+        before = rate(MarathonClient([self.url]))
+        connections = self.server.connections
+        after = rate(PooledMarathonClient([self.url]))
+        sys.stderr.write("\nget_app: {0:.0f} calls/s, pooled client: {1:.0f} calls/s ... ".format(before, after))
+
+        self.assertEqual(connections, calls)
+        self.assertEqual(self.server.connections - connections, 1)
+
+
+class FakeRedis(object):
+    """
+    The few commands of the app state cache, the retry policy and the monitor cluster, on a dict.
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, nx=False, ex=None, px=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = str(value)
+        return True
+
+    def expire(self, key, seconds):
+        return key in self.data
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def hkeys(self, key):
+        return list(self.data.get(key, {}))
+
+    def hmget(self, key, *fields):
+        return [self.data.get(key, {}).get(field) for field in fields]
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value
+
+    def hmset(self, key, mapping):
+        self.data.setdefault(key, {}).update(mapping)
+
+    def hdel(self, key, *fields):
+        for field in fields:
+            self.data.get(key, {}).pop(field, None)
+
+    def hincrby(self, key, field, amount=1):
+        values = self.data.setdefault(key, {})
+        values[field] = int(values.get(field, 0)) + amount
+        return values[field]
+
+    def rpush(self, key, *values):
+        self.data.setdefault(key, []).extend(values)
+        return len(self.data[key])
+
+    def blpop(self, keys, timeout=0):
+        for key in keys:
+            if self.data.get(key):
+                return key, self.data[key].pop(0)
+        return None
+
+    def eval(self, script, numkeys, key, identity, *args):
+        # the lease scripts, which touch the key only when it holds the identity
+        if self.data.get(key) != identity:
+            return 0
+        if script == RELEASE_SCRIPT:
+            self.delete(key)
+        return 1
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((getattr(self.redis, name), args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+
+class AppStateCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.marathon = mock.MagicMock()
+        self.marathon.list_apps.return_value = [
+            MarathonApp(id="/demo-x", instances=2, labels={"HAPROXY_GROUP": "external"}, version="v1",
+                        tasks=[{"id": "t1", "host": "node-1", "ports": [31000]},
+                               {"id": "t2", "host": "node-2", "ports": [31001]}]),
+        ]
+        self.marathon.list_deployments.return_value = [MarathonDeployment(id="d1", affected_apps=["/demo-x"])]
+        self.redis = FakeRedis()
+        self.cache = AppStateCache(self.marathon, self.redis)
+
+    def test_seed_and_events(self):
+        self.assertEqual(self.cache.seed(), (1, 1))
+
+        app = self.cache.get_app("/demo-x")
+        self.assertEqual((app.instances, app.labels, app.version), (2, {"HAPROXY_GROUP": "external"}, "v1"))
+        self.assertEqual([deployment.id for deployment in app.deployments], ["d1"])
+        self.assertEqual(self.cache.list_deployment_ids(), ["d1"])
+
+        self.cache.apply_event({"eventType": "api_post_event",
+                                "appDefinition": {"id": "/demo-x", "instances": 3, "labels": {}, "version": "v2"}})
+        self.cache.apply_event({"eventType": "status_update_event", "appId": "/demo-x", "taskId": "t1",
+                                "taskStatus": "TASK_KILLED"})
+        self.cache.apply_event({"eventType": "deployment_success", "id": "d1"})
+
+        # another process reads what the monitor wrote to redis
+        app = AppStateCache(self.marathon, self.redis).get_app("/demo-x")
+        self.assertEqual((app.instances, app.version), (3, "v2"))
+        self.assertEqual([task.id for task in app.tasks], ["t2"])
+        self.assertEqual(app.deployments, [])
+        self.assertEqual(self.cache.list_deployment_ids(), [])
+        self.assertFalse(self.marathon.get_app.called)
+        self.assertFalse(self.marathon.list_deployments.call_count > 1)
+
+        self.cache.apply_event({"eventType": "app_terminated_event", "appId": "/demo-x"})
+        self.marathon.get_app.side_effect = NotFoundError(mock.MagicMock(status_code=404))
+        with self.assertRaises(NotFoundError):
+            self.cache.get_app("/demo-x")
+
+    def test_staleness_and_bypass(self):
+        self.cache.seed()
+        self.marathon.get_app.return_value = MarathonApp(id="/demo-x", instances=0, version="v3")
+
+        self.assertEqual(self.cache.get_app("/demo-x").instances, 2)
+        self.assertEqual(self.cache.get_app("/demo-x", bypass=True).instances, 0)
+        self.marathon.get_app.assert_called_once_with("/demo-x", embed_tasks=True)
+
+        # the fetched state is cached in turn
+        self.assertEqual(self.cache.get_app("/demo-x").version, "v3")
+        time.sleep(0.01)
+        self.cache.get_app("/demo-x", max_age=0)
+        self.assertEqual(self.marathon.get_app.call_count, 2)
+
+    def test_kept_current_by_the_stream(self):
+        cache = AppStateCache(self.marathon, self.redis, max_age=60, local_ttl=0)
+        cache.seed()
+        self.marathon.get_app.return_value = MarathonApp(id="/demo-x", instances=0, version="v3")
+        later = time.time() + 120
+
+        # the monitor tells its stream is connected, the seeded entries are still current
+        with mock.patch("time.time", return_value=later - 30):
+            cache.mark_alive()
+        with mock.patch("time.time", return_value=later):
+            self.assertEqual(cache.get_app("/demo-x").instances, 2)
+            self.assertEqual(cache.list_deployment_ids(), ["d1"])
+        self.assertFalse(self.marathon.get_app.called)
+
+        # the stream went away
+        with mock.patch("time.time", return_value=later + 60):
+            self.assertEqual(cache.get_app("/demo-x").instances, 0)
+        self.assertEqual(self.marathon.get_app.call_count, 1)
+
+    def test_redis_down(self):
+        redis = mock.MagicMock()
+        redis.hget.side_effect = ConnectionError()
+        redis.pipeline.return_value.execute.side_effect = ConnectionError()
+        cache = AppStateCache(self.marathon, redis, local_ttl=0)
+        self.marathon.get_app.return_value = MarathonApp(id="/demo-x", instances=1)
+
+        self.assertEqual(cache.get_app("/demo-x").instances, 1)
+        self.assertEqual(cache.get_app("/demo-x").instances, 1)
+        self.assertEqual(self.marathon.get_app.call_count, 1)
+
+
+@mock.patch("hubot.utils.deploy_batch.app_states", mock.MagicMock())
+@mock.patch("hubot.utils.deploy_batch.client")
+@mock.patch("hubot.utils.deploy_batch.marathon")
+class BulkDeployTest(TestCase):
+
+    @mock.patch("hubot.tasks.check_deploy_batch.apply_async")
+    def test_bulk_deploy(self, check, marathon, client):
+        releases = [ProjectReleaseFactory(build__project=ProjectFactory(instances=1)) for _ in range(3)]
+        depend = AddonRedisFactory()
+        addon = AddonRedisFactory(depend=depend)
+        marathon.update_apps.side_effect = [{"version": "v1", "deploymentId": "d1"},
+                                            {"version": "v1", "deploymentId": "d2"},
+                                            {"version": "v1", "deploymentId": "d3"}]
+
+        with self.settings(MARATHON_BULK_SIZE=2):
+            result = bulk_deploy(releases + [addon, depend])
+        self.assertEqual((result.deployed, result.skipped, result.failed), (5, 0, 0))
+
+        self.assertEqual(marathon.update_apps.call_count, 3)
+        apps = sum([call[0][0] for call in marathon.update_apps.call_args_list], [])
+        self.assertEqual([app["id"] for app in apps][3:], [depend.marathon_app_id, addon.marathon_app_id])
+        self.assertEqual(apps[4]["dependencies"], [depend.marathon_app_id])
+        self.assertEqual(ProjectRelease.objects.filter(deployment_id="d1").count(), 2)
+
+        client.hmset.assert_called_once_with("deploy_batch:{0}".format(result.batch_id),
+                                             {"action": "deploy", "deployments": '["d1", "d2", "d3"]',
+                                              "created": mock.ANY})
+        check.assert_called_once_with(args=[result.batch_id], countdown=mock.ANY)
+
+        result = bulk_deploy([ProjectRelease.objects.get(id=release.id) for release in releases])
+        self.assertEqual((result.deployed, result.skipped, result.batch_id), (0, 3, None))
+        self.assertEqual(marathon.update_apps.call_count, 3)
+
+    @mock.patch("hubot.tasks.check_deploy_batch.apply_async", mock.Mock())
+    def test_bulk_deploy_split_on_conflict(self, marathon, client):
+        releases = [ProjectReleaseFactory() for _ in range(4)]
+        locked = releases[2].marathon_app_id
+
+        def update_apps(apps, force=False):
+            if locked in [app["id"] for app in apps]:
+                raise MarathonHttpError(mock.Mock(status_code=409, json=lambda: {"message": "locked"}))
+            return {"version": "v1", "deploymentId": "d{0}".format(len(apps))}
+        marathon.update_apps.side_effect = update_apps
+
+        with self.settings(MARATHON_BULK_SIZE=4):
+            result = bulk_deploy(releases)
+
+        self.assertEqual((result.deployed, result.failed), (3, 1))
+        self.assertEqual([call[0][0][0]["id"] for call in marathon.update_apps.call_args_list],
+                         [releases[0].marathon_app_id, releases[0].marathon_app_id, locked, locked,
+                          releases[3].marathon_app_id])
+        self.assertEqual(ProjectRelease.objects.get(id=releases[2].id).deployment_id, "")
+
+    def test_batch_deployment_success(self, marathon, client):
+        from hubot.management.commands.marathon_monitor import deployment_success_status_update
+        running = ProjectReleaseFactory(status=ProjectRelease.STATUS.Running)
+        releases = [ProjectReleaseFactory(build__project=running.project, project=running.project, deployment_id="d1"),
+                    ProjectReleaseFactory(deployment_id="d1")]
+        addon = AddonRedisFactory(deployment_id="d1")
+
+        deployment_success_status_update(None, {"id": "d1"})
+
+        statuses = dict(ProjectRelease.objects.values_list("id", "status"))
+        self.assertEqual([statuses[release.id] for release in [running] + releases],
+                         [ProjectRelease.STATUS.Finished, ProjectRelease.STATUS.Running, ProjectRelease.STATUS.Running])
+        self.assertEqual(Addon.objects.get(id=addon.id).status, Addon.STATUS.Running)
+
+    @mock.patch("projects.tasks.release_deploy.delay")
+    @mock.patch("hubot.tasks.marathon")
+    @mock.patch("hubot.tasks.app_states")
+    def test_check_deploy_batch(self, app_states, tasks_marathon, deploy, marathon, client):
+        running = ProjectReleaseFactory(status=ProjectRelease.STATUS.Running)
+        release = ProjectReleaseFactory(build__project=running.project, project=running.project, deployment_id="d1")
+        previous = ProjectReleaseFactory(status=ProjectRelease.STATUS.Running)
+        stuck = ProjectReleaseFactory(build__project=previous.project, project=previous.project, deployment_id="d2")
+        addon = AddonRedisFactory(deployment_id="d2")
+        client.hgetall.return_value = {"action": "deploy", "deployments": '["d1", "d2"]'}
+        app_states.list_deployment_ids.return_value = ["d2"]
+        converged = MarathonApp(instances=1, version="v2", tasks=[MarathonTask(version="v2")])
+        app_states.get_app.side_effect = lambda app_id, **kwargs: converged if app_id == addon.marathon_app_id \
+            else MarathonApp(instances=1, version="v2", tasks=[MarathonTask(version="v1")])
+
+        check_deploy_batch("batch")
+
+        self.assertEqual(ProjectRelease.objects.get(id=release.id).status, ProjectRelease.STATUS.Running)
+        self.assertEqual(ProjectRelease.objects.get(id=running.id).status, ProjectRelease.STATUS.Finished)
+        self.assertEqual(ProjectRelease.objects.get(id=stuck.id).status, ProjectRelease.STATUS.Failed)
+        self.assertEqual(ProjectRelease.objects.get(id=previous.id).status, ProjectRelease.STATUS.Running)
+        self.assertEqual(Addon.objects.get(id=addon.id).status, Addon.STATUS.Running)
+        tasks_marathon.delete_deployment.assert_called_once_with("d2", force=True)
+        deploy.assert_called_once_with(previous.id, force=True)
+
+
+@mock.patch("hubot.utils.mesos.marathon")
+@mock.patch("hubot.tasks.marathon")
+class ReconcileDeploymentsTest(TestCase):
+
+    def test_reconcile(self, marathon, mesos_marathon):
+        marathon.list_deployments.return_value = [MarathonDeployment(id="d-running")]
+        old = timezone.now() - timedelta(seconds=settings.TIMEOUT_FOR_STATUS_FINISHED + 1)
+        running = ProjectReleaseFactory(status=ProjectRelease.STATUS.Running)
+        finished = ProjectReleaseFactory(build__project=running.project, status=ProjectRelease.STATUS.Staging,
+                                         deployment_id="d-done", deployed_at=old)
+        previous = ProjectReleaseFactory(status=ProjectRelease.STATUS.Running)
+        timed_out = ProjectReleaseFactory(build__project=previous.project, status=ProjectRelease.STATUS.Staging,
+                                          deployment_id="d-running", deployed_at=old)
+        staging = ProjectReleaseFactory(status=ProjectRelease.STATUS.Staging, deployment_id="d-running",
+                                        deployed_at=timezone.now())
+        lost = ProjectReleaseFactory(status=ProjectRelease.STATUS.Staging, deployment_id="d-gone", deployed_at=old)
+        # running releases a rollback was put to
+        rolled_back = ProjectReleaseFactory(status=ProjectRelease.STATUS.Running, deployment_id="d-done",
+                                            deployed_at=old)
+        failed_rollback = ProjectReleaseFactory(status=ProjectRelease.STATUS.Running, deployment_id="d-running",
+                                                deployed_at=old)
+        addon = AddonRedisFactory(status=Addon.STATUS.Staging, deployment_id="d-done", deployed_at=old)
+        restored = AddonRedisFactory(status=Addon.STATUS.Restoring, deployment_id="d-done")
+        restoring = AddonRedisFactory(status=Addon.STATUS.Restoring)
+        stuck = AddonRedisFactory(status=Addon.STATUS.Resetting)
+        Addon.objects.filter(id__in=[restored.id, stuck.id]).update(status_changed=old)
+        Addon.objects.filter(id=restored.id).update(deployed_at=old + timedelta(seconds=1))
+        marathon.list_apps.return_value = [
+            MarathonApp(id="/" + obj.marathon_app_id, instances=1)
+            for obj in [running, previous, staging, rolled_back, failed_rollback, addon, restored, restoring, stuck]]
+        mesos_marathon.delete_deployment.return_value = {"version": "v2", "deploymentId": "d-rollback"}
+
+        with self.assertNumQueries(11):
+            reconcile_deployments()
+
+        releases = dict((release.id, release) for release in ProjectRelease.objects.all())
+        self.assertEqual([releases[release.id].status for release in [running, finished, previous, timed_out, staging,
+                                                                      lost, rolled_back, failed_rollback]],
+                         ["Finished", "Running", "Running", "Failed", "Staging", "Failed", "Running", "Failed"])
+        # the rollback deployment of the timed out release is followed, a failed rollback isn't rolled back again
+        mesos_marathon.delete_deployment.assert_called_once_with("d-running")
+        self.assertEqual(releases[previous.id].deployment_id, "d-rollback")
+        self.assertIsNotNone(releases[previous.id].deployed_at)
+        self.assertEqual([releases[release.id].deployed_at for release in [finished, rolled_back, failed_rollback]],
+                         [None, None, None])
+        statuses = dict(Addon.objects.values_list("id", "status"))
+        self.assertEqual([statuses[obj.id] for obj in [addon, restored, restoring, stuck]],
+                         ["Running", "Running", "Restoring", "Failed"])
+        self.assertEqual((marathon.list_deployments.call_count, marathon.list_apps.call_count), (1, 1))
+
+
+@mock.patch("hubot.utils.waiter.client")
+class WaiterTest(SimpleTestCase):
+
+    def test_publish_event(self, client):
+        publish_event({"eventType": "status_update_event", "appId": "/demo-x"})
+        publish_event({"eventType": "deployment_info",
+                       "plan": {"id": "d1", "steps": [{"actions": [{"app": "/demo-x"}, {"app": "/demo-y"}]}]}})
+        self.assertEqual([call[0][0] for call in client.publish.call_args_list],
+                         ["marathon:events:/demo-x", "marathon:events:/demo-x", "marathon:events:/demo-y"])
+
+    def test_wait_for_event(self, client):
+        pubsub = client.pubsub.return_value
+        pubsub.get_message.side_effect = [None, {"type": "message", "data": "{}"}]
+        condition = mock.MagicMock(side_effect=[False, True])
+
+        start = time.time()
+        self.assertTrue(wait_for("/demo-x", condition, timeout=5, interval=5))
+        self.assertLess(time.time() - start, 1)
+        pubsub.subscribe.assert_called_once_with("marathon:events:/demo-x")
+        self.assertTrue(pubsub.close.called)
+
+    @mock.patch("hubot.utils.waiter.time.sleep")
+    def test_poll_without_redis(self, sleep, client):
+        client.pubsub.side_effect = ConnectionError()
+
+        self.assertTrue(wait_for("/demo-x", mock.MagicMock(side_effect=[False, False, False, True]), interval=1))
+        self.assertEqual([call[0][0] for call in sleep.call_args_list], [1, 2, 4])
+
+        self.assertFalse(wait_for("/demo-x", lambda: False, timeout=0.05, interval=0.01))
+
+
+class FakeMarathonTest(TestCase):
+
+    def setUp(self):
+        self.server = FakeMarathonServer(deployment_duration=0.3, seed=1).start()
+        with self.settings(MARATHON_SERVERS=[self.server.url]):
+            self.client = get_marathon_client()
+        cache = AppStateCache(self.client, FakeRedis())
+        for target in ["hubot.utils.mesos.marathon", "hubot.utils.mesos.app_states", "hubot.utils.waiter.client"]:
+            patcher = mock.patch(target, {"hubot.utils.mesos.marathon": self.client,
+                                          "hubot.utils.mesos.app_states": cache}.get(target, mock.MagicMock()))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.server.stop)
+
+    def test_release_lifecycle(self):
+        release = ProjectReleaseFactory(build__project=ProjectFactory(instances=2))
+        events = requests.get(self.server.url + "/v2/events", stream=True).iter_lines(chunk_size=1)
+
+        self.assertTrue(create_or_update_marathon_app(release))
+        self.assertEqual(self.client.list_deployments()[0].id, release.deployment_id)
+        with self.assertRaises(MarathonHttpError) as cm:
+            self.client.scale_app(release.marathon_app_id, instances=3)
+        self.assertEqual(cm.exception.status_code, 409)
+
+        time.sleep(0.5)
+        app = self.client.get_app(release.marathon_app_id, embed_tasks=True)
+        self.assertEqual((app.instances, len(app.tasks), app.deployments), (2, 2, []))
+        self.assertFalse(create_or_update_marathon_app(release))
+
+        destroy_marathon_app(release, run_async=False)
+        self.assertEqual(self.client.list_apps(), [])
+        self.assertEqual([method for method, path in self.server.marathon.requests if method != "GET"],
+                         ["POST", "PUT", "DELETE"])
+
+        event_types = (line[len("event: "):] for line in events if line.startswith("event: "))
+        self.assertEqual(list(itertools.islice(event_types, 5)), ["api_post_event", "deployment_info",
+                                                                  "status_update_event", "status_update_event",
+                                                                  "deployment_success"])
+
+    def test_conflicts_and_latency(self):
+        self.server.marathon.latency = 0.01
+        self.server.marathon.conflict_rate = 0.5
+        codes = []
+        start = time.time()
+        for i in range(20):
+            try:
+                self.client.update_apps([{"id": "/app-{0}".format(i), "instances": 1}])
+                codes.append(200)
+            except MarathonHttpError as e:
+                codes.append(e.status_code)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        self.assertEqual(set(codes), {200, 409})
+        self.assertEqual(len(self.client.list_apps()), codes.count(200))
+
+
+class RetryPolicyTest(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.policy = RetryPolicy("marathon", self.redis, is_marathon_failure, is_marathon_retryable, base=0.01,
+                                  cap=0.05, attempts=3, threshold=2, reset_after=60, budget_ratio=0, min_retries=2)
+
+    def conflict(self):
+        return MarathonHttpError(mock.Mock(status_code=409, json=lambda: {"message": "locked"}))
+
+    def test_circuit_breaker(self):
+        down = mock.Mock(side_effect=MarathonError("No remaining Marathon servers to try"))
+        for i in range(2):
+            self.assertRaises(MarathonError, self.policy.call, down)
+        with self.assertRaises(CircuitOpenError) as cm:
+            self.policy.call(down)
+        self.assertEqual(down.call_count, 2)
+        self.assertGreater(cm.exception.retry_after, 50)
+
+        # once reset_after passed a single call probes marathon, its success closes the circuit
+        self.redis.hset("breaker:marathon", "opened_until", time.time() - 1)
+        probe = mock.Mock(side_effect=lambda: self.assertRaises(CircuitOpenError, self.policy.call, down) or "ok")
+        self.assertEqual(self.policy.call(probe), "ok")
+        self.assertEqual(down.call_count, 2)
+        self.assertEqual(self.policy.call(lambda: "ok"), "ok")
+
+        # a conflict is retried but doesn't tell marathon is unhealthy
+        for i in range(3):
+            self.assertRaises(MarathonHttpError, self.policy.call, mock.Mock(side_effect=self.conflict()))
+        self.assertIsNone(self.redis.hget("breaker:marathon", "opened_until"))
+
+    def test_retries(self):
+        flaky = mock.Mock(side_effect=[self.conflict(), self.conflict(), "ok"])
+        self.assertEqual(self.policy.run(flaky), "ok")
+        self.assertEqual(flaky.call_count, 3)
+
+        # the budget of 2 retries is spent
+        self.assertFalse(self.policy.should_retry(self.conflict(), retries=5))
+        bad_request = MarathonHttpError(mock.Mock(status_code=400, json=lambda: {"message": "invalid"}))
+        self.assertFalse(RetryPolicy("other", self.redis, is_marathon_failure).should_retry(bad_request, retries=5))
+
+        delays = [self.policy.backoff(0.02) for i in range(50)]
+        self.assertTrue(all(0.01 <= delay <= 0.05 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+    @mock.patch("hubot.utils.retry.time.sleep")
+    def test_poll(self, sleep):
+        check = mock.Mock(side_effect=[False, False, True])
+        self.assertTrue(self.policy.poll(check, timeout=60, interval=2))
+        self.assertEqual(sleep.call_args_list, [mock.call(2), mock.call(2)])
+
+        # a check that never passes gives up at the deadline
+        sleep.reset_mock()
+        self.assertFalse(self.policy.poll(lambda: False, timeout=0))
+        self.assertFalse(sleep.called)
+
+
+class TracingTest(SimpleTestCase):
+
+    def setUp(self):
+        marathon_request_seconds.clear()
+
+    def test_endpoint_template(self):
+        self.assertEqual(endpoint_template("/v2/apps//demo-x"), ("/v2/apps/{app_id}", "/demo-x"))
+        self.assertEqual(endpoint_template("/v2/apps/group/demo-x/tasks/demo-x.1"),
+                         ("/v2/apps/{app_id}/tasks/{task_id}", "/group/demo-x"))
+        self.assertEqual(endpoint_template("/v2/deployments/d1"), ("/v2/deployments/{deployment_id}", None))
+        self.assertEqual(endpoint_template("/v2/apps"), ("/v2/apps", None))
+
+    @mock.patch("hubot.utils.tracing.SLOW_LOG")
+    def test_traced_calls(self, slow_log):
+        with FakeMarathonServer() as server, self.settings(MARATHON_SLOW_CALL=0, MARATHON_SLOW_CALL_SAMPLE=1):
+            client = TracedMarathonClient([server.url])
+            with command_timing("projects info") as timing:
+                self.assertRaises(NotFoundError, client.get_app, "/demo-x")
+            client.update_apps([{"id": "/demo-x"}])
+
+        self.assertEqual(sorted(marathon_request_seconds.values), [("GET", "/v2/apps/{app_id}", 404),
+                                                                   ("PUT", "/v2/apps", 200)])
+        message = slow_log.warning.call_args_list[0][0][0]
+        self.assertIn(u"GET /v2/apps/{app_id} app=/demo-x status=404", message)
+        self.assertIn(u"from=command:projects info:{0}".format(timing.id), message)
+        self.assertIn(u"from=pid:", slow_log.warning.call_args_list[1][0][0])
+
+
+class EventPipelineTest(SimpleTestCase):
+
+    def event(self, app_id, i):
+        return {"eventType": "status_update_event", "appId": app_id, "taskId": str(i)}
+
+    def test_order_kept_per_app(self):
+        handled = []
+        pipeline = EventPipeline(lambda data: handled.append((data["appId"], data["taskId"])), workers=3).start()
+        for i in range(50):
+            for app_id in ["/a", "/b", "/c", "/d"]:
+                pipeline.put(self.event(app_id, i))
+        pipeline.stop()
+
+        self.assertEqual(len(handled), 200)
+        for app_id in ["/a", "/b", "/c", "/d"]:
+            self.assertEqual([task for app, task in handled if app == app_id], [str(i) for i in range(50)])
+
+    def test_backpressure(self):
+        monitor_blocked_seconds.clear()
+        release = threading.Event()
+        handled = []
+
+        def handler(data):
+            release.wait()
+            handled.append(data)
+
+        pipeline = EventPipeline(handler, workers=1, queue_size=2).start()
+        for i in range(3):
+            pipeline.put(self.event("/a", i))
+        reader = threading.Thread(target=pipeline.put, args=[self.event("/a", 3)])
+        reader.start()
+        reader.join(0.1)
+        # the worker holds an event and the queue is full, the reader waits
+        self.assertTrue(reader.is_alive())
+        self.assertEqual(monitor_queue_depth.values[(0,)], 2)
+
+        release.set()
+        reader.join()
+        pipeline.stop()
+        self.assertEqual(len(handled), 4)
+        self.assertGreater(monitor_blocked_seconds.values[()], 0.05)
+
+
+class StatusWindowTest(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.emit = mock.Mock()
+        self.window = StatusWindow(self.emit, self.redis, capacity=0.6)
+
+    def add(self, window, tasks, status="Running"):
+        for i in tasks:
+            window.add("/demo-x", "v1", "t{0}".format(i), status, "ts{0}".format(i), 20, {"addon": "redis"})
+
+    def test_one_emit_per_transition(self):
+        self.add(self.window, range(11))
+        self.assertEqual(self.window.flush(), 0)
+        self.add(self.window, range(11, 15))
+        self.add(self.window, range(15, 20))
+        self.assertEqual(self.window.flush(), 1)
+        self.assertEqual(self.window.flush(), 0)
+        self.emit.assert_called_once_with("/demo-x", "v1", "Running", "ts19", {"addon": "redis"})
+
+        self.add(self.window, range(12), status="Finished")
+        self.assertEqual(self.window.flush(), 1)
+        self.emit.assert_called_with("/demo-x", "v1", "Finished", "ts11", {"addon": "redis"})
+
+    def test_restart_from_checkpoint(self):
+        self.add(self.window, range(12))
+        self.window.flush()
+
+        window = StatusWindow(self.emit, mock.Mock(wraps=self.redis), capacity=0.6)
+        self.add(window, [12])
+        # the checkpoint is read by the flush, not while the events are added
+        self.assertEqual(window.redis.method_calls, [])
+        self.assertEqual(window.flush(), 0)
+        self.assertEqual(window.versions[("/demo-x", "v1")].emitted, "Running")
+        self.add(window, range(12), status="Failed")
+        self.assertEqual(window.flush(), 1)
+        self.assertEqual(self.emit.call_count, 2)
+
+
+class AppMetadataTest(SimpleTestCase):
+
+    def test_events(self):
+        metadata = AppMetadata()
+        metadata.bootstrap([MarathonApp(id="/demo-x", instances=2, labels={"HAPROXY_GROUP": "external"},
+                                        version="v1")])
+        self.assertEqual(metadata.get("/demo-x"), {"instances": 2, "labels": {"HAPROXY_GROUP": "external"},
+                                                   "version": "v1"})
+
+        metadata.apply_event({"eventType": "api_post_event", "appDefinition": {
+            "id": "/demo-x", "instances": 3, "labels": {"HAPROXY_GROUP": "external"}, "version": "v2"}})
+        self.assertEqual(metadata.get("/demo-x")["instances"], 3)
+        addon = {"id": "/g/redis-m-addon", "instances": 1, "labels": {"addon": "redis"}}
+        metadata.apply_event({"eventType": "deployment_info", "plan": {"id": "d1", "target": {
+            "id": "/", "apps": [], "groups": [{"id": "/g", "apps": [addon]}]}}})
+        self.assertEqual(metadata.get("/g/redis-m-addon")["labels"], {"addon": "redis"})
+        metadata.apply_event({"eventType": "app_terminated_event", "appId": "/demo-x"})
+        self.assertIsNone(metadata.get("/demo-x"))
+
+    @mock.patch("hubot.utils.mesos.marathon")
+    @mock.patch("hubot.management.commands.marathon_monitor.publish_event", mock.Mock())
+    @mock.patch("hubot.management.commands.marathon_monitor.app_states")
+    @mock.patch("hubot.management.commands.marathon_monitor.status_window")
+    def test_status_update_without_calls(self, status_window, app_states, marathon):
+        from hubot.management.commands import marathon_monitor
+        marathon_monitor.app_metadata.bootstrap([MarathonApp(id="/demo-m", instances=2, labels={}, version="v1")])
+        data = {"eventType": "status_update_event", "appId": "/demo-m", "taskId": "t1",
+                "taskStatus": "TASK_RUNNING", "version": "v1", "timestamp": "ts"}
+
+        marathon_monitor.handle_event(data)
+        marathon_monitor.handle_event(dict(data, appId="/unknown-m"))
+
+        status_window.add.assert_called_once_with("/demo-m", "v1", "t1", "Running", "ts", 2, {})
+        self.assertFalse(marathon.mock_calls)
+        self.assertFalse(app_states.get_app.called)
+
+
+class EventJournalTest(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def event(self, i):
+        return json.dumps({"eventType": "status_update_event", "appId": "/demo-{0}".format(i % 7), "taskId": str(i),
+                           "taskStatus": "TASK_RUNNING", "version": "v1", "timestamp": "ts"})
+
+    def test_segments(self):
+        journal = EventJournal(self.directory, segment_size=1024, max_segments=3)
+        offsets = [journal.append(self.event(i)) for i in range(100)]
+        journal.close()
+
+        segments = journal.segments()
+        self.assertEqual(len(segments), 3)
+        records = list(journal.read())
+        self.assertEqual(records[0][0], segments[0])
+        self.assertEqual(records[-1], (offsets[-1], self.event(99)))
+        self.assertEqual([data for _, data in journal.read(offsets[90])], [self.event(i) for i in range(90, 100)])
+
+        # a reopened journal goes on after the last record
+        self.assertEqual(EventJournal(self.directory).append(self.event(100)), journal.end_offset() - 4 -
+                         len(self.event(100)))
+
+    def test_cut_record(self):
+        journal = EventJournal(self.directory)
+        journal.append(self.event(0))
+        offset = journal.append(self.event(1))
+        journal.close()
+        path = journal.segment_path(0)
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 3)
+
+        self.assertEqual([data for _, data in journal.read()], [self.event(0)])
+        journal = EventJournal(self.directory)
+        self.assertEqual(journal.append(self.event(2)), offset)
+        self.assertEqual([data for _, data in journal.read()], [self.event(0), self.event(2)])
+
+    @mock.patch("hubot.management.commands.marathon_monitor.status_window", mock.Mock())
+    @mock.patch("hubot.management.commands.marathon_monitor.Command.seed", mock.Mock())
+    def test_replay(self):
+        journal = EventJournal(self.directory)
+        offsets = [journal.append(self.event(i)) for i in range(5000)]
+        journal.close()
+        handled = []
+
+        with mock.patch("hubot.management.commands.marathon_monitor.handle_event", handled.append):
+            call_command("marathon_monitor", replay=offsets[1000], journal_dir=self.directory)
+            self.assertEqual(len(handled), 4000)
+            del handled[:]
+
+            # an offset inside a record would read a length out of the event
+            with self.assertRaises(CommandError):
+                call_command("marathon_monitor", replay=offsets[1000] + 1, journal_dir=self.directory)
+            self.assertEqual(handled, [])
+            self.assertTrue(journal.is_boundary(journal.end_offset()))
+
+            # the journal as a fixture of the throughput of the handlers
+            started = time.time()
+            call_command("marathon_monitor", replay=0, journal_dir=self.directory)
+            rate = len(handled) / (time.time() - started)
+        self.assertEqual(len(handled), 5000)
+        sys.stderr.write("\nreplay: {0:.0f} events/s ... ".format(rate))
+
+
+class MonitorClusterTest(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+
+    def test_lease_failover(self):
+        first = LeaderLease(self.redis, "a")
+        second = LeaderLease(self.redis, "b")
+        self.assertTrue(first.refresh())
+        self.assertFalse(second.refresh())
+        self.assertTrue(first.refresh())
+
+        # redis away, the leader leads until the lease may have expired
+        with mock.patch.object(self.redis, "eval", side_effect=ConnectionError("down")):
+            self.assertTrue(first.refresh())
+            first.expires = time.time()
+            self.assertFalse(first.refresh())
+
+        first.release()
+        self.assertTrue(second.refresh())
+        self.assertFalse(first.refresh())
+        self.assertFalse(first.held())
+
+    def test_ring_moves_few_partitions(self):
+        before = HashRing(["a", "b", "c"])
+        after = HashRing(["a", "b", "c", "d"])
+        moved = [p for p in range(64) if before.node(str(p)) != after.node(str(p))]
+        self.assertTrue(moved)
+        self.assertEqual(set(after.node(str(p)) for p in moved), {"d"})
+
+    def test_partitions(self):
+        first = MonitorCluster(self.redis, "a", partitions=16)
+        second = MonitorCluster(self.redis, "b", partitions=16)
+        for member in [first, second, first]:
+            member.heartbeat()
+        self.assertEqual(sorted(first.owned() + second.owned()), list(range(16)))
+
+        for i in range(10):
+            for app_id in ["/demo-{0}".format(n) for n in range(8)]:
+                first.push(json.dumps({"eventType": "status_update_event", "appId": app_id, "taskId": str(i)}))
+        handled = {}
+        for member in [first, second]:
+            for data in iter(member.pop, None):
+                handled.setdefault(data["appId"], []).append((member.identity, data["taskId"]))
+        self.assertEqual(len(handled), 8)
+        for events in handled.values():
+            self.assertEqual(len(set(identity for identity, task in events)), 1)
+            self.assertEqual([task for identity, task in events], [str(i) for i in range(10)])
+
+        # a member without heartbeat is gone, its partitions move to the others
+        with mock.patch("time.time", return_value=time.time() + 10):
+            first.heartbeat()
+        self.assertEqual(first.owned(), list(range(16)))
+
+
+class OnCommitTest(TestCase):
+
+    def test_callbacks(self):
+        calls = []
+        on_commit(calls.append, "outside")
+        self.assertEqual(calls, ["outside"])
+        del calls[:]
+
+        with atomic():
+            on_commit(calls.append, "kept")
+            try:
+                with atomic():
+                    on_commit(calls.append, "raised")
+                    raise ValueError()
+            except ValueError:
+                pass
+            with atomic():
+                on_commit(calls.append, "rolled back")
+                transaction.set_rollback(True)
+            self.assertEqual(calls, [])
+        self.assertEqual(calls, ["kept"])
+
+        with atomic():
+            on_commit(calls.append, "failing")
+            transaction.set_rollback(True)
+        self.assertEqual(calls, ["kept"])
@@ -3,7 +3,7 @@ from django.conf.urls import patterns, include, url
 from rest_framework.authtoken import views
 from django.contrib import admin
 from django.conf import settings
-from hubot.views import build_notify
+from hubot.views import build_notify, metrics
 from projects.views import version
 
 
@@ -16,7 +16,8 @@ urlpatterns = patterns(
     url(r'^api/', include('api.urls', namespace='api')),
     url(r'^token/', views.obtain_auth_token),
     url(r'^builds/notify/', build_notify),
-    url(r'^version/', version)
+    url(r'^version/', version),
+    url(r'^metrics$', metrics),
 )
 
 
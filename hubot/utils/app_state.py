@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+"""
+Local cache of the state of the marathon apps and deployments.
+
+The monitor seeds it from one ``/v2/apps?embed=apps.tasks`` and one
+``/v2/deployments`` listing and keeps it current from the event stream. The
+state is written to redis, shared by the web and celery workers, and kept a
+short while in the memory of every process, so the mesos helpers don't ask
+marathon for an app the monitor has just seen.
+
+Only what the helpers read is kept: instances, labels, version, deployments
+and tasks. The cache is seeded when the monitor connects to the stream, then
+the monitor tells every few seconds that its stream is still connected: an
+entry written since the seed is current as long as the stream was seen
+connected less than ``max_age`` seconds ago. Any other entry older than
+``max_age`` seconds is fetched again from marathon, ``bypass=True`` always
+asks marathon.
+
+The monitor also keeps an `AppMetadata` table of its own, read by the handlers
+of the task events without any call to marathon or redis.
+"""
+import json
+import logging
+import threading
+import time
+
+from marathon import MarathonApp
+from redis.exceptions import RedisError
+
+
+LOG = logging.getLogger(__name__)
+
+
+APPS_KEY = "marathon:apps"
+DEPLOYMENTS_KEY = "marathon:deployments"
+DEPLOYMENTS_UPDATED_KEY = "marathon:deployments:updated"
+STREAM_KEY = "marathon:stream"
+
+TERMINAL_TASK_STATUSES = ("TASK_FINISHED", "TASK_FAILED", "TASK_KILLED", "TASK_LOST", "TASK_ERROR")
+
+
+def app_state(app):
+    """
+    State kept for a `marathon.MarathonApp`.
+    """
+    return {
+        "id": app.id,
+        "instances": app.instances,
+        "labels": app.labels or {},
+        "version": app.version,
+        "deployments": [{"id": deployment.id} for deployment in app.deployments],
+        "tasks": [{"id": task.id, "host": task.host, "ports": task.ports, "version": task.version}
+                  for task in app.tasks],
+    }
+
+
+def deployment_apps(deployment):
+    """
+    Ids of the apps touched by a deployment, from ``/v2/deployments`` or the plan of a deployment event.
+    """
+    app_ids = set(deployment.get("affectedApps") or [])
+    for step in deployment.get("steps") or []:
+        # marathon < 1.0 sends the steps as lists of actions
+        actions = (step.get("actions") or []) if isinstance(step, dict) else step
+        for action in actions:
+            if action.get("app"):
+                app_ids.add(action["app"])
+    return sorted(app_ids)
+
+
+def group_apps(group):
+    """
+    Definitions of the apps of a group and of its subgroups, like the target of a deployment plan.
+    """
+    apps = list(group.get("apps") or [])
+    for subgroup in group.get("groups") or []:
+        apps.extend(group_apps(subgroup))
+    return apps
+
+
+class AppStateCache(object):
+
+    def __init__(self, marathon, redis, max_age=60, local_ttl=2):
+        """
+        :param int max_age: seconds an entry is used without asking marathon
+        :param int local_ttl: seconds an entry read from redis is kept in the process
+        """
+        self.marathon = marathon
+        self.redis = redis
+        self.max_age = max_age
+        self.local_ttl = local_ttl
+        self.lock = threading.Lock()
+        # the events are applied from several threads, an event reads the state of an app before changing it
+        self.update_lock = threading.RLock()
+        self.apps = {}
+        self.deployments = None
+        self.stream = (0, (0, 0))
+
+    def stream_state(self):
+        """
+        ``(seeded, alive)``: when the monitor seeded the cache and last saw its event stream connected.
+        """
+        with self.lock:
+            read_at, state = self.stream
+        if time.time() - read_at <= self.local_ttl:
+            return state
+        try:
+            state = tuple(float(value or 0) for value in self.redis.hmget(STREAM_KEY, "seeded", "alive"))
+        except RedisError as e:
+            LOG.error(str(e))
+            return state
+        with self.lock:
+            self.stream = (time.time(), state)
+        return state
+
+    def mark_alive(self):
+        """
+        Called by the monitor while its event stream is connected.
+        """
+        try:
+            self.redis.hset(STREAM_KEY, "alive", time.time())
+        except RedisError as e:
+            LOG.error(str(e))
+
+    def is_fresh(self, updated, max_age):
+        """
+        True when an entry written at ``updated`` can be used without asking marathon.
+        """
+        now = time.time()
+        if now - updated <= max_age:
+            return True
+        seeded, alive = self.stream_state()
+        return bool(seeded) and updated >= seeded and now - alive <= max_age
+
+    def read(self, app_id, local=True):
+        with self.lock:
+            read_at, entry = self.apps.get(app_id, (0, None))
+        if local and entry is not None and time.time() - read_at <= self.local_ttl:
+            return entry
+        try:
+            value = self.redis.hget(APPS_KEY, app_id)
+        except RedisError as e:
+            LOG.error(str(e))
+            return entry
+        entry = json.loads(value) if value else None
+        with self.lock:
+            if entry is None:
+                self.apps.pop(app_id, None)
+            else:
+                self.apps[app_id] = (time.time(), entry)
+        return entry
+
+    def write(self, entries=(), removed=()):
+        """
+        Stores ``entries`` (an ``{app id: state}`` dict) and drops the ``removed`` apps.
+        """
+        now = time.time()
+        entries = dict((app_id, {"updated": now, "app": state}) for app_id, state in dict(entries).items())
+        with self.lock:
+            for app_id in removed:
+                self.apps.pop(app_id, None)
+            for app_id, entry in entries.items():
+                self.apps[app_id] = (now, entry)
+        try:
+            pipe = self.redis.pipeline()
+            if removed:
+                pipe.hdel(APPS_KEY, *removed)
+            if entries:
+                pipe.hmset(APPS_KEY, dict((app_id, json.dumps(entry)) for app_id, entry in entries.items()))
+            pipe.execute()
+        except RedisError as e:
+            LOG.error(str(e))
+
+    def forget(self, app_id):
+        self.write(removed=[app_id])
+
+    def get_app(self, app_id, max_age=None, bypass=False, local=True):
+        """
+        Same as ``marathon.get_app(app_id, embed_tasks=True)`` but answered from the cache when it's fresh,
+        raises `marathon.exceptions.NotFoundError` for an unknown app.
+
+        :param bool local: use the copy kept in the process, False reads what the monitor wrote last
+        :rtype: `marathon.MarathonApp`
+        """
+        max_age = self.max_age if max_age is None else max_age
+        if not bypass:
+            entry = self.read(app_id, local=local)
+            if entry is not None and self.is_fresh(entry["updated"], max_age):
+                return MarathonApp.from_json(entry["app"])
+
+        app = self.marathon.get_app(app_id, embed_tasks=True)
+        state = app_state(app)
+        self.write({app.id: state})
+        return MarathonApp.from_json(state)
+
+    def list_deployment_ids(self, max_age=None, bypass=False):
+        """
+        Ids of the running deployments, as ``marathon.list_deployments()`` would list them.
+        """
+        max_age = self.max_age if max_age is None else max_age
+        if not bypass:
+            try:
+                updated, ids = self.redis.get(DEPLOYMENTS_UPDATED_KEY), self.redis.hkeys(DEPLOYMENTS_KEY)
+            except RedisError as e:
+                LOG.error(str(e))
+            else:
+                if updated and self.is_fresh(float(updated), max_age):
+                    return ids
+        return [deployment.id for deployment in self.marathon.list_deployments()]
+
+    def seed(self, apps=None):
+        """
+        Replaces the whole cache with the apps and deployments listed by marathon.
+
+        :param apps: the apps listed with their tasks already, else they are listed here
+        """
+        if apps is None:
+            apps = self.marathon.list_apps(embed_tasks=True)
+        apps = dict((app.id, app_state(app)) for app in apps)
+        deployments = {}
+        for deployment in self.marathon.list_deployments():
+            deployments[deployment.id] = {"id": deployment.id, "affectedApps": deployment.affected_apps or []}
+            for app_id in deployment.affected_apps or []:
+                if app_id in apps and deployment.id not in [d["id"] for d in apps[app_id]["deployments"]]:
+                    apps[app_id]["deployments"].append({"id": deployment.id})
+
+        now = time.time()
+        with self.lock:
+            self.apps = dict((app_id, (now, {"updated": now, "app": state})) for app_id, state in apps.items())
+            self.deployments = deployments
+        try:
+            pipe = self.redis.pipeline()
+            pipe.delete(APPS_KEY, DEPLOYMENTS_KEY)
+            if apps:
+                pipe.hmset(APPS_KEY, dict((app_id, json.dumps({"updated": now, "app": state}))
+                                          for app_id, state in apps.items()))
+            if deployments:
+                pipe.hmset(DEPLOYMENTS_KEY, dict((deployment_id, json.dumps(deployment))
+                                                 for deployment_id, deployment in deployments.items()))
+            pipe.set(DEPLOYMENTS_UPDATED_KEY, now)
+            pipe.hmset(STREAM_KEY, {"seeded": now, "alive": now})
+            pipe.execute()
+        except RedisError as e:
+            LOG.error(str(e))
+        return len(apps), len(deployments)
+
+    def cached_apps(self):
+        """
+        The `marathon.MarathonApp` of every app in redis, None when redis is away.
+        """
+        try:
+            values = self.redis.hgetall(APPS_KEY)
+        except RedisError as e:
+            LOG.error(str(e))
+            return None
+        return [MarathonApp.from_json(json.loads(value)["app"]) for value in values.values()]
+
+    def update_deployments(self, added=None, removed=None):
+        with self.lock:
+            if self.deployments is not None:
+                if added:
+                    self.deployments[added["id"]] = added
+                if removed:
+                    self.deployments.pop(removed, None)
+        try:
+            pipe = self.redis.pipeline()
+            if added:
+                pipe.hset(DEPLOYMENTS_KEY, added["id"], json.dumps(added))
+            if removed:
+                pipe.hdel(DEPLOYMENTS_KEY, removed)
+            pipe.set(DEPLOYMENTS_UPDATED_KEY, time.time())
+            pipe.execute()
+        except RedisError as e:
+            LOG.error(str(e))
+
+    def get_deployment(self, deployment_id):
+        with self.lock:
+            if self.deployments is not None:
+                return self.deployments.get(deployment_id)
+        try:
+            value = self.redis.hget(DEPLOYMENTS_KEY, deployment_id)
+        except RedisError as e:
+            LOG.error(str(e))
+            return None
+        return json.loads(value) if value else None
+
+    def apply_event(self, data):
+        """
+        Applies an event of the marathon event stream, the events the cache doesn't track are ignored.
+        """
+        handler = getattr(self, "on_{0}".format(data.get("eventType")), None)
+        if handler is not None:
+            with self.update_lock:
+                handler(data)
+
+    def cached_state(self, app_id):
+        entry = self.read(app_id)
+        return entry["app"] if entry is not None else None
+
+    def on_api_post_event(self, data):
+        definition = data["appDefinition"]
+        state = self.cached_state(definition["id"]) or {"id": definition["id"], "deployments": [], "tasks": []}
+        state.update({
+            "instances": definition.get("instances"),
+            "labels": definition.get("labels") or {},
+            "version": definition.get("version"),
+        })
+        self.write({definition["id"]: state})
+
+    def on_status_update_event(self, data):
+        state = self.cached_state(data["appId"])
+        if state is None:
+            return
+        tasks = [task for task in state["tasks"] if task["id"] != data["taskId"]]
+        if data["taskStatus"] not in TERMINAL_TASK_STATUSES:
+            tasks.append({"id": data["taskId"], "host": data.get("host"), "ports": data.get("ports") or [],
+                          "version": data.get("version")})
+        state["tasks"] = tasks
+        self.write({data["appId"]: state})
+
+    def on_app_terminated_event(self, data):
+        self.forget(data["appId"])
+
+    def on_deployment_info(self, data):
+        plan = data["plan"]
+        deployment = {"id": plan["id"], "affectedApps": deployment_apps(plan)}
+        self.update_deployments(added=deployment)
+        entries = {}
+        for app_id in deployment["affectedApps"]:
+            state = self.cached_state(app_id)
+            if state is not None and plan["id"] not in [d["id"] for d in state["deployments"]]:
+                state["deployments"].append({"id": plan["id"]})
+                entries[app_id] = state
+        self.write(entries)
+
+    def on_deployment_success(self, data):
+        deployment_id = data["id"]
+        deployment = self.get_deployment(deployment_id) or {"affectedApps": deployment_apps(data.get("plan") or {})}
+        self.update_deployments(removed=deployment_id)
+        entries = {}
+        for app_id in deployment["affectedApps"]:
+            state = self.cached_state(app_id)
+            if state is not None:
+                state["deployments"] = [d for d in state["deployments"] if d["id"] != deployment_id]
+                entries[app_id] = state
+        self.write(entries)
+
+    on_deployment_failed = on_deployment_success
+
+
+class AppMetadata(object):
+    """
+    Instances, labels and version of every app, in the memory of the monitor.
+
+    It's filled from one listing of the apps and kept current from the events,
+    so the handlers of the monitor never ask marathon or redis about an app.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.apps = {}
+
+    @staticmethod
+    def metadata(definition):
+        return {
+            "instances": definition.get("instances"),
+            "labels": definition.get("labels") or {},
+            "version": definition.get("version"),
+        }
+
+    def bootstrap(self, apps):
+        """
+        :param apps: the `marathon.MarathonApp` listed by marathon
+        """
+        apps = dict((app.id, {"instances": app.instances, "labels": app.labels or {}, "version": app.version})
+                    for app in apps)
+        with self.lock:
+            self.apps = apps
+
+    def get(self, app_id):
+        """
+        :returns: ``{"instances": ..., "labels": ..., "version": ...}`` or None for an unknown app
+        """
+        with self.lock:
+            return self.apps.get(app_id)
+
+    def apply_event(self, data):
+        event_type = data.get("eventType")
+        if event_type == "api_post_event":
+            definitions = [data["appDefinition"]]
+        elif event_type == "deployment_info":
+            definitions = group_apps((data.get("plan") or {}).get("target") or {})
+        elif event_type == "app_terminated_event":
+            with self.lock:
+                self.apps.pop(data["appId"], None)
+            return
+        else:
+            return
+        with self.lock:
+            for definition in definitions:
+                self.apps[definition["id"]] = self.metadata(definition)
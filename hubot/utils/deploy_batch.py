@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk deploys of many apps, for the admin actions.
+
+The app definitions are put to marathon with ``PUT /v2/apps``, a chunk of
+``settings.MARATHON_BULK_SIZE`` apps at a time, so marathon runs one deployment
+for a whole chunk instead of one per app. The depends are put before the apps
+using them, and inside a chunk marathon orders them by the ``dependencies`` of
+the definitions. A chunk refused because one of its apps is locked by another
+deployment is split in halves put one after the other, down to the app at
+fault. The deployments of a bulk deploy are recorded as one batch in redis,
+checked by a single task once they had the time to finish.
+"""
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.utils import timezone
+from marathon import MarathonError
+from marathon.exceptions import MarathonHttpError
+from redis.exceptions import RedisError
+
+from api.utils import client
+from hubot.utils.mesos import app_states, get_spec_hash, marathon
+from hubot.utils.metrics import marathon_deploys
+
+
+LOG = logging.getLogger(__name__)
+
+
+BATCH_KEY = "deploy_batch:{0}"
+BATCH_TIMEOUT = 60 * 60 * 24
+
+
+class BulkResult(namedtuple("BulkResult", ["batch_id", "deployed", "skipped", "failed"])):
+
+    def describe(self, action):
+        return "{0} apps {1} in batch {2}, {3} skipped, {4} failed".format(
+            self.deployed, action, self.batch_id, self.skipped, self.failed)
+
+
+def get_depends(obj):
+    depend = getattr(obj, "depend", None)
+    return [depend.real_addon] if depend else []
+
+
+def sort_by_depends(objs):
+    """
+    Drops the duplicated apps and puts every app after its depends.
+    """
+    apps = OrderedDict((obj.marathon_app_id, obj) for obj in objs)
+    ordered = []
+    seen = set()
+
+    def visit(obj):
+        if obj.marathon_app_id in seen:
+            return
+        seen.add(obj.marathon_app_id)
+        for depend in get_depends(obj):
+            if depend.marathon_app_id in apps:
+                visit(apps[depend.marathon_app_id])
+        ordered.append(obj)
+
+    for obj in apps.values():
+        visit(obj)
+    return ordered
+
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def create_batch(action, deployment_ids):
+    batch_id = uuid.uuid4().hex
+    try:
+        key = BATCH_KEY.format(batch_id)
+        client.hmset(key, {"action": action, "deployments": json.dumps(deployment_ids), "created": time.time()})
+        client.expire(key, BATCH_TIMEOUT)
+    except RedisError as e:
+        LOG.error(str(e))
+        return None
+    return batch_id
+
+
+def get_batch(batch_id):
+    """
+    :returns: ``{"action": "deploy" or "suspend", "deployments": [deployment id, ...]}`` or None
+    """
+    try:
+        batch = client.hgetall(BATCH_KEY.format(batch_id))
+    except RedisError as e:
+        LOG.error(str(e))
+        return None
+    if not batch:
+        return None
+    return {"action": batch["action"], "deployments": json.loads(batch["deployments"])}
+
+
+def put_chunk(chunk, force=False):
+    """
+    Puts a chunk of entries, split in halves while marathon refuses it with a conflict.
+
+    :returns: ``([(entries, result of the put), ...], failed entries)``
+    """
+    try:
+        return [(chunk, marathon.update_apps([definition for obj, definition, spec_hash in chunk], force=force))], []
+    except MarathonError as e:
+        LOG.error(str(e))
+        # a 409 tells an app of the chunk is locked by a deployment, the others may go on
+        if len(chunk) == 1 or not (isinstance(e, MarathonHttpError) and e.status_code == 409):
+            return [], chunk
+    half = len(chunk) // 2
+    first, first_failed = put_chunk(chunk[:half], force=force)
+    second, second_failed = put_chunk(chunk[half:], force=force)
+    return first + second, first_failed + second_failed
+
+
+def submit(action, entries, force=False):
+    """
+    Puts ``entries``, a list of ``(obj, app definition, spec hash)``, and records their deployments as a batch.
+    """
+    from hubot.tasks import check_deploy_batch
+    from projects.models import ProjectRelease
+
+    deployment_ids = []
+    deployed = failed = 0
+    puts = []
+    for chunk in chunked(entries, settings.MARATHON_BULK_SIZE):
+        accepted, refused = put_chunk(chunk, force=force)
+        puts.extend(accepted)
+        failed += len(refused)
+
+    for chunk, result in puts:
+        deployment_ids.append(result["deploymentId"])
+        for obj, definition, spec_hash in chunk:
+            app_states.forget(obj.marathon_app_id)
+            if action == "deploy":
+                obj.status = ProjectRelease.STATUS.Staging
+                obj.deployed_at = timezone.now()
+                marathon_deploys.inc("applied")
+            obj.m_version = result["version"]
+            obj.deployment_id = result["deploymentId"]
+            obj.spec_hash = spec_hash
+            obj.save()
+            if hasattr(obj, "clear_other_spec_hashes"):
+                obj.clear_other_spec_hashes()
+        deployed += len(chunk)
+
+    batch_id = None
+    if deployment_ids:
+        batch_id = create_batch(action, deployment_ids)
+        if batch_id:
+            check_deploy_batch.apply_async(args=[batch_id], countdown=settings.TIMEOUT_FOR_STATUS_FINISHED)
+    return batch_id, deployed, failed
+
+
+def bulk_deploy(objs, force=False):
+    """
+    Deploys the releases or addons ``objs`` in a few deployments, the unchanged apps are skipped.
+
+    :rtype: `hubot.utils.deploy_batch.BulkResult`
+    """
+    entries = []
+    skipped = 0
+    objs = sort_by_depends(objs)
+    app_ids = set(obj.marathon_app_id for obj in objs)
+    for obj in objs:
+        marathon_app = obj.get_marathon_app()
+        spec_hash = get_spec_hash(obj.marathon_app_id, marathon_app)
+        if not force and spec_hash == obj.spec_hash:
+            try:
+                app_states.get_app(obj.marathon_app_id)
+            except Exception as e:
+                LOG.error(e)
+            else:
+                marathon_deploys.inc("skipped")
+                skipped += 1
+                continue
+
+        definition = json.loads(marathon_app.to_json())
+        definition["id"] = obj.marathon_app_id
+        depends = [depend.marathon_app_id for depend in get_depends(obj) if depend.marathon_app_id in app_ids]
+        if depends:
+            definition["dependencies"] = sorted(set(definition.get("dependencies", []) + depends))
+        entries.append((obj, definition, spec_hash))
+
+    batch_id, deployed, failed = submit("deploy", entries, force=force)
+    return BulkResult(batch_id, deployed, skipped, failed)
+
+
+def bulk_suspend(objs, force=False):
+    """
+    Scales the releases or addons ``objs`` to 0 in a few deployments, the apps using a depend go first.
+
+    :rtype: `hubot.utils.deploy_batch.BulkResult`
+    """
+    entries = []
+    skipped = 0
+    for obj in reversed(sort_by_depends(objs)):
+        try:
+            app_states.get_app(obj.marathon_app_id)
+        except Exception as e:
+            LOG.error(e)
+            skipped += 1
+            continue
+        entries.append((obj, {"id": obj.marathon_app_id, "instances": 0}, ""))
+
+    batch_id, deployed, failed = submit("suspend", entries, force=force)
+    return BulkResult(batch_id, deployed, skipped, failed)
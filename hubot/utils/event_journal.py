@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only journal of the marathon events read by the monitor.
+
+Every event is appended as read from the stream, before it's handled, so the
+events of a crash or of a bug can be handled again with
+``manage.py marathon_monitor --replay <offset>``. A recorded journal is also a
+fixture for the throughput of the handlers: replaying it reports events/s.
+
+The journal is split in segments of ``segment_size`` bytes, named after the
+offset of their first record, the oldest are deleted past ``max_segments``.
+A record is the length of the event on 4 bytes then the event, its offset is
+the position of the record in the whole journal. The segments are read
+through ``mmap``, a record cut by a crash ends the reading.
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+
+
+LOG = logging.getLogger(__name__)
+
+
+HEADER = struct.Struct(">I")
+SEGMENT_SUFFIX = ".log"
+
+
+class EventJournal(object):
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, max_segments=16):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.file = None
+        self.base_offset = None
+
+    def segments(self):
+        """
+        Base offsets of the segments, oldest first.
+        """
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+
+    def segment_path(self, base_offset):
+        return os.path.join(self.directory, "{0:020d}{1}".format(base_offset, SEGMENT_SUFFIX))
+
+    def end_offset(self):
+        """
+        Offset the next record will be written at.
+        """
+        segments = self.segments()
+        if not segments:
+            return 0
+        end = segments[-1]
+        for offset, data in self.read_segment(segments[-1], segments[-1]):
+            end = offset + HEADER.size + len(data)
+        return end
+
+    def append(self, data):
+        """
+        Writes the raw event ``data`` and returns its offset.
+        """
+        with self.lock:
+            if self.file is None:
+                segments = self.segments()
+                end = self.end_offset()
+                self.base_offset = segments[-1] if segments else 0
+                self.file = open(self.segment_path(self.base_offset), "r+b" if segments else "wb")
+                # a record cut by a crash is written over
+                self.file.truncate(end - self.base_offset)
+                self.file.seek(0, os.SEEK_END)
+            elif self.file.tell() >= self.segment_size:
+                self.roll()
+
+            offset = self.base_offset + self.file.tell()
+            self.file.write(HEADER.pack(len(data)) + data)
+            self.file.flush()
+            return offset
+
+    def roll(self):
+        offset = self.base_offset + self.file.tell()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = open(self.segment_path(offset), "wb")
+        self.base_offset = offset
+        for base_offset in self.segments()[:-self.max_segments]:
+            os.remove(self.segment_path(base_offset))
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+
+    def read_segment(self, base_offset, start):
+        """
+        Yields ``(offset, data)`` of the records of a segment from ``start``.
+        """
+        with open(self.segment_path(base_offset), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return
+            view = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                position = start - base_offset
+                while position + HEADER.size <= size:
+                    length, = HEADER.unpack_from(view, position)
+                    end = position + HEADER.size + length
+                    if end > size:
+                        LOG.warning("Record at {0} is cut, the journal ends there".format(base_offset + position))
+                        return
+                    yield base_offset + position, view[position + HEADER.size:end]
+                    position = end
+            finally:
+                view.close()
+
+    def is_boundary(self, offset):
+        """
+        True when a record starts at ``offset``, or it's the end of the journal or before its first kept segment.
+        """
+        segments = [base_offset for base_offset in self.segments() if base_offset <= offset]
+        if not segments:
+            return True
+        end = segments[-1]
+        for position, data in self.read_segment(segments[-1], segments[-1]):
+            if position >= offset:
+                return position == offset
+            end = position + HEADER.size + len(data)
+        return end == offset
+
+    def read(self, start=0):
+        """
+        Yields ``(offset, data)`` of the records from offset ``start``, the first kept one when it was deleted.
+        """
+        segments = self.segments()
+        for i, base_offset in enumerate(segments):
+            next_offset = segments[i + 1] if i + 1 < len(segments) else None
+            if next_offset is not None and next_offset <= start:
+                continue
+            for record in self.read_segment(base_offset, max(start, base_offset)):
+                yield record
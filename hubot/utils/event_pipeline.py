@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Worker threads handling the marathon events read by the monitor.
+
+The reader only parses the stream and puts every event in the queue of a
+worker, chosen by a hash of the app the event is about, so the events of an
+app are handled one after the other, in the order marathon sent them. The
+queues are bounded: when a worker falls behind, the reader waits for room in
+its queue and stops reading the stream instead of dropping events.
+
+The queue depths, the age of the last event read and the time the reader was
+blocked are kept in `hubot.utils.metrics`, the monitor serves them with
+`serve_metrics`.
+"""
+import logging
+import threading
+import time
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime
+from Queue import Queue
+
+from hubot.utils.metrics import expose_metrics, monitor_blocked_seconds, monitor_event_seconds, \
+    monitor_queue_depth, monitor_reader_lag_seconds
+from hubot.utils.waiter import event_apps
+
+
+LOG = logging.getLogger(__name__)
+
+
+def event_age(data):
+    """
+    Seconds since marathon sent the event, None when it has no timestamp.
+    """
+    try:
+        sent = datetime.strptime(data["timestamp"], "%Y-%m-%dT%H:%M:%S.%fZ")
+    except (KeyError, TypeError, ValueError):
+        return None
+    return (datetime.utcnow() - sent).total_seconds()
+
+
+def app_partition(data, count):
+    """
+    Partition out of ``count`` of the app an event is about, the events without app go to the first one.
+    """
+    app_ids = event_apps(data)
+    key = app_ids[0] if app_ids else ""
+    return (zlib.crc32(key.encode("utf-8")) & 0xffffffff) % count
+
+
+class EventPipeline(object):
+
+    def __init__(self, handler, workers=4, queue_size=1000):
+        """
+        :param handler: ``handler(data)`` called in a worker thread for every event
+        :param int queue_size: events waiting for the workers, split evenly between them
+        """
+        self.handler = handler
+        self.queues = [Queue(maxsize=max(queue_size // workers, 1)) for _ in range(workers)]
+        self.threads = []
+
+    def partition(self, data):
+        return app_partition(data, len(self.queues))
+
+    def start(self):
+        for i, queue in enumerate(self.queues):
+            thread = threading.Thread(target=self.work, args=[i, queue], name="marathon-events-{0}".format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+        """
+        Lets the workers handle the events already queued, then stops them.
+        """
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def put(self, data):
+        """
+        Queues an event, waits while the queue of its worker is full.
+        """
+        age = event_age(data)
+        if age is not None:
+            monitor_reader_lag_seconds.set(age)
+
+        i = self.partition(data)
+        queue = self.queues[i]
+        received = time.time()
+        full = queue.full()
+        queue.put((received, data))
+        if full:
+            monitor_blocked_seconds.inc(amount=time.time() - received)
+        monitor_queue_depth.set(queue.qsize(), i)
+
+    def work(self, i, queue):
+        while True:
+            item = queue.get()
+            monitor_queue_depth.set(queue.qsize(), i)
+            if item is None:
+                return
+            received, data = item
+            try:
+                self.handler(data)
+            except Exception:
+                LOG.exception("Failed to handle {0}".format(data.get("eventType")))
+            monitor_event_seconds.observe(time.time() - received, data.get("eventType"))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = expose_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_metrics(port, host="0.0.0.0"):
+    """
+    Serves the metrics of the process on ``port`` from a thread.
+    """
+    server = HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics")
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+In-process stand-in of a marathon server, for integration tests and benchmarks.
+
+It keeps the apps and deployments in memory and answers the part of the REST
+API this project uses: ``/v2/apps``, ``/v2/deployments``, ``/v2/groups`` and
+the ``/v2/events`` stream. A deployment lasts ``deployment_duration`` seconds,
+then its tasks are started or killed and the events marathon would send are
+published. Every request waits ``latency`` seconds, and ``conflict_rate`` of
+the changes are refused with a 409 as if a deployment held the app.
+
+Run it in a thread with `FakeMarathonServer` or as ``manage.py fake_marathon``,
+and point ``MARATHON_SERVERS`` at its url.
+"""
+import json
+import random
+import socket
+import threading
+import time
+import urlparse
+import uuid
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime
+from Queue import Empty, Queue
+from SocketServer import ThreadingMixIn
+
+
+def timestamp():
+    return datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+class Conflict(Exception):
+    pass
+
+
+class NotFound(Exception):
+    pass
+
+
+class FakeMarathon(object):
+    """
+    The apps, deployments and event subscribers of the fake server.
+    """
+
+    def __init__(self, latency=0, conflict_rate=0, deployment_duration=0, seed=None):
+        self.latency = latency
+        self.conflict_rate = conflict_rate
+        self.deployment_duration = deployment_duration
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.apps = {}
+        self.deployments = {}
+        self.subscribers = []
+        self.requests = []
+
+    def publish(self, event_type, **data):
+        data.update(eventType=event_type, timestamp=timestamp())
+        for queue in list(self.subscribers):
+            queue.put(data)
+
+    def subscribe(self):
+        queue = Queue()
+        self.subscribers.append(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.remove(queue)
+
+    def get_app(self, app_id, embed_tasks=False):
+        with self.lock:
+            if app_id not in self.apps:
+                raise NotFound(u"App '{0}' does not exist".format(app_id))
+            app = dict(self.apps[app_id])
+            app["deployments"] = [{"id": deployment["id"]} for deployment in self.deployments.values()
+                                  if app_id in deployment["affectedApps"]]
+            app["tasksRunning"] = len(app["tasks"])
+            if not embed_tasks:
+                app.pop("tasks")
+            return app
+
+    def list_apps(self, embed_tasks=False):
+        with self.lock:
+            return [self.get_app(app_id, embed_tasks) for app_id in sorted(self.apps)]
+
+    def check_conflict(self, app_ids, force):
+        if self.conflict_rate and self.random.random() < self.conflict_rate:
+            raise Conflict(u"App is locked by one or more deployments.")
+        if force:
+            return
+        for deployment in self.deployments.values():
+            if set(app_ids) & set(deployment["affectedApps"]):
+                raise Conflict(u"App is locked by one or more deployments.")
+
+    def deploy(self, definitions, force=False, remove=False):
+        """
+        Starts one deployment for ``definitions``, ``{app id: changed fields}``.
+        """
+        with self.lock:
+            self.check_conflict(definitions, force)
+            version = timestamp()
+            deployment = {
+                "id": str(uuid.uuid4()),
+                "version": version,
+                "affectedApps": sorted(definitions),
+                "currentStep": 1,
+                "totalSteps": 1,
+                "steps": [[{"action": "StopApplication" if remove else "ScaleApplication", "app": app_id}
+                           for app_id in sorted(definitions)]],
+                "currentActions": [],
+            }
+            for app_id, definition in definitions.items():
+                if remove:
+                    continue
+                app = self.apps.setdefault(app_id, {"id": app_id, "instances": 1, "labels": {}, "tasks": []})
+                app.update(definition)
+                app.update(id=app_id, version=version)
+                self.publish("api_post_event", appDefinition=dict((k, v) for k, v in app.items() if k != "tasks"))
+            self.deployments[deployment["id"]] = deployment
+            self.publish("deployment_info", plan={"id": deployment["id"], "steps": [
+                {"actions": deployment["steps"][0]}]}, currentStep={"actions": deployment["steps"][0]})
+
+        timer = threading.Timer(self.deployment_duration, self.finish, args=[deployment["id"], remove])
+        timer.daemon = True
+        timer.start()
+        return deployment
+
+    def finish(self, deployment_id, remove=False):
+        with self.lock:
+            deployment = self.deployments.pop(deployment_id, None)
+            if deployment is None:
+                return
+            for app_id in deployment["affectedApps"]:
+                app = self.apps.get(app_id)
+                if app is None:
+                    continue
+                instances = 0 if remove else app["instances"]
+                while len(app["tasks"]) > instances:
+                    self.kill_task(app, app["tasks"][-1])
+                while len(app["tasks"]) < instances:
+                    self.start_task(app)
+                if remove:
+                    del self.apps[app_id]
+                    self.publish("app_terminated_event", appId=app_id)
+            self.publish("deployment_success", id=deployment_id, plan={"id": deployment_id})
+
+    def start_task(self, app):
+        task = {"id": "{0}.{1}".format(app["id"].strip("/").replace("/", "_"), uuid.uuid4()), "appId": app["id"],
+                "host": "127.0.0.1", "ports": [31000 + len(app["tasks"])], "version": app["version"],
+                "stagedAt": timestamp(), "startedAt": timestamp()}
+        app["tasks"].append(task)
+        self.publish("status_update_event", appId=app["id"], taskId=task["id"], taskStatus="TASK_RUNNING",
+                     host=task["host"], ports=task["ports"], version=app["version"], slaveId="fake")
+
+    def kill_task(self, app, task):
+        app["tasks"].remove(task)
+        self.publish("status_update_event", appId=app["id"], taskId=task["id"], taskStatus="TASK_KILLED",
+                     host=task["host"], ports=task["ports"], version=task["version"], slaveId="fake")
+
+    def rollback(self, deployment_id):
+        with self.lock:
+            deployment = self.deployments.pop(deployment_id, None)
+            if deployment is None:
+                raise NotFound(u"DeploymentPlan {0} does not exist".format(deployment_id))
+            self.publish("deployment_failed", id=deployment_id, plan={"id": deployment_id})
+            return self.deploy(dict((app_id, {}) for app_id in deployment["affectedApps"] if app_id in self.apps),
+                               force=True)
+
+
+class FakeMarathonHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+
+    @property
+    def marathon(self):
+        return self.server.marathon
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def route(self, method):
+        url = urlparse.urlparse(self.path)
+        path = "/" + url.path.strip("/")
+        params = dict(urlparse.parse_qsl(url.query))
+        force = params.get("force", "").lower() == "true"
+        self.marathon.requests.append((method, path))
+
+        if path == "/v2/events":
+            return self.stream_events()
+        time.sleep(self.marathon.latency)
+
+        if path == "/v2/apps":
+            if method == "GET":
+                return 200, {"apps": self.marathon.list_apps(params.get("embed") == "apps.tasks")}
+            if method == "POST":
+                definition = self.read_json()
+                app_id = "/" + definition["id"].strip("/")
+                with self.marathon.lock:
+                    if app_id in self.marathon.apps:
+                        return 409, {"message": u"An app with id [{0}] already exists.".format(app_id)}
+                    self.marathon.deploy({app_id: definition})
+                    return 201, self.marathon.get_app(app_id)
+            if method == "PUT":
+                definitions = dict(("/" + app["id"].strip("/"), app) for app in self.read_json())
+                deployment = self.marathon.deploy(definitions, force=force)
+                return 200, {"version": deployment["version"], "deploymentId": deployment["id"]}
+
+        elif path.startswith("/v2/apps/"):
+            app_id = "/" + path[len("/v2/apps/"):].strip("/")
+            if method == "GET":
+                return 200, {"app": self.marathon.get_app(app_id, params.get("embed") == "apps.tasks")}
+            if method == "PUT":
+                deployment = self.marathon.deploy({app_id: self.read_json()}, force=force)
+                return 200, {"version": deployment["version"], "deploymentId": deployment["id"]}
+            if method == "DELETE":
+                self.marathon.get_app(app_id)
+                deployment = self.marathon.deploy({app_id: {}}, force=force, remove=True)
+                return 200, {"version": deployment["version"], "deploymentId": deployment["id"]}
+
+        elif path == "/v2/deployments" and method == "GET":
+            return 200, sorted(self.marathon.deployments.values(), key=lambda deployment: deployment["version"])
+
+        elif path.startswith("/v2/deployments/") and method == "DELETE":
+            deployment = self.marathon.rollback(path[len("/v2/deployments/"):])
+            return 200, {"version": deployment["version"], "deploymentId": deployment["id"]}
+
+        elif path.startswith("/v2/groups"):
+            group_id = path[len("/v2/groups"):] or "/"
+            if method == "GET":
+                apps = [app for app in self.marathon.list_apps() if app["id"].startswith(group_id.rstrip("/") + "/")]
+                return 200, {"id": group_id, "apps": apps, "groups": [], "dependencies": []}
+            if method == "PUT":
+                definitions = dict(("/".join([group_id.rstrip("/"), app["id"].strip("/")]), app)
+                                   for app in self.read_json().get("apps", []))
+                deployment = self.marathon.deploy(definitions, force=force)
+                return 200, {"version": deployment["version"], "deploymentId": deployment["id"]}
+
+        return 404, {"message": u"Not found: {0} {1}".format(method, path)}
+
+    def handle_method(self, method):
+        try:
+            response = self.route(method)
+        except NotFound as e:
+            response = 404, {"message": unicode(e)}
+        except Conflict as e:
+            response = 409, {"message": unicode(e)}
+        if response is not None:
+            self.send_json(*response)
+
+    def do_GET(self):
+        self.handle_method("GET")
+
+    def do_POST(self):
+        self.handle_method("POST")
+
+    def do_PUT(self):
+        self.handle_method("PUT")
+
+    def do_DELETE(self):
+        self.handle_method("DELETE")
+
+    def stream_events(self):
+        self.close_connection = 1
+        queue = self.marathon.subscribe()
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            self.wfile.flush()
+            while not self.server.stopped.is_set():
+                try:
+                    event = queue.get(timeout=0.2)
+                except Empty:
+                    continue
+                self.wfile.write("event: {0}\r\ndata: {1}\r\n\r\n".format(event["eventType"], json.dumps(event)))
+                self.wfile.flush()
+        except IOError:
+            pass
+        finally:
+            self.marathon.unsubscribe(queue)
+
+
+class FakeMarathonServer(ThreadingMixIn, HTTPServer):
+    """
+    ``with FakeMarathonServer(latency=0.01) as server:`` serves on a free port in a thread, see ``server.url``.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, **kwargs):
+        HTTPServer.__init__(self, (host, port), FakeMarathonHandler)
+        self.marathon = FakeMarathon(**kwargs)
+        self.stopped = threading.Event()
+        self.connections = set()
+
+    def process_request(self, request, client_address):
+        self.connections.add(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        self.connections.discard(request)
+        HTTPServer.shutdown_request(self, request)
+
+    @property
+    def url(self):
+        return "http://{0}:{1}".format(*self.server_address)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.shutdown()
+        self.server_close()
+        # ends the connections kept alive by the clients, their threads would outlive the server
+        for request in list(self.connections):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def handle_error(self, request, client_address):
+        # the connections kept alive by the clients break when the server stops
+        if not self.stopped.is_set():
+            HTTPServer.handle_error(self, request, client_address)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
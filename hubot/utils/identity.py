@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Request scoped identity map.
+
+Inside one scope (a chat request, a batch of commands or a celery task) every row
+is loaded at most once and the same python object is handed out for it, so a
+change made by one command is seen by the next one without another query.
+"""
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+
+_local = threading.local()
+
+
+def model_key(model):
+    # children of a multi-table inheritance share the identity of their root model
+    parents = list(model._meta.get_parent_list())
+    root = parents[-1] if parents else model
+    return root._meta.app_label, root._meta.model_name
+
+
+class IdentityMap(object):
+
+    def __init__(self):
+        self.objects = {}
+        self.lookups = {}
+
+    @staticmethod
+    def object_key(model, pk):
+        return model_key(model), unicode(pk)
+
+    @staticmethod
+    def lookup_key(model, lookup):
+        return model_key(model), frozenset(lookup.items())
+
+    def get(self, model, pk):
+        return self.objects.get(self.object_key(model, pk))
+
+    def lookup(self, model, **lookup):
+        """
+        Returns the object registered with ``lookup``, eg. ``lookup(Project, user_id=1, name="demo")``.
+        """
+        key = self.lookups.get(self.lookup_key(model, lookup))
+        if key is None:
+            return None
+        return self.objects.get(key)
+
+    def add(self, obj, **lookup):
+        key = self.object_key(type(obj), obj.pk)
+        self.objects[key] = obj
+        if lookup:
+            self.lookups[self.lookup_key(type(obj), lookup)] = key
+        return obj
+
+    def forget(self, obj):
+        # matched by identity, a deleted object has already lost its pk
+        for key, value in self.objects.items():
+            if value is obj:
+                del self.objects[key]
+                for lookup, target in self.lookups.items():
+                    if target == key:
+                        del self.lookups[lookup]
+
+    def clear(self):
+        self.objects.clear()
+        self.lookups.clear()
+
+
+def current_identity_map():
+    """
+    :rtype: `hubot.utils.identity.IdentityMap` or None outside of a scope
+    """
+    return getattr(_local, "identity_map", None)
+
+
+@contextmanager
+def identity_map():
+    """
+    Opens a scope, nested scopes share the map of the outermost one.
+    """
+    current = current_identity_map()
+    if current is not None:
+        yield current
+        return
+
+    _local.identity_map = IdentityMap()
+    try:
+        yield _local.identity_map
+    finally:
+        _local.identity_map = None
+
+
+def identity_scoped(func):
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with identity_map():
+            return func(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Marathon client on a pooled keep-alive session.
+
+`marathon.MarathonClient` sends every request with ``requests.request``, so a
+new connection is opened for each call and the TLS setting can only be changed
+process wide. Here the requests go through one ``requests.Session`` owned by
+the client, spread round-robin over the servers, and a server that can't be
+reached is left aside for a while.
+"""
+import json
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from marathon import MarathonClient
+from marathon.exceptions import InternalServerError, MarathonError, MarathonHttpError, NotFoundError
+
+
+LOG = logging.getLogger(__name__)
+
+
+class PooledMarathonClient(MarathonClient):
+
+    def __init__(self, servers, username=None, password=None, timeout=10, verify=True, pool_maxsize=10,
+                 retry_after=30):
+        """
+        :param bool verify: TLS verification of this client only
+        :param int pool_maxsize: keep-alive connections kept for each server
+        :param int retry_after: seconds a server that can't be reached is skipped
+        """
+        super(PooledMarathonClient, self).__init__(servers, username=username, password=password, timeout=timeout)
+        self.verify = verify
+        self.retry_after = retry_after
+
+        self.session = requests.Session()
+        self.session.verify = verify
+        self.session.auth = self.auth
+        self.session.headers.update({'Content-Type': 'application/json', 'Accept': 'application/json'})
+        adapter = HTTPAdapter(pool_connections=len(self.servers), pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.lock = threading.Lock()
+        self.next_server = 0
+        self.down_until = {}
+
+    def get_servers(self):
+        """
+        Servers to try in order: the healthy ones round-robin, then the ones marked down.
+        """
+        with self.lock:
+            start = self.next_server
+            self.next_server = (self.next_server + 1) % len(self.servers)
+        servers = self.servers[start:] + self.servers[:start]
+        now = time.time()
+        healthy = [server for server in servers if self.down_until.get(server, 0) <= now]
+        return healthy + [server for server in servers if server not in healthy]
+
+    def mark_down(self, server):
+        self.down_until[server] = time.time() + self.retry_after
+
+    def mark_up(self, server):
+        self.down_until.pop(server, None)
+
+    def _do_request(self, method, path, params=None, data=None):
+        response = None
+        for server in self.get_servers():
+            url = ''.join([server.rstrip('/'), path])
+            try:
+                response = self.session.request(method, url, params=params, data=data, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                LOG.error('Error while calling %s: %s', url, e)
+                self.mark_down(server)
+                continue
+            self.mark_up(server)
+            break
+
+        if response is None:
+            raise MarathonError('No remaining Marathon servers to try')
+
+        if response.status_code >= 400:
+            LOG.error('Got HTTP {code}: {body}'.format(code=response.status_code, body=response.text))
+            if response.status_code >= 500:
+                raise InternalServerError(response)
+            elif response.status_code == 404:
+                raise NotFoundError(response)
+            raise MarathonHttpError(response)
+
+        return response
+
+    def update_apps(self, apps, force=False):
+        """
+        Puts many app definitions at once, marathon creates the missing apps and runs one deployment for all.
+
+        :param list[dict] apps: app definitions, with their ``id``
+        :returns: a dict containing the deployment id and version
+        :rtype: dict
+        """
+        response = self._do_request('PUT', '/v2/apps', params={'force': force}, data=json.dumps(apps))
+        return response.json()
+
+    def _do_sse_request(self, path, params=None, data=None):
+        from sseclient import SSEClient
+
+        headers = {'Accept': 'text/event-stream'}
+        for server in self.get_servers():
+            url = ''.join([server.rstrip('/'), path])
+            try:
+                return SSEClient(url, params=params, data=data, headers=headers, auth=self.auth, verify=self.verify)
+            except Exception as e:
+                LOG.error('Error while calling %s: %s', url, e)
+                self.mark_down(server)
+
+        raise MarathonError('No remaining Marathon servers to try')
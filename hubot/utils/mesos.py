@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import logging
 import os.path
 
-import time
 from django.conf import settings
+from django.utils import timezone
 from django.utils.functional import SimpleLazyObject
-from marathon import MarathonApp, MarathonClient, MarathonHttpError
+from marathon import MarathonApp
+from marathon.exceptions import NotFoundError
 from marathon.models.container import MarathonContainerVolume, MarathonDockerContainer, MarathonContainer
+from api.utils import client
+from hubot.utils.app_state import AppStateCache
+from hubot.utils.metrics import TimedProxy, marathon_deploys
+from hubot.utils.tracing import TracedMarathonClient
+from hubot.utils.waiter import wait_for
 
 LOG = logging.getLogger(__name__)
 
@@ -144,20 +151,41 @@ class MarathonAppMixin(object):
                            health_checks=self.get_health_checks())
 
 
-def create_or_update_marathon_app(obj, force=False):
+def get_spec_hash(app_id, marathon_app):
+    """
+    Digest of an app definition, ``to_json`` drops the empty values and sorts the keys.
+    """
+    return hashlib.sha1("{0}\n{1}".format(app_id, marathon_app.to_json())).hexdigest()
+
+
+def create_or_update_marathon_app(obj, force=False, bypass_cache=False):
+    """
+    Returns False when the app runs the same definition already and nothing was put to marathon.
+    """
+    marathon_app = obj.get_marathon_app()
+    spec_hash = get_spec_hash(obj.marathon_app_id, marathon_app)
     try:
-        app = marathon.get_app(obj.marathon_app_id)
+        app = app_states.get_app(obj.marathon_app_id, bypass=bypass_cache)
     except Exception as e:
         LOG.error(e)
         app = None
+    if app and not force and spec_hash == getattr(obj, "spec_hash", None):
+        LOG.info("App {0} is unchanged, skip the update".format(obj.marathon_app_id))
+        marathon_deploys.inc("skipped")
+        return False
     if not app:
-        app = marathon.create_app(obj.marathon_app_id, obj.get_marathon_app())
+        app = marathon.create_app(obj.marathon_app_id, marathon_app)
     else:
-        app = marathon.update_app(obj.marathon_app_id, obj.get_marathon_app(), force=force)
+        app = marathon.update_app(obj.marathon_app_id, marathon_app, force=force)
+    # the monitor stores the new definition when marathon posts it
+    app_states.forget(obj.marathon_app_id)
+    marathon_deploys.inc("applied")
 
     if hasattr(obj, "m_version") and hasattr(obj, "deployment_id"):
         from projects.models import ProjectRelease
         obj.status = ProjectRelease.STATUS.Staging
+        obj.spec_hash = spec_hash
+        obj.deployed_at = timezone.now()
         if isinstance(app, dict):
             obj.m_version = app['version']
             obj.deployment_id = app['deploymentId']
@@ -165,49 +193,57 @@ def create_or_update_marathon_app(obj, force=False):
             obj.m_version = app.version
             obj.deployment_id = app.deployments[0].id
         obj.save()
-    if hasattr(obj, "check_status_after"):
-        obj.check_status_after(settings.TIMEOUT_FOR_STATUS_FINISHED)
+    if hasattr(obj, "clear_other_spec_hashes"):
+        obj.clear_other_spec_hashes()
 
-    return None
+    return True
 
 
-def destroy_marathon_app(obj, run_async=True):
+def destroy_marathon_app(obj, run_async=True, bypass_cache=False):
     try:
-        marathon.get_app(obj.marathon_app_id)
+        app_states.get_app(obj.marathon_app_id, bypass=bypass_cache)
     except Exception as e:
         LOG.error(e)
     else:
-        marathon.delete_app(obj.marathon_app_id)
-        if not run_async:
-            while True:
-                try:
-                    marathon.get_app(obj.marathon_app_id)
-                except MarathonHttpError as e:
-                    if str(e).find("404") != -1:
-                        return
-                time.sleep(1)
-                continue
+        try:
+            marathon.delete_app(obj.marathon_app_id)
+        except NotFoundError as e:
+            # the cache may still hold an app removed meanwhile
+            LOG.error(e)
+            app_states.forget(obj.marathon_app_id)
+            return None
+        app_states.forget(obj.marathon_app_id)
+        if not run_async and not wait_app_removed(obj.marathon_app_id):
+            LOG.error("App {0} is still there after {1} seconds".format(
+                obj.marathon_app_id, settings.MARATHON_WAIT_TIMEOUT))
 
     return None
 
 
-def suspend_marathon_app(obj, run_async=True):
+def suspend_marathon_app(obj, run_async=True, bypass_cache=False):
     try:
-        marathon.get_app(obj.marathon_app_id)
+        app_states.get_app(obj.marathon_app_id, bypass=bypass_cache)
     except Exception as e:
         LOG.error(e)
     else:
-        app = marathon.scale_app(obj.marathon_app_id, instances=0)
+        try:
+            app = marathon.scale_app(obj.marathon_app_id, instances=0)
+        except NotFoundError as e:
+            LOG.error(e)
+            app_states.forget(obj.marathon_app_id)
+            return None
+        app_states.forget(obj.marathon_app_id)
         if hasattr(obj, "m_version") and hasattr(obj, "deployment_id"):
             obj.m_version = app['version']
             obj.deployment_id = app['deploymentId']
+            # marathon no longer runs the stored definition
+            obj.spec_hash = ""
             obj.save()
-        if not run_async:
-            app = marathon.get_app(obj.marathon_app_id)
-            while app.instances != 0:
-                time.sleep(1)
-                app = marathon.get_app(obj.marathon_app_id)
-                continue
+        if hasattr(obj, "clear_other_spec_hashes"):
+            obj.clear_other_spec_hashes()
+        if not run_async and not wait_app_suspended(obj.marathon_app_id):
+            LOG.error("App {0} still has tasks after {1} seconds".format(
+                obj.marathon_app_id, settings.MARATHON_WAIT_TIMEOUT))
         if hasattr(obj, "check_suspend"):
             obj.check_suspend()
 
@@ -215,24 +251,50 @@ def suspend_marathon_app(obj, run_async=True):
 
 
 def get_marathon_client():
+    return TracedMarathonClient(settings.MARATHON_SERVERS,
+                                username=settings.MARATHON_USERNAME,
+                                password=settings.MARATHON_PASSWORD,
+                                timeout=settings.MARATHON_TIMEOUT,
+                                verify=settings.MARATHON_VERIFY,
+                                pool_maxsize=settings.MARATHON_POOL_MAXSIZE,
+                                retry_after=settings.MARATHON_RETRY_AFTER)
+
+
+marathon = SimpleLazyObject(lambda: TimedProxy(get_marathon_client(), "marathon"))
+
+
+def get_app_state_cache():
+    return AppStateCache(marathon, client,
+                         max_age=settings.MARATHON_STATE_MAX_AGE,
+                         local_ttl=settings.MARATHON_STATE_LOCAL_TTL)
+
+
+app_states = SimpleLazyObject(get_app_state_cache)
 
-    def disable_requests_ssl_verify():
-        import requests
-        origin_request = requests.request
 
-        def request(*args, **kwargs):
-            kwargs['verify'] = False
-            return origin_request(*args, **kwargs)
-        requests.request = request
+def wait_app_removed(app_id, timeout=None):
+    """
+    Waits until marathon has removed the app, False if it's still there after ``timeout`` seconds.
+    """
 
-    disable_requests_ssl_verify()
+    def removed():
+        try:
+            app_states.get_app(app_id, local=False)
+        except NotFoundError:
+            return True
+        return False
+    return wait_for(app_id, removed, timeout=timeout or settings.MARATHON_WAIT_TIMEOUT)
 
-    return MarathonClient(settings.MARATHON_SERVERS,
-                          username=settings.MARATHON_USERNAME,
-                          password=settings.MARATHON_PASSWORD)
 
+def wait_app_suspended(app_id, timeout=None):
+    """
+    Waits until the app is scaled to 0 and its last task is gone, False if it still runs after ``timeout`` seconds.
+    """
 
-marathon = SimpleLazyObject(lambda: get_marathon_client())
+    def suspended():
+        app = app_states.get_app(app_id, local=False)
+        return app.instances == 0 and not app.tasks
+    return wait_for(app_id, suspended, timeout=timeout or settings.MARATHON_WAIT_TIMEOUT)
 
 
 def get_image_fullname(image):
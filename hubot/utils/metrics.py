@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+Latency histograms of the chat commands, exposed in the prometheus text format.
+
+A command run is split in phases: parse (docopt), validate (schema), db (django
+queries), marathon and cinder (http calls through the wrapped clients). The
+histograms live in the process, which is one gunicorn worker with the Procfile.
+The deploys counter tells the app updates applied from the ones skipped because
+the definition didn't change. The http calls to marathon are observed by
+endpoint in any process, see `hubot.utils.tracing`, and the monitor keeps the
+gauges of its event queues, see `hubot.utils.event_pipeline`.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+from django.db.backends.signals import connection_created
+from django.db.backends.utils import CursorDebugWrapper, CursorWrapper
+from django.dispatch import receiver
+
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, float("inf"))
+
+PHASES = ("parse", "validate", "db", "marathon", "cinder")
+
+
+METRICS_REGISTRY = OrderedDict()
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def format_labels(labels):
+    return u",".join(u'{0}="{1}"'.format(name, unicode(value).replace("\\", "\\\\").replace('"', '\\"'))
+                     for name, value in labels)
+
+
+class Histogram(object):
+
+    def __init__(self, name, documentation, labelnames, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts, total = self.values.get(labels) or ([0] * len(self.buckets), 0.0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[labels] = (counts, total + value)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+    def expose(self):
+        lines = [u"# HELP {0} {1}".format(self.name, self.documentation), u"# TYPE {0} histogram".format(self.name)]
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, (counts, total) in values:
+            labels = zip(self.labelnames, labels)
+            for bound, count in zip(self.buckets, counts):
+                lines.append(u"{0}_bucket{{{1}}} {2}".format(
+                    self.name, format_labels(labels + [("le", format_value(bound))]), count))
+            lines.append(u"{0}_sum{{{1}}} {2}".format(self.name, format_labels(labels), format_value(total)))
+            lines.append(u"{0}_count{{{1}}} {2}".format(self.name, format_labels(labels), counts[-1]))
+        return lines
+
+
+class Counter(object):
+
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *labels, **kwargs):
+        amount = kwargs.get("amount", 1)
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+    def expose(self):
+        lines = [u"# HELP {0} {1}".format(self.name, self.documentation), u"# TYPE {0} counter".format(self.name)]
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, count in values:
+            lines.append(u"{0}{{{1}}} {2}".format(self.name, format_labels(zip(self.labelnames, labels)), count))
+        return lines
+
+
+class Gauge(object):
+
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+    def expose(self):
+        lines = [u"# HELP {0} {1}".format(self.name, self.documentation), u"# TYPE {0} gauge".format(self.name)]
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            lines.append(u"{0}{{{1}}} {2}".format(
+                self.name, format_labels(zip(self.labelnames, labels)), format_value(value)))
+        return lines
+
+
+def register(metric):
+    METRICS_REGISTRY[metric.name] = metric
+    return metric
+
+
+def expose_metrics():
+    lines = []
+    for metric in METRICS_REGISTRY.values():
+        lines.extend(metric.expose())
+    return u"\n".join(lines) + u"\n"
+
+
+command_seconds = register(Histogram(
+    "hubot_command_seconds", "Time to run a chat command.", ["command"]))
+command_phase_seconds = register(Histogram(
+    "hubot_command_phase_seconds", "Time spent in each phase of a chat command.", ["command", "phase"]))
+marathon_deploys = register(Counter(
+    "hubot_marathon_deploys_total", "App definitions put to marathon or skipped as unchanged.", ["result"]))
+marathon_request_seconds = register(Histogram(
+    "hubot_marathon_request_seconds", "Time of the http calls to marathon.", ["method", "endpoint", "status"]))
+call_retries = register(Counter(
+    "hubot_call_retries_total", "Failed calls to marathon or cinder, retried or given up.", ["endpoint", "result"]))
+monitor_queue_depth = register(Gauge(
+    "hubot_monitor_queue_depth", "Marathon events read by the monitor and waiting for a worker.", ["worker"]))
+monitor_reader_lag_seconds = register(Gauge(
+    "hubot_monitor_reader_lag_seconds", "Age of the last marathon event read by the monitor.", []))
+monitor_blocked_seconds = register(Counter(
+    "hubot_monitor_blocked_seconds_total", "Time the monitor stopped reading because a worker queue was full.", []))
+monitor_event_seconds = register(Histogram(
+    "hubot_monitor_event_seconds", "Time from reading a marathon event to the end of its handling.", ["event_type"]))
+
+
+_local = threading.local()
+
+
+class CommandTiming(object):
+
+    def __init__(self, command):
+        self.command = command
+        self.id = uuid.uuid4().hex[:12]
+        self.phases = dict((phase, 0.0) for phase in PHASES)
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+
+def current_timing():
+    """
+    :rtype: `hubot.utils.metrics.CommandTiming` or None outside of a command
+    """
+    return getattr(_local, "timing", None)
+
+
+@contextmanager
+def command_timing(command):
+    """
+    Times a command and records its phases when it ends, nested commands add to the outermost one.
+    """
+    timing = current_timing()
+    if timing is not None:
+        yield timing
+        return
+
+    timing = _local.timing = CommandTiming(command)
+    start = time.time()
+    try:
+        yield timing
+    finally:
+        elapsed = time.time() - start
+        _local.timing = None
+
+        command_seconds.observe(elapsed, timing.command)
+        for phase, seconds in timing.phases.items():
+            command_phase_seconds.observe(seconds, timing.command, phase)
+
+
+class TimedCursorMixin(object):
+    """
+    Adds the time of the queries to the db phase of the running command.
+    """
+
+    def execute(self, sql, params=None):
+        timing = current_timing()
+        if timing is None:
+            return super(TimedCursorMixin, self).execute(sql, params)
+        with timing.phase("db"):
+            return super(TimedCursorMixin, self).execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        timing = current_timing()
+        if timing is None:
+            return super(TimedCursorMixin, self).executemany(sql, param_list)
+        with timing.phase("db"):
+            return super(TimedCursorMixin, self).executemany(sql, param_list)
+
+
+class TimedCursorWrapper(TimedCursorMixin, CursorWrapper):
+    pass
+
+
+class TimedCursorDebugWrapper(TimedCursorMixin, CursorDebugWrapper):
+    pass
+
+
+@receiver(connection_created, dispatch_uid="hubot.utils.metrics.time_queries")
+def time_queries(sender, connection, **kwargs):
+    # the connections are per thread, each one gets the timed cursors when it connects
+    connection.make_cursor = lambda cursor: TimedCursorWrapper(cursor, connection)
+    connection.make_debug_cursor = lambda cursor: TimedCursorDebugWrapper(cursor, connection)
+
+
+def timed(phase, func):
+    """
+    Wraps ``func`` so its time is added to ``phase`` of the running command.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        timing = current_timing()
+        if timing is None:
+            return func(*args, **kwargs)
+        with timing.phase(phase):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class TimedProxy(object):
+    """
+    Proxies ``obj``, the time of every method call is added to ``phase`` of the running command.
+    """
+
+    def __init__(self, obj, phase):
+        self._obj = obj
+        self._phase = phase
+
+    def __getattr__(self, name):
+        value = getattr(self._obj, name)
+        if callable(value):
+            return timed(self._phase, value)
+        return value
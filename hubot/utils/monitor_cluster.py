@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Several ``marathon_monitor`` processes sharing the marathon events.
+
+One process, the leader, reads the event stream: it holds a lease in redis,
+renewed every third of ``ttl`` seconds, and stops reading as soon as it can't
+tell it still holds it. The others try to take the lease as often, so a
+leader gone away is replaced within ``ttl`` seconds, at once when it
+released the lease on exit.
+
+The leader doesn't handle the events, it pushes them to ``partitions`` redis
+lists by a hash of their app. Every process, the leader too, sends a
+heartbeat to redis and places the processes alive on a consistent hash ring,
+each handles the events of the partitions the ring gives it. A process
+joining or leaving moves only the partitions of its neighbours, and the
+events of a process gone away wait in its lists until another takes them.
+"""
+import bisect
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+
+from redis.exceptions import RedisError
+
+from hubot.utils.event_pipeline import app_partition
+
+
+LOG = logging.getLogger(__name__)
+
+
+LEASE_KEY = "monitor:leader"
+MEMBERS_KEY = "monitor:members"
+PARTITION_KEY = "monitor:events:{0}"
+
+# the lease is only renewed or released by the process holding it
+RENEW_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+def member_identity():
+    return "{0}:{1}".format(socket.gethostname(), os.getpid())
+
+
+class LeaderLease(object):
+
+    def __init__(self, redis, identity, ttl=5, key=LEASE_KEY):
+        self.redis = redis
+        self.identity = identity
+        self.ttl = ttl
+        self.key = key
+        self.expires = 0
+
+    def held(self):
+        """
+        True until the lease may have expired in redis.
+        """
+        return time.time() < self.expires
+
+    def refresh(self):
+        """
+        Renews the lease, or takes it when it's free, and tells whether it's held.
+        """
+        started = time.time()
+        milliseconds = int(self.ttl * 1000)
+        try:
+            held = self.redis.eval(RENEW_SCRIPT, 1, self.key, self.identity, milliseconds) or \
+                self.redis.set(self.key, self.identity, nx=True, px=milliseconds)
+        except RedisError as e:
+            LOG.error(str(e))
+            return self.held()
+        if held and not self.held():
+            LOG.warning("{0} leads the marathon monitors".format(self.identity))
+        self.expires = started + self.ttl if held else 0
+        return bool(held)
+
+    def release(self):
+        self.expires = 0
+        try:
+            self.redis.eval(RELEASE_SCRIPT, 1, self.key, self.identity)
+        except RedisError as e:
+            LOG.error(str(e))
+
+
+def ring_hash(key):
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+
+    def __init__(self, nodes, replicas=64):
+        self.points = sorted((ring_hash(u"{0}#{1}".format(node, i)), node) for node in nodes for i in range(replicas))
+        self.hashes = [point for point, node in self.points]
+
+    def node(self, key):
+        if not self.points:
+            return None
+        return self.points[bisect.bisect(self.hashes, ring_hash(key)) % len(self.points)][1]
+
+
+class MonitorCluster(object):
+
+    def __init__(self, redis, identity, partitions=64, ttl=5):
+        """
+        :param int partitions: redis lists the events are spread on, the same in all the processes
+        :param int ttl: seconds without heartbeat after which a process is gone
+        """
+        self.redis = redis
+        self.identity = identity
+        self.partitions = partitions
+        self.ttl = ttl
+        self.ring = HashRing([identity])
+        self.pops = 0
+
+    def heartbeat(self):
+        """
+        Tells the process is alive and places the processes alive on the ring.
+        """
+        now = time.time()
+        try:
+            self.redis.hset(MEMBERS_KEY, self.identity, now)
+            members = self.redis.hgetall(MEMBERS_KEY)
+            gone = [member for member, seen in members.items() if now - float(seen) > self.ttl]
+            if gone:
+                self.redis.hdel(MEMBERS_KEY, *gone)
+        except RedisError as e:
+            LOG.error(str(e))
+            return
+        self.ring = HashRing(sorted(set(members) - set(gone)))
+
+    def leave(self):
+        try:
+            self.redis.hdel(MEMBERS_KEY, self.identity)
+        except RedisError as e:
+            LOG.error(str(e))
+
+    def owned(self):
+        """
+        Partitions handled by the process.
+        """
+        return [partition for partition in range(self.partitions) if self.ring.node(str(partition)) == self.identity]
+
+    def push(self, raw):
+        """
+        Sends the raw event ``raw`` to the partition of its app.
+        """
+        partition = app_partition(json.loads(raw), self.partitions)
+        self.redis.rpush(PARTITION_KEY.format(partition), raw)
+
+    def pop(self, timeout=1):
+        """
+        The next event of the partitions of the process, None when there was none for ``timeout`` seconds.
+        """
+        keys = [PARTITION_KEY.format(partition) for partition in self.owned()]
+        if not keys:
+            time.sleep(timeout)
+            return None
+        # blpop looks at the keys in order, they are rotated so that a busy partition doesn't starve the next ones
+        self.pops += 1
+        keys = keys[self.pops % len(keys):] + keys[:self.pops % len(keys)]
+        item = self.redis.blpop(keys, timeout=timeout)
+        return json.loads(item[1]) if item else None
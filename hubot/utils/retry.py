@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+One retry policy for the calls to marathon and cinder.
+
+Every endpoint has a circuit breaker kept in redis, so all the web and celery
+workers see the same state: after ``threshold`` failures in a row the circuit
+opens and the calls are refused without reaching the endpoint for
+``reset_after`` seconds, then a single call is let through to probe it. The
+retries are spread with decorrelated jitter, and each endpoint has a retry
+budget: in a window of ``window`` seconds the retries may not exceed
+``min_retries`` plus ``budget_ratio`` of the calls, so a degraded endpoint
+isn't flooded by the retries of every task at once.
+
+Redis being away never blocks a call: the breaker stays closed and the budget
+is unlimited.
+"""
+import logging
+import random
+import time
+
+from cinderclient.exceptions import ClientException
+from django.conf import settings
+from marathon.exceptions import InternalServerError, MarathonError, MarathonHttpError
+from redis.exceptions import RedisError
+
+from api.utils import client
+from hubot.utils.metrics import call_retries
+
+
+LOG = logging.getLogger(__name__)
+
+
+BREAKER_KEY = "breaker:{0}"
+PROBE_KEY = "breaker:{0}:probe"
+BUDGET_KEY = "retry_budget:{0}:{1}"
+
+
+class CircuitOpenError(Exception):
+
+    def __init__(self, endpoint, retry_after):
+        super(CircuitOpenError, self).__init__(
+            u"Circuit of {0} is open, retry in {1:.0f}s".format(endpoint, retry_after))
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+def decorrelated_jitter(previous, base, cap):
+    """
+    Next pause between two attempts, random between ``base`` and three times the ``previous`` pause.
+    """
+    return min(cap, random.uniform(base, max(previous or base, base) * 3))
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, endpoint, redis, threshold=5, reset_after=30):
+        self.endpoint = endpoint
+        self.redis = redis
+        self.threshold = threshold
+        self.reset_after = reset_after
+
+    @property
+    def key(self):
+        return BREAKER_KEY.format(self.endpoint)
+
+    def before_call(self):
+        """
+        Raises `CircuitOpenError` when the circuit is open, or half-open and another call is probing the endpoint.
+        """
+        try:
+            opened_until = self.redis.hget(self.key, "opened_until")
+            if not opened_until:
+                return
+            remaining = float(opened_until) - time.time()
+            if remaining <= 0 and self.redis.set(PROBE_KEY.format(self.endpoint), 1, nx=True, ex=self.reset_after):
+                return
+        except RedisError as e:
+            LOG.error(str(e))
+            return
+        raise CircuitOpenError(self.endpoint, max(remaining, 0))
+
+    def record_success(self):
+        try:
+            self.redis.delete(self.key, PROBE_KEY.format(self.endpoint))
+        except RedisError as e:
+            LOG.error(str(e))
+
+    def record_failure(self):
+        try:
+            pipe = self.redis.pipeline()
+            pipe.hincrby(self.key, "failures", 1)
+            pipe.expire(self.key, self.reset_after * 10)
+            failures = pipe.execute()[0]
+            if failures >= self.threshold:
+                pipe = self.redis.pipeline()
+                pipe.hset(self.key, "opened_until", time.time() + self.reset_after)
+                pipe.delete(PROBE_KEY.format(self.endpoint))
+                pipe.execute()
+                LOG.warning("Circuit of {0} opened after {1} failures".format(self.endpoint, failures))
+        except RedisError as e:
+            LOG.error(str(e))
+
+
+class RetryBudget(object):
+
+    def __init__(self, endpoint, redis, ratio=0.2, min_retries=10, window=60):
+        self.endpoint = endpoint
+        self.redis = redis
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+
+    @property
+    def key(self):
+        return BUDGET_KEY.format(self.endpoint, int(time.time() / self.window))
+
+    def record_call(self):
+        try:
+            pipe = self.redis.pipeline()
+            pipe.hincrby(self.key, "calls", 1)
+            pipe.expire(self.key, self.window * 2)
+            pipe.execute()
+        except RedisError as e:
+            LOG.error(str(e))
+
+    def withdraw(self):
+        """
+        Takes one retry from the budget, False when it's spent.
+        """
+        key = self.key
+        try:
+            pipe = self.redis.pipeline()
+            pipe.hincrby(key, "retries", 1)
+            pipe.hget(key, "calls")
+            pipe.expire(key, self.window * 2)
+            retries, calls = pipe.execute()[:2]
+        except RedisError as e:
+            LOG.error(str(e))
+            return True
+        if retries <= self.min_retries + self.ratio * int(calls or 0):
+            return True
+        try:
+            self.redis.hincrby(key, "retries", -1)
+        except RedisError as e:
+            LOG.error(str(e))
+        return False
+
+
+class RetryPolicy(object):
+
+    def __init__(self, endpoint, redis, is_failure, is_retryable=None, base=1, cap=60, attempts=5, threshold=5,
+                 reset_after=30, budget_ratio=0.2, min_retries=10, window=60):
+        """
+        :param is_failure: ``is_failure(error)``, True when the error tells the endpoint is unhealthy
+        :param is_retryable: ``is_retryable(error)``, True when the call may succeed later, ``is_failure`` by default
+        :param int base: shortest pause between two attempts, in seconds
+        :param int cap: longest pause between two attempts, in seconds
+        :param int attempts: calls made by `RetryPolicy.run` before giving up
+        """
+        self.endpoint = endpoint
+        self.is_failure = is_failure
+        self.is_retryable = is_retryable or is_failure
+        self.base = base
+        self.cap = cap
+        self.attempts = attempts
+        self.breaker = CircuitBreaker(endpoint, redis, threshold=threshold, reset_after=reset_after)
+        self.budget = RetryBudget(endpoint, redis, ratio=budget_ratio, min_retries=min_retries, window=window)
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls ``func`` once through the circuit breaker, raises `CircuitOpenError` when the circuit is open.
+        """
+        self.breaker.before_call()
+        self.budget.record_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if self.is_failure(e):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+        self.breaker.record_success()
+        return result
+
+    def backoff(self, previous=None, error=None):
+        """
+        Pause before the next attempt, at least until an open circuit lets a call through.
+        """
+        delay = decorrelated_jitter(previous, self.base, self.cap)
+        if isinstance(error, CircuitOpenError):
+            delay = max(delay, error.retry_after)
+        return delay
+
+    def should_retry(self, error, retries):
+        """
+        True when the call failing with ``error`` may be tried again, ``retries`` being the attempts left.
+        """
+        if retries <= 0 or not (isinstance(error, CircuitOpenError) or self.is_retryable(error)):
+            call_retries.inc(self.endpoint, "given_up")
+            return False
+        if not self.budget.withdraw():
+            LOG.warning("Retry budget of {0} is spent".format(self.endpoint))
+            call_retries.inc(self.endpoint, "over_budget")
+            return False
+        call_retries.inc(self.endpoint, "retried")
+        return True
+
+    def poll(self, check, timeout, interval=None):
+        """
+        Calls ``check`` every ``interval`` seconds, ``base`` by default, until it returns True.
+
+        A poll isn't a retry: the pause doesn't grow, and the waiting ends at a deadline ``timeout`` seconds away.
+
+        :returns: False when the deadline passed first
+        """
+        deadline = time.time() + timeout
+        interval = interval or self.base
+        while not check():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(interval, remaining))
+        return True
+
+    def run(self, func, *args, **kwargs):
+        """
+        Calls ``func`` until it succeeds, sleeping between the attempts, and raises the last error.
+        """
+        delay = None
+        retries = self.attempts - 1
+        while True:
+            try:
+                return self.call(func, *args, **kwargs)
+            except Exception as e:
+                if not self.should_retry(e, retries):
+                    raise
+                LOG.error(str(e))
+                delay = self.backoff(delay, e)
+                retries -= 1
+                time.sleep(delay)
+
+
+def is_marathon_failure(error):
+    return isinstance(error, InternalServerError) or (
+        isinstance(error, MarathonError) and not isinstance(error, MarathonHttpError))
+
+
+def is_marathon_retryable(error):
+    return is_marathon_failure(error) or (isinstance(error, MarathonHttpError) and error.status_code == 409)
+
+
+def is_cinder_failure(error):
+    if isinstance(error, ClientException):
+        return (error.code or 0) >= 500 or error.code == 413
+    return True
+
+
+marathon_policy = RetryPolicy(
+    "marathon", client, is_marathon_failure, is_marathon_retryable, base=settings.RETRY_BASE,
+    cap=settings.TIMEOUT_FOR_STATUS_FINISHED, threshold=settings.CIRCUIT_BREAKER_THRESHOLD,
+    reset_after=settings.CIRCUIT_BREAKER_RESET_AFTER, budget_ratio=settings.RETRY_BUDGET_RATIO)
+cinder_policy = RetryPolicy(
+    "cinder", client, is_cinder_failure, base=settings.RETRY_BASE, cap=settings.TIMEOUT_FOR_STATUS_FINISHED,
+    threshold=settings.CIRCUIT_BREAKER_THRESHOLD, reset_after=settings.CIRCUIT_BREAKER_RESET_AFTER,
+    budget_ratio=settings.RETRY_BUDGET_RATIO)
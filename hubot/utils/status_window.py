@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Coalesces the task status events of the monitor.
+
+A rollout of 20 instances sends 20 nearly identical events within seconds.
+They are gathered in memory by ``appId:version`` and, every ``window``
+seconds, the latest status of the version is emitted once, if enough tasks
+reached it: ``MINIMUM_HEALTH_CAPACITY`` of the instances of the app. The status
+is emitted again only when it changes.
+
+The tasks seen and the status emitted of every version are written to redis
+at each flush, as a checkpoint read back when the monitor restarts. Only the
+flush talks to redis: the checkpoints of the versions new to the process are
+read there, in one round trip, before their transitions are looked at, so the
+events are handled without waiting on redis.
+"""
+import json
+import logging
+import math
+import threading
+import time
+
+from redis.exceptions import RedisError
+
+
+LOG = logging.getLogger(__name__)
+
+
+CHECKPOINT_KEY = "monitor:status:{0}:{1}"
+
+
+class VersionStatus(object):
+    """
+    Task statuses of one version of an app.
+    """
+
+    def __init__(self, app_id, version, tasks=None, emitted=None):
+        self.app_id = app_id
+        self.version = version
+        self.tasks = tasks or {}
+        self.emitted = emitted
+        self.instances = 1
+        self.labels = {}
+        self.status = None
+        self.timestamp = None
+        self.updated = time.time()
+        self.dirty = False
+        # the checkpoint of the version is read back by the next flush
+        self.restored = False
+
+    def add(self, task_id, status, timestamp, instances, labels):
+        self.tasks[task_id] = status
+        self.status = status
+        self.timestamp = timestamp
+        self.instances = instances
+        self.labels = labels
+        self.updated = time.time()
+        self.dirty = True
+
+    def transition(self, capacity):
+        """
+        The status to emit, None when not enough tasks reached it or it was emitted already.
+        """
+        if self.status is None or self.status == self.emitted:
+            return None
+        count = sum(1 for status in self.tasks.values() if status == self.status)
+        if self.instances > 1 and count < int(math.ceil(capacity * self.instances)):
+            return None
+        return self.status
+
+    def checkpoint(self):
+        return json.dumps({"tasks": self.tasks, "emitted": self.emitted})
+
+    def merge(self, checkpoint):
+        """
+        Completes the tasks seen by the process with the ones of a checkpoint written before, the newer win.
+        """
+        tasks = dict(checkpoint["tasks"])
+        tasks.update(self.tasks)
+        self.tasks = tasks
+        if self.emitted is None:
+            self.emitted = checkpoint["emitted"]
+
+
+class StatusWindow(object):
+
+    def __init__(self, emit, redis, capacity, window=2, ttl=900):
+        """
+        :param emit: ``emit(app_id, version, status, timestamp, labels)`` called once per transition
+        :param float capacity: share of the instances that must reach a status
+        :param int window: seconds the events are gathered before being looked at
+        :param int ttl: seconds a version without events is kept
+        """
+        self.emit = emit
+        self.redis = redis
+        self.capacity = capacity
+        self.window = window
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.versions = {}
+        self.stopped = threading.Event()
+
+    def restore(self):
+        """
+        Reads back the checkpoints of the versions new to the process, which may have been seen before a restart.
+
+        Only the flush thread restores, so a checkpoint is read once per version.
+        """
+        with self.lock:
+            entries = [entry for entry in self.versions.values() if not entry.restored]
+        if not entries:
+            return
+        try:
+            pipe = self.redis.pipeline()
+            for entry in entries:
+                pipe.get(CHECKPOINT_KEY.format(entry.app_id, entry.version))
+            values = pipe.execute()
+        except RedisError as e:
+            LOG.error(str(e))
+            values = [None] * len(entries)
+        with self.lock:
+            for entry, value in zip(entries, values):
+                if value:
+                    entry.merge(json.loads(value))
+                entry.restored = True
+
+    def add(self, app_id, version, task_id, status, timestamp, instances, labels):
+        with self.lock:
+            entry = self.versions.setdefault((app_id, version), VersionStatus(app_id, version))
+            entry.add(task_id, status, timestamp, instances, labels)
+
+    def flush(self):
+        """
+        Emits the transitions of the versions changed since the last flush and writes their checkpoints.
+        """
+        self.restore()
+        now = time.time()
+        transitions = []
+        checkpoints = {}
+        with self.lock:
+            for key, entry in self.versions.items():
+                if not entry.restored:
+                    # added after the checkpoints were read, it waits for the next flush
+                    continue
+                if not entry.dirty:
+                    if now - entry.updated > self.ttl:
+                        del self.versions[key]
+                    continue
+                entry.dirty = False
+                status = entry.transition(self.capacity)
+                if status is not None:
+                    entry.emitted = status
+                    transitions.append((entry.app_id, entry.version, status, entry.timestamp, entry.labels))
+                checkpoints[CHECKPOINT_KEY.format(entry.app_id, entry.version)] = entry.checkpoint()
+
+        if checkpoints:
+            try:
+                pipe = self.redis.pipeline()
+                for key, value in checkpoints.items():
+                    pipe.set(key, value, ex=self.ttl)
+                pipe.execute()
+            except RedisError as e:
+                LOG.error(str(e))
+
+        for transition in transitions:
+            try:
+                self.emit(*transition)
+            except Exception:
+                LOG.exception("Failed to emit the status of {0}:{1}".format(*transition[:2]))
+        return len(transitions)
+
+    def run(self):
+        while not self.stopped.wait(self.window):
+            self.flush()
+        self.flush()
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name="status-window")
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
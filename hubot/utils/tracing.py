@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Tracing of the http calls to marathon.
+
+Every call is observed in the ``hubot_marathon_request_seconds`` histogram by
+method, endpoint template (``/v2/apps/{app_id}`` rather than the app itself)
+and status code. The calls slower than ``MARATHON_SLOW_CALL`` seconds are
+logged to the ``hubot.marathon.slow`` logger, ``MARATHON_SLOW_CALL_SAMPLE`` of
+them, with the app id and what made the call: the chat command, the celery
+task or, in the monitor, the process.
+"""
+import logging
+import os
+import random
+import re
+import time
+
+from celery import current_task
+from django.conf import settings
+from marathon.exceptions import MarathonHttpError
+
+from hubot.utils.marathon_client import PooledMarathonClient
+from hubot.utils.metrics import current_timing, marathon_request_seconds
+
+
+SLOW_LOG = logging.getLogger("hubot.marathon.slow")
+
+
+ENDPOINT_TEMPLATES = [(re.compile(pattern), template) for pattern, template in [
+    (r"^/v2/apps/(?P<app_id>.+)/tasks/[^/]+$", "/v2/apps/{app_id}/tasks/{task_id}"),
+    (r"^/v2/apps/(?P<app_id>.+)/versions/[^/]+$", "/v2/apps/{app_id}/versions/{version}"),
+    (r"^/v2/apps/(?P<app_id>.+)/tasks$", "/v2/apps/{app_id}/tasks"),
+    (r"^/v2/apps/(?P<app_id>.+)/versions$", "/v2/apps/{app_id}/versions"),
+    (r"^/v2/apps/(?P<app_id>.+)/restart$", "/v2/apps/{app_id}/restart"),
+    (r"^/v2/apps/(?P<app_id>.+)$", "/v2/apps/{app_id}"),
+    (r"^/v2/queue/(?P<app_id>.+)/delay$", "/v2/queue/{app_id}/delay"),
+    (r"^/v2/deployments/[^/]+$", "/v2/deployments/{deployment_id}"),
+    (r"^/v2/groups/.+$", "/v2/groups/{group_id}"),
+]]
+
+
+def endpoint_template(path):
+    """
+    :returns: ``(endpoint template, app id or None)`` of a request path
+    """
+    for pattern, template in ENDPOINT_TEMPLATES:
+        match = pattern.match(path)
+        if match:
+            app_id = match.groupdict().get("app_id")
+            return template, "/" + app_id.strip("/") if app_id else None
+    return path, None
+
+
+def correlation_id():
+    """
+    What the running code is serving: ``command:<command>:<id>``, ``task:<task name>:<task id>`` or ``pid:<pid>``.
+    """
+    timing = current_timing()
+    if timing is not None:
+        return u"command:{0}:{1}".format(timing.command, timing.id)
+    if current_task and current_task.request.id:
+        return u"task:{0}:{1}".format(current_task.name, current_task.request.id)
+    return u"pid:{0}".format(os.getpid())
+
+
+def trace_call(method, path, status, seconds):
+    endpoint, app_id = endpoint_template(path)
+    marathon_request_seconds.observe(seconds, method, endpoint, status)
+    if seconds >= settings.MARATHON_SLOW_CALL and random.random() < settings.MARATHON_SLOW_CALL_SAMPLE:
+        SLOW_LOG.warning(u"Slow marathon call {0} {1} app={2} status={3} seconds={4:.3f} from={5}".format(
+            method, endpoint, app_id or "-", status, seconds, correlation_id()))
+
+
+class TracedMarathonClient(PooledMarathonClient):
+    """
+    `PooledMarathonClient` tracing each of its calls with `trace_call`.
+    """
+
+    def _do_request(self, method, path, params=None, data=None):
+        start = time.time()
+        status = "error"
+        try:
+            response = super(TracedMarathonClient, self)._do_request(method, path, params=params, data=data)
+            status = response.status_code
+            return response
+        except MarathonHttpError as e:
+            status = e.status_code
+            raise
+        finally:
+            trace_call(method, path, status, time.time() - start)
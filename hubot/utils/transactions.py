@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Side effects run once the transaction that caused them is committed.
+
+Django 1.8 has no ``transaction.on_commit``. Inside `atomic` the callbacks of
+`on_commit` are kept until the outermost `atomic` block commits, and dropped
+when the block they were registered in rolls back, on an error or after
+``transaction.set_rollback(True)``. Outside of it they run at
+once, so code calling `on_commit` behaves as before when not in a batch.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.db import transaction
+
+
+LOG = logging.getLogger(__name__)
+
+
+_local = threading.local()
+
+
+def on_commit(func, *args, **kwargs):
+    """
+    Calls ``func(*args, **kwargs)`` once the current `atomic` block commits, at once outside of one.
+    """
+    callbacks = getattr(_local, "callbacks", None)
+    if callbacks is None:
+        return func(*args, **kwargs)
+    callbacks.append((func, args, kwargs))
+
+
+@contextmanager
+def atomic():
+    """
+    ``transaction.atomic()`` running the `on_commit` callbacks after the outermost block committed.
+    """
+    outermost = getattr(_local, "callbacks", None) is None
+    if outermost:
+        _local.callbacks = []
+    registered = len(_local.callbacks)
+    try:
+        with transaction.atomic():
+            yield
+            if transaction.get_rollback():
+                del _local.callbacks[registered:]
+    except:
+        del _local.callbacks[registered:]
+        raise
+    finally:
+        if outermost:
+            callbacks, _local.callbacks = _local.callbacks, None
+    if outermost:
+        for func, args, kwargs in callbacks:
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                # the transaction is committed already, there's nothing left to undo
+                LOG.exception("Failed to run {0} after commit".format(getattr(func, "__name__", func)))
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Waits on the marathon events instead of sleep-polling marathon.
+
+The monitor publishes every event it reads to the channel of each app the event
+is about. A waiter subscribes to the channel of its app and checks its
+condition once (the event may be gone already), then again at every event of
+the app, until the condition holds or the timeout expires. The condition is
+also checked when no event came for a while, the pause doubling each time, so
+a lost event or redis being away only makes the wait slower.
+"""
+import json
+import logging
+import time
+
+from redis.exceptions import RedisError
+
+from api.utils import client
+from hubot.utils.app_state import deployment_apps
+
+
+LOG = logging.getLogger(__name__)
+
+
+CHANNEL = "marathon:events:{0}"
+
+
+def event_apps(data):
+    """
+    Ids of the apps a marathon event is about.
+    """
+    if data.get("appId"):
+        return [data["appId"]]
+    if data.get("appDefinition"):
+        return [data["appDefinition"]["id"]]
+    if data.get("plan"):
+        return deployment_apps(data["plan"])
+    return []
+
+
+def publish_event(data):
+    message = json.dumps(data)
+    try:
+        for app_id in event_apps(data):
+            client.publish(CHANNEL.format(app_id), message)
+    except RedisError as e:
+        LOG.error(str(e))
+
+
+def subscribe(app_id):
+    try:
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(CHANNEL.format(app_id))
+    except RedisError as e:
+        LOG.error(str(e))
+        return None
+    return pubsub
+
+
+def next_event(pubsub, timeout):
+    """
+    Waits ``timeout`` seconds at most for the next event of the channel, None if there was none.
+    """
+    end = time.time() + timeout
+    while True:
+        remaining = end - time.time()
+        if remaining <= 0:
+            return None
+        message = pubsub.get_message(timeout=remaining)
+        if message is not None and message["type"] == "message":
+            return json.loads(message["data"])
+
+
+def wait_for(app_id, condition, timeout=500, interval=1, max_interval=30):
+    """
+    Blocks until ``condition()`` is true, checked at every event of ``app_id``.
+
+    :param int interval: first pause between two checks when no event comes, doubled up to ``max_interval``
+    :returns: False when ``timeout`` seconds passed before the condition held
+    """
+    deadline = time.time() + timeout
+    pubsub = subscribe(app_id)
+    try:
+        while True:
+            if condition():
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            pause = min(interval, remaining)
+            interval = min(interval * 2, max_interval)
+
+            if pubsub is None:
+                time.sleep(pause)
+                continue
+            try:
+                next_event(pubsub, pause)
+            except RedisError as e:
+                LOG.error(str(e))
+                pubsub = None
+    finally:
+        if pubsub is not None:
+            pubsub.close()
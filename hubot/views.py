@@ -5,7 +5,8 @@ import logging
 from django.conf import settings
 from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_GET, require_POST
+from hubot.utils.metrics import expose_metrics
 from projects.models import ProjectBuild, ProjectRelease
 from projects.tasks import release_deploy
 
@@ -47,3 +48,11 @@ def build_notify(request):
         return HttpResponse("Success")
 
     return HttpResponse("Failed", status=400)
+
+
+@require_GET
+def metrics(request):
+    # the latencies are labelled by user, command and marathon endpoint, they're for the scraper and the staff only
+    if request.META.get("REMOTE_ADDR") not in settings.METRICS_ALLOWED_IPS and not request.user.is_staff:
+        return HttpResponse("Forbidden", status=403)
+    return HttpResponse(expose_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -2,28 +2,29 @@
 import logging
 from django.contrib import admin
 
+from hubot.utils.deploy_batch import bulk_deploy, bulk_suspend
 from hubot.utils.mesos import get_image_fullname
 from projects.models import Project, ProjectConfig, ProjectRelease, ProjectPort, ProjectAddon, ProjectVolume, \
     ProjectBuild
-from projects.tasks import release_deploy, release_suspend
 
 
 logger = logging.getLogger(__name__)
 
 
+def get_running_releases(queryset):
+    releases = [project.get_running_release() for project in queryset]
+    return [release for release in releases if release]
+
+
 def project_release(modeladmin, request, queryset):
-    for query in queryset:
-        release = query.get_running_release()
-        if release:
-            release_deploy(release.id, enqueue=True)
+    result = bulk_deploy(get_running_releases(queryset))
+    modeladmin.message_user(request, result.describe("deployed"))
 project_release.short_description = "Releases all selected projects"
 
 
 def project_suspend(modeladmin, request, queryset):
-    for query in queryset:
-        release = query.get_running_release()
-        if release:
-            release_suspend(release.id, enqueue=True)
+    result = bulk_suspend(get_running_releases(queryset))
+    modeladmin.message_user(request, result.describe("suspended"))
 project_suspend.short_description = "Suspend all selected projects"
 
 
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0013_project_use_lb'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='projectrelease',
+            index_together=set([('project', 'created')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0014_release_project_created_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='projectrelease',
+            name='spec_hash',
+            field=models.CharField(max_length=40, verbose_name='Marathon Spec Hash', blank=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def track_staging(apps, schema_editor):
+    # the deployments in flight keep being followed by reconcile_deployments
+    ProjectRelease = apps.get_model('projects', 'ProjectRelease')
+    ProjectRelease.objects.filter(status='Staging').exclude(deployment_id='').update(deployed_at=F('modified'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0015_projectrelease_spec_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='projectrelease',
+            name='deployed_at',
+            field=models.DateTimeField(null=True, verbose_name='Marathon Deployed At', blank=True),
+        ),
+        migrations.RunPython(track_staging, migrations.RunPython.noop),
+    ]
@@ -4,6 +4,7 @@ from django.conf import settings
 from django.db import models
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 from model_utils.models import TimeStampedModel, StatusModel
@@ -13,6 +14,7 @@ from hubot.utils.build import build_code_to_docker
 from hubot.fields import UpperCaseCharField
 from hubot.models import MesosResourceModel, NamespaceModel
 from hubot.utils.mesos import MarathonAppMixin, clean_container_path
+from hubot.utils.transactions import on_commit
 
 
 logger = logging.getLogger('hubot')
@@ -70,11 +72,12 @@ class Project(NamespaceModel, MesosResourceModel):
         """
         :return dict
         """
+        from addons.models import select_real_addons
         configs = dict((e.key.upper(), e.value) for e in self.configs.all())
 
-        for pa in ProjectAddon.objects.filter(project=self).all():
-            addon = getattr(pa.addon, "addon" + pa.addon.slug)
-            configs.update(addon.get_config(primary=pa.primary, alias=pa.alias))
+        project_addons = select_real_addons(ProjectAddon.objects.filter(project=self), prefix="addon__", depend=False)
+        for pa in project_addons:
+            configs.update(pa.addon.real_addon.get_config(primary=pa.primary, alias=pa.alias))
 
         return configs
 
@@ -179,7 +182,7 @@ class ProjectBuild(StatusModel, TimeStampedModel, models.Model):
             self.status = ProjectBuild.STATUS.Staging
             self.save()
             from projects.tasks import check_build_status
-            check_build_status.apply_async(args=[task_id], countdown=settings.TIMEOUT_FOR_STATUS_FINISHED)
+            on_commit(check_build_status.apply_async, args=[task_id], countdown=settings.TIMEOUT_FOR_STATUS_FINISHED)
 
 
 @python_2_unicode_compatible
@@ -197,6 +200,25 @@ class ProjectConfig(TimeStampedModel, models.Model):
         return "{0}:{1}".format(self.project.name, self.key)
 
 
+class ReleaseSpecContext(object):
+    """
+    What the marathon app of a release is built from, loaded in the same few queries whatever the project has.
+    """
+
+    def __init__(self, release):
+        missing = [name for name in ("project", "build")
+                   if not hasattr(release, ProjectRelease._meta.get_field(name).get_cache_name())]
+        if missing:
+            loaded = ProjectRelease.objects.select_related("project__user", "build").get(pk=release.pk)
+            for name in missing:
+                setattr(release, name, getattr(loaded, name))
+
+        project = release.project
+        self.configs = project.get_configs()
+        self.volumes = list(project.volumes.all())
+        self.ports = project.get_ports()
+
+
 @python_2_unicode_compatible
 class ProjectRelease(MarathonAppMixin, StatusModel, TimeStampedModel, models.Model):
 
@@ -213,10 +235,16 @@ class ProjectRelease(MarathonAppMixin, StatusModel, TimeStampedModel, models.Mod
     build = models.ForeignKey(ProjectBuild, related_name=_('deploys'))
     m_version = models.CharField(max_length=128, blank=True, verbose_name=_('Marathon Version'))
     deployment_id = models.CharField(max_length=128, blank=True, verbose_name=_('Marathon Deployment Id'))
+    spec_hash = models.CharField(max_length=40, blank=True, verbose_name=_('Marathon Spec Hash'))
+    # when the deployment followed by `hubot.tasks.reconcile_deployments` was put, None once it's settled
+    deployed_at = models.DateTimeField(null=True, blank=True, verbose_name=_('Marathon Deployed At'))
 
     class Meta:
         verbose_name = _(u"Project Release")
         ordering = ('-modified',)
+        index_together = (("project", "created"),)
+
+    _spec_context = None
 
     def __str__(self):
         return u"{0}:{1}".format(self.project.name, self.build.tag)
@@ -225,16 +253,23 @@ class ProjectRelease(MarathonAppMixin, StatusModel, TimeStampedModel, models.Mod
         self.status = self.STATUS.Failed
         self.save()
 
-    def check_status_after(self, seconds):
-        from hubot.tasks import check_release_status
-        check_release_status.apply_async(args=[self.deployment_id], countdown=seconds)
+    def clear_other_spec_hashes(self):
+        """
+        The releases of a project share one marathon app, once a release is put the others no longer match it.
+        """
+        ProjectRelease.objects.filter(project_id=self.project_id).exclude(id=self.id).exclude(
+            spec_hash="").update(spec_hash="")
 
     def check_suspend(self):
         from hubot.tasks import check_release_suspend
-        check_release_suspend.apply_async(args=[self.build.tag])
+        on_commit(check_release_suspend.apply_async, args=[self.build.tag])
 
     def do_rollback(self):
         if self.deployment_id:
+            # marathon goes back to the previous definition, the next deploy must be put again
+            if self.spec_hash:
+                ProjectRelease.objects.filter(id=self.id).update(spec_hash="")
+                self.spec_hash = ""
             from hubot.utils.mesos import marathon
             try:
                 app = marathon.delete_deployment(self.deployment_id)
@@ -247,12 +282,11 @@ class ProjectRelease(MarathonAppMixin, StatusModel, TimeStampedModel, models.Mod
                 except Exception as e:
                     logger.error(str(e))
                 else:
+                    # the rollback deployment is followed by reconcile_deployments too
                     release.m_version = app['version']
                     release.deployment_id = app['deploymentId']
+                    release.deployed_at = timezone.now()
                     release.save()
-                    from hubot.tasks import check_release_status
-                    check_release_status.apply_async(args=[release.deployment_id],
-                                                     countdown=settings.TIMEOUT_FOR_STATUS_FINISHED)
 
     @property
     def marathon_app_id(self):
@@ -269,15 +303,29 @@ class ProjectRelease(MarathonAppMixin, StatusModel, TimeStampedModel, models.Mod
         if self.project.args:
             return self.project.args.split()
 
+    @property
+    def spec_context(self):
+        """
+        :rtype: `projects.models.ReleaseSpecContext`, shared by the getters while ``get_marathon_app`` runs
+        """
+        return self._spec_context or ReleaseSpecContext(self)
+
+    def get_marathon_app(self):
+        self._spec_context = ReleaseSpecContext(self)
+        try:
+            return super(ProjectRelease, self).get_marathon_app()
+        finally:
+            self._spec_context = None
+
     @property
     def container_paths(self):
-        return [pv for pv in ProjectVolume.objects.filter(project=self.project, is_block_volume=False)]
+        return [pv for pv in self.spec_context.volumes if not pv.is_block_volume]
 
     @property
     def docker_parameters(self):
         parameters = [dict(key="label", value="weave_hostname={0}".format(self.project.slug + "-app"))]
 
-        volumes = ProjectVolume.objects.filter(project=self.project, is_block_volume=True)
+        volumes = [pv for pv in self.spec_context.volumes if pv.is_block_volume]
         if volumes:
             parameters.append(dict(key="volume-driver", value="rexray"))
             for volume in volumes:
@@ -288,7 +336,7 @@ class ProjectRelease(MarathonAppMixin, StatusModel, TimeStampedModel, models.Mod
         return parameters
 
     def get_env(self):
-        configs = self.project.get_configs()
+        configs = dict(self.spec_context.configs)
         configs.update({'WEAVE_CIDR': self.project.get_weave_cidr(), 'APP_VERSION': self.build.tag})
         return configs
 
@@ -319,7 +367,7 @@ class ProjectRelease(MarathonAppMixin, StatusModel, TimeStampedModel, models.Mod
         return "{0}:{1}".format(image_name, self.build.tag)
 
     def get_ports(self):
-        return self.project.get_ports()
+        return self.spec_context.ports
 
     def get_health_checks(self):
         from marathon.models import MarathonHealthCheck
@@ -2,15 +2,16 @@
 from __future__ import absolute_import
 from celery import shared_task
 from django.conf import settings
-from marathon import MarathonHttpError
+from marathon import MarathonError
 import requests
 from hubot.utils.mesos import create_or_update_marathon_app, suspend_marathon_app
+from hubot.utils.retry import CircuitOpenError, marathon_policy
 from projects.models import ProjectRelease, ProjectBuild
 from projects.utils import LOG
 
 
 @shared_task(ignore_result=True)
-def release_deploy(release_id, force=False, enqueue=False, retries=5):
+def release_deploy(release_id, force=False, enqueue=False, retries=5, delay=None):
     try:
         release = ProjectRelease.objects.get(id=release_id)
     except ProjectRelease.DoesNotExist:
@@ -18,21 +19,19 @@ def release_deploy(release_id, force=False, enqueue=False, retries=5):
     else:
         LOG.info("Try to release #{0}".format(release_id))
         try:
-            create_or_update_marathon_app(release, force)
-        except MarathonHttpError as e:
+            return marathon_policy.call(create_or_update_marathon_app, release, force)
+        except (MarathonError, CircuitOpenError) as e:
             LOG.error(str(e))
-            if enqueue and retries == 0:
+            if marathon_policy.should_retry(e, retries):
+                delay = marathon_policy.backoff(delay, e)
+                release_deploy.apply_async(args=[release.id, force, enqueue, retries - 1, delay], countdown=delay)
+            elif enqueue:
                 release.status = ProjectRelease.STATUS.Failed
                 release.save()
-                return
-            countdown = 0
-            if enqueue and retries and e.status_code in ["409", 409]:
-                countdown = settings.TIMEOUT_FOR_STATUS_FINISHED
-            release_deploy.apply_async(args=[release.id, force, enqueue, retries - 1], countdown=countdown)
 
 
 @shared_task(ignore_result=True)
-def release_suspend(release_id, force=False, enqueue=False, retries=5):
+def release_suspend(release_id, force=False, enqueue=False, retries=5, delay=None):
     try:
         release = ProjectRelease.objects.get(id=release_id)
     except ProjectRelease.DoesNotExist:
@@ -40,16 +39,15 @@ def release_suspend(release_id, force=False, enqueue=False, retries=5):
     else:
         LOG.info("Try to release #{0}".format(release_id))
         try:
-            suspend_marathon_app(release, force)
-        except MarathonHttpError as e:
-            if enqueue and retries:
-                release_suspend.apply_async(args=[release.id, force, enqueue, retries - 1],
-                                            countdown=settings.TIMEOUT_FOR_STATUS_FINISHED)
-            else:
-                if enqueue and retries == 0:
-                    release.status = ProjectRelease.STATUS.Failed
-                    release.save()
-                LOG.error(str(e))
+            marathon_policy.call(suspend_marathon_app, release, force)
+        except (MarathonError, CircuitOpenError) as e:
+            LOG.error(str(e))
+            if enqueue and marathon_policy.should_retry(e, retries):
+                delay = marathon_policy.backoff(delay, e)
+                release_suspend.apply_async(args=[release.id, force, enqueue, retries - 1, delay], countdown=delay)
+            elif enqueue:
+                release.status = ProjectRelease.STATUS.Failed
+                release.save()
 
 
 @shared_task(ignore_result=True)
@@ -10,9 +10,10 @@ from django.conf import settings
 from django.test import TestCase
 
 from accounts.factories import CustomUserFactory
-from addons.factories import AddonMySQLFactory
-from projects.factories import ProjectFactory, ProjectBuildFactory, ProjectConfigFactory, ProjectReleaseFactory
-from projects.models import ProjectAddon, Project
+from addons.factories import AddonMySQLFactory, AddonPostgresqlFactory, AddonRedisFactory
+from projects.factories import ProjectFactory, ProjectBuildFactory, ProjectConfigFactory, ProjectReleaseFactory, \
+    ProjectVolumeFactory
+from projects.models import ProjectAddon, Project, ProjectRelease
 
 
 class ProjectTest(TestCase):
@@ -80,6 +81,27 @@ class ProjectReleaseTest(TestCase):
             self.assertTrue(key in env)
             self.assertEqual(env[key], value)
 
+    def test_get_marathon_app_queries(self):
+        project = ProjectFactory()
+        ProjectConfigFactory(project=project)
+        ProjectVolumeFactory(project=project)
+        ProjectVolumeFactory(project=project, is_block_volume=True)
+        release = ProjectReleaseFactory(build__project=project)
+        AddonMySQLFactory().attach(project)
+
+        # project, user and build, configs, addons, volumes and ports
+        release = ProjectRelease.objects.get(id=release.id)
+        with self.assertNumQueries(5):
+            release.get_marathon_app()
+
+        for factory in [AddonMySQLFactory, AddonPostgresqlFactory, AddonRedisFactory] * 3:
+            factory().attach(project)
+        release = ProjectRelease.objects.get(id=release.id)
+        with self.assertNumQueries(5):
+            app = release.get_marathon_app()
+        self.assertIn("REDIS_URL", app.env)
+        self.assertEqual(len(app.container.volumes), 1)
+
     def test_get_labels(self):
         project = ProjectFactory(name="demo")
         build = ProjectBuildFactory(project=project)